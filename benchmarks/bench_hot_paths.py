@@ -0,0 +1,243 @@
+"""Micro-benchmarks for helpers that run on every /ws frame (pytest-benchmark).
+
+    pip install pytest pytest-benchmark
+    pytest benchmarks --benchmark-only --benchmark-storage=benchmarks/.benchmarks --benchmark-save=baseline
+    pytest benchmarks --benchmark-only --benchmark-storage=benchmarks/.benchmarks \\
+        --benchmark-compare --benchmark-compare-fail=mean:15%
+
+Scales: 1-1000 workflows, 1-500 agents and 1-10k visitors per site. Sockets are in-memory fakes
+whose sends never suspend, so the async helpers are driven without an event loop and the
+numbers are pure Python cost.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("LOOP_MONITOR_ENABLED", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import jwt  # noqa: E402
+import main  # noqa: E402
+
+WORKFLOW_COUNTS = [1, 10, 100, 1000]
+AGENT_COUNTS = [1, 10, 100, 500]
+VISITOR_COUNTS = [1, 100, 1000, 10000]
+
+
+class FakeSocket:
+    """WebSocket stand-in: counts frames, never blocks"""
+
+    def __init__(self, protocol: str = "json"):
+        self.state = SimpleNamespace(protocol=protocol)
+        self.sent = 0
+
+    async def send_text(self, payload: str):
+        self.sent += 1
+
+    async def send_bytes(self, payload: bytes):
+        self.sent += 1
+
+
+def run_sync(coro):
+    """Drive a coroutine that never suspends to completion without an event loop"""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError("coroutine suspended; the benchmark needs non-blocking fakes")
+
+
+def make_site(agents: int = 0, visitors: int = 0, workflows: list = None) -> dict:
+    site = {
+        "agents": {},
+        "supervisors": {},
+        "customers": {},
+        "names": {},
+        "admins": {},
+        "analysis_enabled": False,
+        "auto_reply_enabled": False,
+        "workflows": workflows or [],
+        "ai_tasks": {},
+        "topics": {},
+        "untargeted_agents": set(),
+        "assignments": {},
+        "event_seq": 0,
+        "event_log": main.deque(maxlen=main.RESUME_LOG_SIZE),
+        "ref_count": 1,
+        "pinned": False,
+        "config_token": None
+    }
+    for i in range(agents):
+        agent_id = f"agent-{i}"
+        site["agents"][agent_id] = {
+            "ws": FakeSocket(),
+            "username": f"Agent {i}",
+            # Most of the team is busy, so "first available" has to scan
+            "status": "online" if i == agents - 1 else "away",
+            "token": "token",
+            "role": "agent",
+            "topics": set(),
+            "explicit_topics": set(),
+            "viewing": None
+        }
+        site["untargeted_agents"].add(agent_id)
+    for i in range(visitors):
+        visitor_id = f"visitor-{i}"
+        site["customers"][visitor_id] = FakeSocket()
+        site["names"][visitor_id] = f"Visitor {i}"
+        main.VISITOR_DATA[visitor_id] = {"internal_visitor_id": f"iv-{i}", "conversation_id": f"conv-{i}"}
+    return site
+
+
+def make_workflows(count: int) -> list:
+    """new_message workflows with a mix of operators, none of which match the benchmark message"""
+    operators = [
+        ("message_text", "contains", "refund"),
+        ("visitor_name", "equals", "someone else"),
+        ("message_text", "not_equals", "hello, i have a question about pricing"),
+        ("idle_minutes", "greater_than", "30")
+    ]
+    return [
+        {
+            "id": i,
+            "name": f"workflow {i}",
+            "triggerType": "new_message" if i % 4 else "conversation_idle",
+            "isEnabled": True,
+            "priority": count - i,
+            "conditions": [
+                {"field": field, "operator": operator, "value": f"{value}-{i}" if operator == "contains" else value}
+                for field, operator, value in operators[:1 + i % len(operators)]
+            ],
+            "actions": []
+        }
+        for i in range(count)
+    ]
+
+
+CONTEXT = {
+    "visitor_id": "visitor-0",
+    "visitor_name": "Visitor 0",
+    "conversation_id": "conv-0",
+    "message_text": "Hello, I have a question about pricing",
+    "idle_minutes": "5"
+}
+
+
+@pytest.fixture(autouse=True)
+def clean_visitor_data():
+    yield
+    main.VISITOR_DATA.clear()
+
+
+# ------------------ WORKFLOWS ------------------
+
+@pytest.mark.parametrize("workflows", WORKFLOW_COUNTS)
+def test_evaluate_conditions(benchmark, workflows):
+    rules = make_workflows(workflows)
+
+    def evaluate_all():
+        return sum(main.evaluate_conditions(w["conditions"], CONTEXT) for w in rules)
+
+    assert benchmark(evaluate_all) == 0
+
+
+@pytest.mark.parametrize("workflows", WORKFLOW_COUNTS)
+def test_evaluate_workflows(benchmark, workflows):
+    site = make_site(agents=1, workflows=make_workflows(workflows))
+    benchmark(lambda: run_sync(main.evaluate_workflows(site, "site", "new_message", CONTEXT)))
+
+
+# ------------------ AGENT SELECTION ------------------
+
+@pytest.mark.parametrize("agents", AGENT_COUNTS)
+def test_get_round_robin_agent(benchmark, agents):
+    site = make_site(agents=agents)
+    assert benchmark(main.get_round_robin_agent, site) == f"agent-{agents - 1}"
+
+
+@pytest.mark.parametrize("agents", AGENT_COUNTS)
+def test_get_first_available_agent(benchmark, agents):
+    site = make_site(agents=agents)
+    agent_id, _ = benchmark(main.get_first_available_agent, site)
+    assert agent_id == f"agent-{agents - 1}"
+
+
+# ------------------ AUTH ------------------
+
+def _token(**overrides) -> str:
+    claims = {
+        "sub": "agent-1",
+        "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/name": "Agent 1",
+        "email": "agent@example.com",
+        "http://schemas.microsoft.com/ws/2008/06/identity/claims/role": "agent",
+        "aud": "ChatApp.Client",
+        "iss": "ChatApp.API",
+        "exp": int(time.time()) + 3600
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, main.JWT_SECRET, algorithm=main.JWT_ALGORITHM)
+
+
+def test_validate_jwt_token(benchmark):
+    token = _token()
+    assert benchmark(main.validate_jwt_token, token)["user_id"] == "agent-1"
+
+
+def test_validate_jwt_token_expired(benchmark):
+    token = _token(exp=int(time.time()) - 60)
+    assert benchmark(main.validate_jwt_token, token) is None
+
+
+# ------------------ BROADCAST ------------------
+
+MESSAGE = {"type": "message", "from": "visitor-0", "name": "Visitor 0", "message": "Hello, I have a question about pricing"}
+
+
+@pytest.mark.parametrize("agents", AGENT_COUNTS)
+def test_broadcast_to_agents(benchmark, agents):
+    site = make_site(agents=agents)
+    benchmark(lambda: run_sync(main.broadcast_to_agents(site, dict(MESSAGE))))
+    assert site["agents"]["agent-0"]["ws"].sent > 0
+
+
+@pytest.mark.parametrize("agents", AGENT_COUNTS)
+def test_publish_conversation_event_untargeted(benchmark, agents):
+    """Every agent still on the site feed receives every conversation event"""
+    site = make_site(agents=agents, visitors=1)
+    benchmark(lambda: run_sync(main.publish_conversation_event(site, "conv-0", dict(MESSAGE))))
+
+
+@pytest.mark.parametrize("agents", AGENT_COUNTS)
+def test_publish_conversation_event_targeted(benchmark, agents):
+    """Agents subscribed only to their assignments: one recipient regardless of team size"""
+    site = make_site(agents=agents, visitors=1)
+    for agent_id, agent_data in site["agents"].items():
+        main.update_agent_topics(site, agent_id, ["assigned"], True)
+    main.record_assignment(site, "conv-0", "agent-0")
+    benchmark(lambda: run_sync(main.publish_conversation_event(site, "conv-0", dict(MESSAGE))))
+    assert site["agents"]["agent-0"]["ws"].sent > 0
+    assert site["agents"][f"agent-{agents - 1}"]["ws"].sent == 0 or agents == 1
+
+
+@pytest.mark.parametrize("visitors", VISITOR_COUNTS)
+def test_agent_status_change_fanout(benchmark, visitors):
+    """Status changes go to every agent and every connected customer"""
+    site = make_site(agents=10, visitors=visitors)
+    conn = {"site": site, "auth": {"user_id": "agent-0", "username": "Agent 0"}}
+    benchmark(lambda: run_sync(main.handle_agent_status_change(conn, {"status": "away"})))
+
+
+@pytest.mark.parametrize("visitors", VISITOR_COUNTS)
+def test_send_agent_snapshot(benchmark, visitors):
+    """Full state sent to an agent that connects (or fails to resume)"""
+    site = make_site(agents=10, visitors=visitors)
+    ws = FakeSocket()
+    benchmark(lambda: run_sync(main.send_agent_snapshot(site, ws, "agent-0")))
@@ -0,0 +1,229 @@
+"""Stand-in for the .NET API for load tests: canned responses with simulated latency and errors.
+
+    python benchmarks/mock_api.py --port 5005 --latency-ms 20 --error-rate 0.01
+    API_BASE_URL=http://127.0.0.1:5005/api uvicorn main:app --port 8000
+
+Every endpoint main.py calls is served under /api; anything else gets {"success": true, "data": {}}.
+GET /mock/stats returns request counts per route.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+
+# Base latency plus an exponential tail, per request (milliseconds)
+MOCK_LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "20"))
+MOCK_JITTER_MS = float(os.getenv("MOCK_JITTER_MS", "10"))
+# The AI endpoints are much slower than the CRUD ones
+MOCK_AI_LATENCY_MS = float(os.getenv("MOCK_AI_LATENCY_MS", "400"))
+# Route -> base latency override, e.g. '{"/chat/message": 50}'
+MOCK_ROUTE_LATENCY_MS = json.loads(os.getenv("MOCK_ROUTE_LATENCY_MS", "{}"))
+# Fraction of requests answered with a 500, and fraction that hang past the client timeout
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_HANG_RATE = float(os.getenv("MOCK_HANG_RATE", "0"))
+MOCK_HANG_SECONDS = float(os.getenv("MOCK_HANG_SECONDS", "35"))
+# Site settings the app loads on first connection
+MOCK_ANALYSIS_ENABLED = os.getenv("MOCK_ANALYSIS_ENABLED", "false").lower() == "true"
+MOCK_AUTO_REPLY_ENABLED = os.getenv("MOCK_AUTO_REPLY_ENABLED", "false").lower() == "true"
+# Enabled non-matching new_message workflows per site, to load evaluate_workflows
+MOCK_WORKFLOWS = int(os.getenv("MOCK_WORKFLOWS", "0"))
+MOCK_AI_LIMIT = int(os.getenv("MOCK_AI_LIMIT", "1000000"))
+
+AI_ROUTES = {"/ai/analyze-message", "/ai/analyze-message-with-rag"}
+
+app = FastAPI()
+
+# route template -> {"requests", "errors", "hangs"}
+_stats = {}
+# (site_id, feature) -> used
+_ai_usage = {}
+
+
+def ok(data=None) -> dict:
+    return {"success": True, "data": data if data is not None else {}}
+
+
+@app.middleware("http")
+async def simulate_network(request: Request, call_next):
+    # Routing happens inside call_next, so match the route template here for per-route settings
+    path = request.url.path
+    template = next((r.path for r in app.routes if r.matches(request.scope)[0] == Match.FULL), path)
+    template = template[len("/api"):] if template.startswith("/api") else template
+    stats = _stats.setdefault(template, {"requests": 0, "errors": 0, "hangs": 0})
+    stats["requests"] += 1
+
+    if template.startswith("/mock"):
+        return await call_next(request)
+
+    base = MOCK_AI_LATENCY_MS if template in AI_ROUTES else MOCK_ROUTE_LATENCY_MS.get(template, MOCK_LATENCY_MS)
+    delay = base + (random.expovariate(1 / MOCK_JITTER_MS) if MOCK_JITTER_MS > 0 else 0)
+    roll = random.random()
+    if roll < MOCK_HANG_RATE:
+        stats["hangs"] += 1
+        await asyncio.sleep(MOCK_HANG_SECONDS)
+    else:
+        await asyncio.sleep(delay / 1000)
+    if roll < MOCK_HANG_RATE + MOCK_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse({"success": False, "message": "Simulated failure"}, status_code=500)
+    return await call_next(request)
+
+
+# ------------------ SITES ------------------
+
+@app.post("/api/sites/{site_id}/validate-api-key")
+async def validate_api_key(site_id: str):
+    return ok({"valid": True})
+
+
+@app.get("/api/sites/{site_id}")
+async def get_site(site_id: str):
+    return ok({
+        "id": site_id,
+        "name": f"Load test {site_id}",
+        "analysisEnabled": MOCK_ANALYSIS_ENABLED,
+        "autoReplyEnabled": MOCK_AUTO_REPLY_ENABLED,
+        "onboardingState": None
+    })
+
+
+@app.get("/api/sites/{site_id}/welcome-messages")
+async def welcome_messages(site_id: str):
+    return ok([{"id": 1, "message": "Hi! How can we help?", "isActive": True, "displayOrder": 1}])
+
+
+@app.get("/api/sites/{site_id}/workflows")
+async def workflows(site_id: str):
+    return ok([
+        {
+            "id": i,
+            "name": f"workflow {i}",
+            "triggerType": "new_message",
+            "isEnabled": True,
+            "priority": i,
+            "conditions": [{"field": "message_text", "operator": "contains", "value": f"never-matches-{i}"}],
+            "actions": [{"type": "add_tag", "config": {"tag": "bench"}}]
+        }
+        for i in range(MOCK_WORKFLOWS)
+    ])
+
+
+@app.get("/api/sites/{site_id}/agents")
+async def site_agents(site_id: str):
+    return ok([])
+
+
+# ------------------ CHAT ------------------
+
+@app.post("/api/chat/init")
+async def chat_init(request: Request):
+    body = await request.json()
+    return ok({"conversationId": str(uuid.uuid4()), "visitorId": f"iv-{body.get('visitorId')}"})
+
+
+@app.post("/api/chat/message")
+async def chat_message():
+    return ok({"id": str(uuid.uuid4())})
+
+
+@app.get("/api/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str):
+    return ok({"id": conversation_id, "tags": []})
+
+
+@app.post("/api/sites/{site_id}/conversations/{conversation_id}/{action}")
+async def conversation_action(site_id: str, conversation_id: str, action: str):
+    return ok({"id": conversation_id, "action": action})
+
+
+# ------------------ AI ------------------
+
+def _analysis(rag: bool) -> dict:
+    return {
+        "suggestedReply": "Thanks for reaching out! Let me check that for you.",
+        "interestLevel": random.choice(["Low", "Medium", "High"]),
+        "conversionPercentage": random.randint(10, 90),
+        "objection": None,
+        "nextAction": "Answer the question",
+        "usedKnowledgeBase": rag,
+        "relevantKnowledge": []
+    }
+
+
+@app.post("/api/ai/analyze-message")
+async def analyze_message():
+    return ok(_analysis(False))
+
+
+@app.post("/api/ai/analyze-message-with-rag")
+async def analyze_message_with_rag():
+    return ok(_analysis(True))
+
+
+@app.get("/api/subscriptions/sites/{site_id}/ai-usage")
+async def get_ai_usage(site_id: str):
+    return ok({
+        "analysis": {"used": _ai_usage.get((site_id, "analysis"), 0), "limit": MOCK_AI_LIMIT},
+        "autoReply": {"used": _ai_usage.get((site_id, "auto_reply"), 0), "limit": MOCK_AI_LIMIT}
+    })
+
+
+@app.post("/api/subscriptions/sites/{site_id}/ai-usage")
+async def record_ai_usage(site_id: str, request: Request):
+    body = await request.json()
+    key = (site_id, body.get("featureType", "analysis"))
+    _ai_usage[key] = _ai_usage.get(key, 0) + 1
+    return ok({"allowed": _ai_usage[key] <= MOCK_AI_LIMIT, "used": _ai_usage[key], "limit": MOCK_AI_LIMIT})
+
+
+@app.get("/api/knowledge/sites/{site_id}/stats")
+async def knowledge_stats(site_id: str):
+    return ok({"totalDocuments": 3, "indexedDocuments": 3, "totalChunks": 42, "lastUpdatedAt": "2024-01-01T00:00:00Z"})
+
+
+@app.get("/api/subscriptions/plans")
+async def plans():
+    return ok([{"id": "free", "name": "Free", "price": 0}, {"id": "pro", "name": "Pro", "price": 29}])
+
+
+# ------------------ FALLBACK ------------------
+
+@app.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def fallback(path: str):
+    return ok()
+
+
+@app.get("/mock/stats")
+async def mock_stats():
+    return _stats
+
+
+@app.post("/mock/reset")
+async def mock_reset():
+    _stats.clear()
+    _ai_usage.clear()
+    return {"success": True}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5005)
+    parser.add_argument("--latency-ms", type=float, default=MOCK_LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=MOCK_JITTER_MS)
+    parser.add_argument("--ai-latency-ms", type=float, default=MOCK_AI_LATENCY_MS)
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE)
+    parser.add_argument("--hang-rate", type=float, default=MOCK_HANG_RATE)
+    parser.add_argument("--workflows", type=int, default=MOCK_WORKFLOWS)
+    args = parser.parse_args()
+
+    MOCK_LATENCY_MS, MOCK_JITTER_MS, MOCK_AI_LATENCY_MS = args.latency_ms, args.jitter_ms, args.ai_latency_ms
+    MOCK_ERROR_RATE, MOCK_HANG_RATE, MOCK_WORKFLOWS = args.error_rate, args.hang_rate, args.workflows
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,366 @@
+"""Load test for /ws: a swarm of customer and agent sockets driving chat, typing and status traffic.
+
+Against a running app (pointed at benchmarks/mock_api.py, not the real API):
+    python benchmarks/ws_swarm.py --url ws://127.0.0.1:8000/ws --customers 2000 --agents 50 --duration 60
+
+Or let the swarm start the mock API and the app itself, and sample the app's RSS:
+    python benchmarks/ws_swarm.py --spawn --customers 2000 --agents 50 --duration 60
+
+Reports connect failures, throughput, p50/p90/p99 delivery latency (customer -> agent and
+agent -> customer) and peak RSS. --json writes the same report for comparing runs.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import jwt
+import websockets
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Must match the app's JWT settings so agent tokens validate
+JWT_SECRET = os.getenv("JWT_SECRET", "YourSuperSecretKeyThatShouldBeAtLeast32CharactersLong!")
+
+# Prefix of every message body the swarm sends; the rest is the send time in ns
+MARKER = "bench:"
+
+# kind -> count
+_sent = {}
+_received = {}
+# "customer_to_agent" | "agent_to_customer" -> latencies in seconds
+_latencies = {"customer_to_agent": [], "agent_to_customer": []}
+_connect_seconds = []
+_errors = {}
+# Bounds how many handshakes are in flight at once
+_connect_slots = None
+
+
+def count(store: dict, key: str, amount: int = 1):
+    store[key] = store.get(key, 0) + amount
+
+
+def agent_token(user_id: str, name: str) -> str:
+    return jwt.encode({
+        "sub": user_id,
+        "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/name": name,
+        "email": f"{user_id}@bench.local",
+        "http://schemas.microsoft.com/ws/2008/06/identity/claims/role": "agent",
+        "aud": "ChatApp.Client",
+        "iss": "ChatApp.API",
+        "exp": int(time.time()) + 24 * 3600
+    }, JWT_SECRET, algorithm="HS256")
+
+
+def marked(text: str) -> str:
+    return f"{MARKER}{time.time_ns()} {text}"
+
+
+def record_delivery(kind: str, message: str):
+    if not message or not message.startswith(MARKER):
+        return
+    sent_ns = int(message[len(MARKER):].split(" ", 1)[0])
+    _latencies[kind].append((time.time_ns() - sent_ns) / 1e9)
+
+
+async def open_socket(url: str):
+    started = time.perf_counter()
+    try:
+        async with _connect_slots:
+            ws = await websockets.connect(url, max_size=None, ping_interval=None, open_timeout=30)
+    except Exception as e:
+        count(_errors, f"connect: {type(e).__name__}")
+        return None
+    _connect_seconds.append(time.perf_counter() - started)
+    return ws
+
+
+# ------------------ CUSTOMERS ------------------
+
+async def run_customer(args, site_id: str, index: int, stop_at: float):
+    visitor_id = f"bench-{site_id}-{index}-{uuid.uuid4().hex[:6]}"
+    ws = await open_socket(f"{args.url}?siteId={site_id}&role=customer&visitorId={visitor_id}&apiKey={args.api_key}")
+    if ws is None:
+        return
+    count(_sent, "connected_customers")
+
+    async def receive():
+        async for raw in ws:
+            frame = json.loads(raw)
+            frame_type = frame.get("type")
+            count(_received, f"customer:{frame_type}")
+            if frame_type == "message" and frame.get("from") == "support":
+                record_delivery("agent_to_customer", frame.get("message"))
+            elif frame_type == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+
+    receiver = asyncio.ensure_future(receive())
+    try:
+        await ws.send(json.dumps({"type": "init", "name": f"Visitor {index}", "email": f"{visitor_id}@bench.local"}))
+        count(_sent, "init")
+        while time.monotonic() < stop_at and not receiver.done():
+            # Poisson arrivals at --message-rate per customer
+            await asyncio.sleep(random.expovariate(args.message_rate))
+            if args.typing:
+                await ws.send(json.dumps({"type": "typing_start"}))
+                count(_sent, "typing")
+                await asyncio.sleep(random.uniform(0.2, 1.5))
+            await ws.send(json.dumps({"message": marked(f"question from {visitor_id}")}))
+            count(_sent, "customer_message")
+            if args.typing:
+                await ws.send(json.dumps({"type": "typing_stop"}))
+    except websockets.ConnectionClosed:
+        count(_errors, "customer closed by server")
+    finally:
+        receiver.cancel()
+        await ws.close()
+
+
+# ------------------ AGENTS ------------------
+
+async def run_agent(args, site_id: str, index: int, stop_at: float):
+    user_id = f"bench-agent-{site_id}-{index}"
+    token = agent_token(user_id, f"Agent {index}")
+    ws = await open_socket(f"{args.url}?siteId={site_id}&role=support&token={token}")
+    if ws is None:
+        return
+    count(_sent, "connected_agents")
+    replies = asyncio.Queue()
+
+    async def receive():
+        async for raw in ws:
+            frame = json.loads(raw)
+            frame_type = frame.get("type")
+            count(_received, f"agent:{frame_type}")
+            if frame_type == "message" and frame.get("from") and frame.get("from") != "support":
+                record_delivery("customer_to_agent", frame.get("message"))
+                # Agents answer a share of the messages they see, like a team splitting the queue
+                if random.random() < args.reply_rate:
+                    replies.put_nowait(frame["from"])
+            elif frame_type == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+
+    async def status_changes():
+        while True:
+            await asyncio.sleep(random.expovariate(args.status_rate / 60))
+            await ws.send(json.dumps({"type": "agent_status_change", "status": random.choice(["away", "online"])}))
+            count(_sent, "status_change")
+
+    receiver = asyncio.ensure_future(receive())
+    statuses = asyncio.ensure_future(status_changes()) if args.status_rate > 0 else None
+    try:
+        while time.monotonic() < stop_at and not receiver.done():
+            try:
+                visitor_id = await asyncio.wait_for(replies.get(), max(0.1, stop_at - time.monotonic()))
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(random.uniform(0, args.reply_delay))
+            if args.typing:
+                await ws.send(json.dumps({"type": "support_typing", "to": visitor_id}))
+                count(_sent, "typing")
+            await ws.send(json.dumps({"to": visitor_id, "message": marked("answer")}))
+            count(_sent, "agent_message")
+    except websockets.ConnectionClosed:
+        count(_errors, "agent closed by server")
+    finally:
+        receiver.cancel()
+        if statuses:
+            statuses.cancel()
+        await ws.close()
+
+
+# ------------------ REPORT ------------------
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_mb(pid: int = None) -> float:
+    """Current RSS of a process from /proc, or this process' peak RSS elsewhere"""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+
+async def sample_rss(pid: int, peaks: dict):
+    while True:
+        for name, target in (("server", pid), ("swarm", None)):
+            if name == "server" and not pid:
+                continue
+            value = rss_mb(target)
+            if value is not None:
+                peaks[name] = max(peaks.get(name, 0), value)
+        await asyncio.sleep(1)
+
+
+def build_report(args, elapsed: float, peaks: dict) -> dict:
+    latency = {
+        kind: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2) if values else None,
+            "p90_ms": round(percentile(values, 0.90) * 1000, 2) if values else None,
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+            "max_ms": round(max(values) * 1000, 2) if values else None
+        }
+        for kind, values in _latencies.items()
+    }
+    sent_messages = _sent.get("customer_message", 0) + _sent.get("agent_message", 0)
+    received_frames = sum(_received.values())
+    return {
+        "config": {
+            "sites": args.sites, "customers": args.customers, "agents": args.agents,
+            "duration": args.duration, "message_rate": args.message_rate, "reply_rate": args.reply_rate
+        },
+        "elapsed_seconds": round(elapsed, 1),
+        "connected": {"customers": _sent.get("connected_customers", 0), "agents": _sent.get("connected_agents", 0)},
+        "connect_p99_ms": round(percentile(_connect_seconds, 0.99) * 1000, 2) if _connect_seconds else None,
+        "sent": dict(sorted(_sent.items())),
+        "received": dict(sorted(_received.items())),
+        "throughput": {
+            "messages_sent_per_second": round(sent_messages / elapsed, 1),
+            "frames_received_per_second": round(received_frames / elapsed, 1)
+        },
+        "latency": latency,
+        "rate_limited": _received.get("customer:rate_limited", 0) + _received.get("agent:rate_limited", 0),
+        "errors": _errors,
+        "peak_rss_mb": {name: round(value, 1) for name, value in peaks.items()}
+    }
+
+
+def print_report(report: dict):
+    print(f"\nConnected {report['connected']['customers']} customers, {report['connected']['agents']} agents "
+          f"(connect p99 {report['connect_p99_ms']} ms) over {report['elapsed_seconds']}s")
+    print(f"Throughput: {report['throughput']['messages_sent_per_second']} msg/s sent, "
+          f"{report['throughput']['frames_received_per_second']} frames/s received")
+    for kind, stats in report["latency"].items():
+        print(f"{kind:>18}: n={stats['count']} p50={stats['p50_ms']}ms p90={stats['p90_ms']}ms "
+              f"p99={stats['p99_ms']}ms max={stats['max_ms']}ms")
+    print(f"Rate limited: {report['rate_limited']}  Errors: {report['errors'] or 'none'}")
+    print(f"Peak RSS: {report['peak_rss_mb']}")
+
+
+# ------------------ SPAWN ------------------
+
+def wait_for_port(port: int, timeout: float = 30):
+    import socket
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def spawn_stack(args) -> list:
+    """Start the mock API and the app as subprocesses; returns [mock, app]"""
+    mock = subprocess.Popen([sys.executable, str(BASE_DIR / "benchmarks" / "mock_api.py"), "--port", str(args.mock_port)])
+    wait_for_port(args.mock_port)
+    env = dict(
+        os.environ,
+        API_BASE_URL=f"http://127.0.0.1:{args.mock_port}/api",
+        LOG_LEVEL=os.getenv("LOG_LEVEL", "WARNING"),
+        # Every swarm socket comes from 127.0.0.1, so per-IP limits would throttle the whole run
+        RATE_LIMIT_ENABLED=os.getenv("RATE_LIMIT_ENABLED", "false")
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.app_port), "--log-level", "warning"],
+        cwd=str(BASE_DIR), env=env
+    )
+    wait_for_port(args.app_port)
+    args.url = f"ws://127.0.0.1:{args.app_port}/ws"
+    args.server_pid = server.pid
+    return [mock, server]
+
+
+# ------------------ MAIN ------------------
+
+async def run(args):
+    global _connect_slots
+    _connect_slots = asyncio.Semaphore(args.connect_concurrency)
+    sites = [f"{args.site_prefix}{i}" for i in range(args.sites)]
+    peaks = {}
+    sampler = asyncio.ensure_future(sample_rss(args.server_pid, peaks))
+    started = time.monotonic()
+    stop_at = started + args.ramp + args.duration
+
+    async def staggered(factory, delay: float):
+        await asyncio.sleep(delay)
+        await factory()
+
+    jobs = []
+    # Agents first so customer messages have someone to fan out to
+    for i in range(args.agents):
+        site_id = sites[i % len(sites)]
+        jobs.append(staggered(lambda site_id=site_id, i=i: run_agent(args, site_id, i, stop_at), 0))
+    for i in range(args.customers):
+        site_id = sites[i % len(sites)]
+        delay = args.ramp * i / max(1, args.customers)
+        jobs.append(staggered(lambda site_id=site_id, i=i: run_customer(args, site_id, i, stop_at), delay))
+
+    await asyncio.gather(*jobs)
+    sampler.cancel()
+    return build_report(args, time.monotonic() - started, peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--site-prefix", default="bench-site-")
+    parser.add_argument("--customers", type=int, default=200, help="customer sockets, spread across sites")
+    parser.add_argument("--agents", type=int, default=10, help="agent sockets, spread across sites")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic after the ramp")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which customers connect")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--message-rate", type=float, default=0.1, help="messages per second per customer")
+    parser.add_argument("--reply-rate", type=float, default=0.2, help="chance an agent answers a message it sees")
+    parser.add_argument("--reply-delay", type=float, default=2.0, help="max seconds before an agent answers")
+    parser.add_argument("--status-rate", type=float, default=1.0, help="status changes per agent per minute")
+    parser.add_argument("--no-typing", dest="typing", action="store_false")
+    parser.add_argument("--api-key", default="bench-key")
+    parser.add_argument("--server-pid", type=int, help="app process to sample RSS from")
+    parser.add_argument("--spawn", action="store_true", help="start mock_api.py and the app locally")
+    parser.add_argument("--mock-port", type=int, default=5005)
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    # Thousands of sockets need more than the default 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    processes = spawn_stack(args) if args.spawn else []
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,40 @@
 # v1.0.1
 import secrets
 import asyncio
+import hashlib
 import json
 import os
+import time
+import sqlite3
+import threading
 import uuid
+import re
+import sys
+import copy
+import queue
+import random
+import logging
+import logging.handlers
+import contextvars
+import traceback
+import functools
+import contextlib
+import atexit
+import ipaddress
+from bisect import bisect_left
+from collections import OrderedDict, deque
 from pathlib import Path
 
 import httpx
 import jwt
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Header
-from fastapi.responses import FileResponse, HTMLResponse, Response
+try:
+    import msgpack  # optional: enables ?protocol=msgpack on /ws
+except ImportError:
+    msgpack = None
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Header
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.datastructures import State
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -99,6 +123,906 @@ VISITOR_DATA = {}
 # siteId -> state
 connections = {}
 
+# ------------------ LOGGING ------------------
+
+# Records go through a bounded queue to a listener thread that does the formatting and the
+# stdout write, so a slow stdout never blocks the event loop; when the queue is full the record
+# is dropped and counted instead. Each category (logger name) can be sampled, and records carry
+# the site/visitor/conversation ids bound for the current socket or task.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Logger name -> fraction of records kept below ERROR; the longest matching prefix applies
+LOG_SAMPLING = {"widget.ws.send": 0.1}
+LOG_SAMPLING.update(json.loads(os.getenv("LOG_SAMPLING", "{}")))  # per-category overrides
+
+log = logging.getLogger("widget")
+api_log = logging.getLogger("widget.api")
+ai_log = logging.getLogger("widget.ai")
+ws_log = logging.getLogger("widget.ws")
+send_log = logging.getLogger("widget.ws.send")  # per-recipient send failures during fan-out
+heartbeat_log = logging.getLogger("widget.ws.heartbeat")
+workflow_log = logging.getLogger("widget.workflows")
+site_log = logging.getLogger("widget.sites")
+store_log = logging.getLogger("widget.store")
+loop_log = logging.getLogger("widget.loop")
+
+# Correlation ids, bound per socket (and inherited by tasks it spawns)
+log_site_id = contextvars.ContextVar("log_site_id", default=None)
+log_visitor_id = contextvars.ContextVar("log_visitor_id", default=None)
+log_conversation_id = contextvars.ContextVar("log_conversation_id", default=None)
+LOG_CONTEXT_FIELDS = (("site_id", log_site_id), ("visitor_id", log_visitor_id), ("conversation_id", log_conversation_id))
+
+# Records dropped before reaching stdout: "sampled" | "queue_full"
+_log_drops = {}
+_log_listener = None
+
+
+def bind_log_context(site_id: str = None, visitor_id: str = None, conversation_id: str = None):
+    """Attach correlation ids to every record logged from the current context"""
+    if site_id is not None:
+        log_site_id.set(site_id)
+    if visitor_id is not None:
+        log_visitor_id.set(visitor_id)
+    if conversation_id is not None:
+        log_conversation_id.set(conversation_id)
+
+
+def _sample_rate(logger_name: str) -> float:
+    name = logger_name
+    while True:
+        if name in LOG_SAMPLING:
+            return LOG_SAMPLING[name]
+        if "." not in name:
+            return 1.0
+        name = name.rsplit(".", 1)[0]
+
+
+class LogContextFilter(logging.Filter):
+    """Applies per-category sampling and stamps correlation ids (runs on the logging thread's caller)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.ERROR:
+            rate = _sample_rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                _log_drops["sampled"] = _log_drops.get("sampled", 0) + 1
+                return False
+        for field, var in LOG_CONTEXT_FIELDS:
+            setattr(record, field, var.get())
+        span = current_span.get()
+        record.trace_id = span["trace_id"] if span else None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback here, while args and the exception are still live
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _log_drops["queue_full"] = _log_drops.get("queue_full", 0) + 1
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for field, _ in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Route the widget.* loggers through the queue to stdout"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        formatter = JsonLogFormatter()
+        formatter.converter = time.gmtime
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(site_id)s %(visitor_id)s %(conversation_id)s] %(message)s")
+    stream.setFormatter(formatter)
+
+    handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(LogContextFilter())
+    log.addHandler(handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+    _log_listener = logging.handlers.QueueListener(handler.queue, stream)
+    _log_listener.start()
+
+
+def flush_logs():
+    """Stop the listener thread once it has written everything still queued"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+configure_logging()
+# atexit rather than a shutdown hook so records logged by later shutdown hooks still get written
+atexit.register(flush_logs)
+
+
+# ------------------ METRICS ------------------
+
+# Prometheus text exposition at GET /metrics. Counters, gauges and histograms are plain dicts
+# keyed by label values, so recording is a dict lookup plus an add (histograms: one bisect).
+# Gauges that mirror existing state (sockets, sites, pending AI tasks) are filled in by
+# collectors at scrape time instead of being kept in sync on every change.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PREFIX = "widget_"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500)
+SIZE_BUCKETS = (1024, 16 * 1024, 128 * 1024, 512 * 1024, 1024 * 1024, 4 * 1024 * 1024, MAX_FILE_SIZE)
+DURATION_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600)
+
+# name -> {"kind", "help", "labels", "buckets", "series": {label_values: value | [bucket counts..., sum]}}
+_metrics = {}
+# Functions run before each scrape to refresh state-derived series
+_metric_collectors = []
+
+
+def define_metric(name: str, kind: str, help_text: str, labels: tuple = (), buckets: tuple = None):
+    _metrics[name] = {
+        "kind": kind,
+        "help": help_text,
+        "labels": labels,
+        "buckets": buckets,
+        "series": {}
+    }
+
+
+def inc_metric(name: str, *labels, amount: float = 1):
+    """Add to a counter or gauge"""
+    if not METRICS_ENABLED:
+        return
+    series = _metrics[name]["series"]
+    series[labels] = series.get(labels, 0) + amount
+
+
+def set_metric(name: str, value: float, *labels):
+    """Set a gauge, or a counter mirrored from an existing tally"""
+    if not METRICS_ENABLED:
+        return
+    _metrics[name]["series"][labels] = value
+
+
+def observe(name: str, value: float, *labels):
+    if not METRICS_ENABLED:
+        return
+    metric = _metrics[name]
+    series = metric["series"].get(labels)
+    if series is None:
+        series = metric["series"][labels] = [0] * (len(metric["buckets"]) + 1) + [0.0]
+    series[bisect_left(metric["buckets"], value)] += 1
+    series[-1] += value
+
+
+def metrics_collector(collector):
+    """Register a function that refreshes state-derived series before each scrape"""
+    _metric_collectors.append(collector)
+    return collector
+
+
+def _label_text(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = []
+    for name, value in list(zip(names, values)) + list(extra):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_metrics() -> str:
+    """Prometheus text format (0.0.4) for every defined metric"""
+    for collector in _metric_collectors:
+        try:
+            collector()
+        except Exception as e:
+            log.error("Metrics collector %s failed: %s", collector.__name__, e)
+
+    lines = []
+    for name, metric in _metrics.items():
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# HELP {full_name} {metric['help']}")
+        lines.append(f"# TYPE {full_name} {metric['kind']}")
+        for labels, value in list(metric["series"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(f"{full_name}{_label_text(metric['labels'], labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ("+Inf",), value):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_label_text(metric['labels'], labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_label_text(metric['labels'], labels)} {value[-1]}")
+            lines.append(f"{full_name}_count{_label_text(metric['labels'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+define_metric("ws_connections", "gauge", "Open /ws sockets by role", ("role",))
+define_metric("ws_connections_opened_total", "counter", "/ws sockets accepted and registered by role", ("role",))
+define_metric("ws_connection_seconds", "histogram", "Lifetime of closed /ws sockets", ("role",), DURATION_BUCKETS)
+define_metric("ws_frames_total", "counter", "/ws frames dispatched by role and type", ("role", "type"))
+define_metric("ws_frame_errors_total", "counter", "/ws handler exceptions by role and type", ("role", "type"))
+define_metric("ws_frames_invalid_total", "counter", "/ws frames rejected by validation", ("role", "type"))
+define_metric("ws_handler_seconds", "histogram", "/ws handler run time", ("role", "type"), LATENCY_BUCKETS)
+define_metric("sse_connections", "gauge", "Open /ws/sse customer streams", ())
+define_metric("ws_rate_limited_total", "counter", "/ws frames dropped by rate limiting", ("role", "class", "scope"))
+define_metric("broadcast_seconds", "histogram", "Time to fan a frame out to its recipients", ("kind",), LATENCY_BUCKETS)
+define_metric("broadcast_recipients", "histogram", "Sockets a broadcast frame was sent to", ("kind",), FANOUT_BUCKETS)
+define_metric("broadcast_send_failures_total", "counter", "Sends that failed during a broadcast", ("kind",))
+define_metric("upstream_requests_total", "counter", "API_BASE_URL requests by method, endpoint and status", ("method", "endpoint", "status"))
+define_metric("upstream_request_seconds", "histogram", "API_BASE_URL time to response headers", ("method", "endpoint"), LATENCY_BUCKETS)
+define_metric("upstream_circuit_state", "gauge", "Circuit breaker state per endpoint: 0 closed, 1 half-open, 2 open", ("method", "endpoint"))
+define_metric("upstream_circuit_opened_total", "counter", "Times an endpoint's circuit opened", ("method", "endpoint"))
+define_metric("upstream_circuit_rejected_total", "counter", "Calls failed fast while the circuit was open", ("method", "endpoint"))
+define_metric("upstream_adaptive_timeout_seconds", "gauge", "Current adaptive read timeout per endpoint", ("method", "endpoint"))
+define_metric("message_outbox_size", "gauge", "Messages waiting to be saved while the API is unavailable", ())
+define_metric("message_save_failures_total", "counter", "Messages given up on: rejected by the API, errors, or outbox overflow", ("reason",))
+define_metric("upstream_get_coalesced_total", "counter", "GETs served from another caller's in-flight request or the micro-cache", ("result",))
+define_metric("public_cache_responses_total", "counter", "Anonymous proxy responses by cache outcome", ("key", "result"))
+define_metric("uploads_total", "counter", "POST /upload requests by result", ("result",))
+define_metric("upload_bytes", "histogram", "Size of accepted uploads", (), SIZE_BUCKETS)
+define_metric("upload_seconds", "histogram", "POST /upload handling time including the API copy", (), LATENCY_BUCKETS)
+define_metric("ai_pipeline_seconds", "histogram", "AI analysis/auto-reply pipeline run time", ("result",), LATENCY_BUCKETS)
+define_metric("ai_tasks_pending", "gauge", "AI pipeline tasks queued or running", ())
+define_metric("sites_resident", "gauge", "Sites with in-memory state", ())
+define_metric("log_records_dropped_total", "counter", "Log records sampled out or dropped on a full queue", ("reason",))
+define_metric("loop_lag_seconds", "histogram", "How late the event loop ran the lag probe", (), LATENCY_BUCKETS)
+define_metric("loop_lag_last_seconds", "gauge", "Lag of the most recent probe", ())
+define_metric("loop_stalls_total", "counter", "Times the loop was blocked past LOOP_STALL_SECONDS", ())
+define_metric("loop_stall_seconds", "histogram", "Probe lag of each detected stall (a lower bound on the block)", (), LATENCY_BUCKETS)
+define_metric("loop_tasks", "gauge", "asyncio tasks alive on the loop", ())
+
+
+@metrics_collector
+def collect_log_metrics():
+    for reason, drops in list(_log_drops.items()):
+        set_metric("log_records_dropped_total", drops, reason)
+
+
+@app.get("/metrics")
+async def get_metrics(authorization: str = Header(None)):
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ------------------ UPSTREAM API CLIENT ------------------
+
+# Every API_BASE_URL call goes through api_client() so it is timed and counted per endpoint.
+# Path segments that look like ids (digits, GUIDs, long tokens) collapse to {id} so the
+# endpoint label stays low-cardinality.
+_ID_SEGMENT = re.compile(r"^(?=.*\d)[\w.-]+$|^[\w-]{24,}$")
+_UPSTREAM_BASE_PATH = httpx.URL(API_BASE_URL).path.rstrip("/")
+
+
+def upstream_endpoint(url: httpx.URL) -> str:
+    path = url.path
+    if path.startswith(_UPSTREAM_BASE_PATH):
+        path = path[len(_UPSTREAM_BASE_PATH):]
+    return "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/")) or "/"
+
+
+# Each (method, endpoint) has its own circuit breaker. CIRCUIT_FAILURE_THRESHOLD consecutive
+# failures (transport errors, timeouts, 5xx) open it; while open, calls fail fast with
+# CircuitOpenError instead of tying up sockets and handlers for the full timeout. After
+# CIRCUIT_OPEN_SECONDS one half-open probe is let through: success closes the circuit, failure
+# reopens it for twice as long (up to CIRCUIT_MAX_OPEN_SECONDS). Callers already treat a raised
+# httpx error as "API unavailable", so they fall back the same way they do on a timeout.
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "10"))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", "120"))
+# Read timeouts adapt to each endpoint's observed latency (srtt + 4 * rttvar, as TCP
+# retransmission timers do), never below the floor and never above the caller's own timeout.
+# Like TCP, the learned timeout doubles each time it fires and resets on the next good sample,
+# so an endpoint that slows down gets back to the caller's timeout instead of being cut off for
+# good. Half-open probes always get the caller's timeout.
+ADAPTIVE_TIMEOUT_ENABLED = os.getenv("ADAPTIVE_TIMEOUT_ENABLED", "true").lower() == "true"
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.getenv("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "20"))
+ADAPTIVE_TIMEOUT_FLOOR = float(os.getenv("ADAPTIVE_TIMEOUT_FLOOR", "2.0"))
+ADAPTIVE_TIMEOUT_MAX_BACKOFF = 64
+# Endpoint prefixes that always keep the caller's timeout - model calls vary too much to learn
+ADAPTIVE_TIMEOUT_EXCLUDE = tuple(
+    p.strip() for p in os.getenv("ADAPTIVE_TIMEOUT_EXCLUDE", "/ai/").split(",") if p.strip()
+)
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+# (method, endpoint) -> breaker state
+_upstream_breakers = {}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of calling an endpoint whose circuit is open"""
+
+
+def upstream_breaker(method: str, endpoint: str) -> dict:
+    breaker = _upstream_breakers.get((method, endpoint))
+    if breaker is None:
+        breaker = _upstream_breakers[(method, endpoint)] = {
+            "state": "closed",
+            "failures": 0,  # consecutive
+            "open_seconds": CIRCUIT_OPEN_SECONDS,
+            "open_until": 0.0,
+            "probing": False,  # half-open probe in flight
+            "srtt": None,
+            "rttvar": 0.0,
+            "samples": 0,
+            "backoff": 1,  # RTO multiplier, doubled by each adaptive timeout
+            "adaptive": not endpoint.startswith(ADAPTIVE_TIMEOUT_EXCLUDE),
+            "opened_total": 0,
+            "rejected_total": 0
+        }
+    return breaker
+
+
+def upstream_available(method: str, path: str) -> bool:
+    """False while the circuit for method + path (relative to API_BASE_URL) is rejecting calls"""
+    if not CIRCUIT_BREAKER_ENABLED:
+        return True
+    breaker = _upstream_breakers.get((method, upstream_endpoint(httpx.URL(API_BASE_URL + path))))
+    if breaker is None or breaker["state"] == "closed":
+        return True
+    return not breaker["probing"] and time.monotonic() >= breaker["open_until"]
+
+
+def _admit_upstream_call(breaker: dict) -> bool:
+    if not CIRCUIT_BREAKER_ENABLED or breaker["state"] == "closed":
+        return True
+    if breaker["state"] == "open" and time.monotonic() >= breaker["open_until"]:
+        breaker["state"] = "half_open"
+    if breaker["state"] == "half_open" and not breaker["probing"]:
+        breaker["probing"] = True
+        return True
+    return False
+
+
+def _record_upstream_result(breaker: dict, endpoint: str, ok: bool, elapsed: float = None):
+    if elapsed is not None:
+        if breaker["srtt"] is None:
+            breaker["srtt"], breaker["rttvar"] = elapsed, elapsed / 2
+        else:
+            breaker["rttvar"] = 0.75 * breaker["rttvar"] + 0.25 * abs(breaker["srtt"] - elapsed)
+            breaker["srtt"] = 0.875 * breaker["srtt"] + 0.125 * elapsed
+        breaker["samples"] += 1
+        breaker["backoff"] = 1
+
+    probe = breaker["probing"]
+    breaker["probing"] = False
+    if ok:
+        if breaker["state"] != "closed":
+            api_log.info("Circuit closed for %s", endpoint)
+        breaker["state"] = "closed"
+        breaker["failures"] = 0
+        breaker["open_seconds"] = CIRCUIT_OPEN_SECONDS
+        return
+
+    breaker["failures"] += 1
+    if probe:
+        breaker["open_seconds"] = min(breaker["open_seconds"] * 2, CIRCUIT_MAX_OPEN_SECONDS)
+    elif breaker["state"] != "closed" or breaker["failures"] < CIRCUIT_FAILURE_THRESHOLD:
+        return
+    breaker["state"] = "open"
+    breaker["open_until"] = time.monotonic() + breaker["open_seconds"]
+    breaker["opened_total"] += 1
+    api_log.warning("Circuit open for %s after %s failures; retrying in %ss", endpoint, breaker["failures"], breaker["open_seconds"])
+
+
+def adaptive_timeout(breaker: dict):
+    """Read timeout learned from the endpoint's latency, or None until there are enough samples"""
+    if not ADAPTIVE_TIMEOUT_ENABLED or not breaker["adaptive"] or breaker["samples"] < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+        return None
+    return max(ADAPTIVE_TIMEOUT_FLOOR, breaker["srtt"] + 4 * breaker["rttvar"]) * breaker["backoff"]
+
+
+class UpstreamTransport(httpx.AsyncHTTPTransport):
+    """AsyncHTTPTransport that traces, times and circuit-breaks each API call"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = upstream_endpoint(request.url)
+        label = f"{request.method} {endpoint}"
+        breaker = upstream_breaker(request.method, endpoint)
+        status = "error"
+        started = time.perf_counter()
+        attributes = {"http.method": request.method, "http.route": endpoint, "server.address": request.url.host}
+        with trace_span(label, "client", attributes) as span:
+            if not _admit_upstream_call(breaker):
+                breaker["rejected_total"] += 1
+                inc_metric("upstream_requests_total", request.method, endpoint, "circuit_open")
+                raise CircuitOpenError(f"Circuit open for {label}", request=request)
+
+            # A half-open probe decides whether the endpoint is back, so it gets the caller's full timeout
+            timeout = None if breaker["state"] == "half_open" else adaptive_timeout(breaker)
+            shortened = False
+            if timeout is not None:
+                timeouts = dict(request.extensions.get("timeout") or {})
+                if timeouts.get("read") is None or timeouts["read"] > timeout:
+                    timeouts["read"] = timeout
+                    request.extensions["timeout"] = timeouts
+                    shortened = True
+            if span is not None:
+                request.headers["traceparent"] = traceparent(span)
+            result = None
+            try:
+                response = await super().handle_async_request(request)
+                status = str(response.status_code)
+                result = response.status_code < 500
+                if span is not None:
+                    span["attributes"]["http.status_code"] = response.status_code
+                return response
+            except httpx.ReadTimeout:
+                result = False
+                if shortened:
+                    # Our learned timeout fired, not the caller's: back it off
+                    breaker["backoff"] = min(breaker["backoff"] * 2, ADAPTIVE_TIMEOUT_MAX_BACKOFF)
+                raise
+            except (httpx.TransportError, OSError):
+                result = False
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                if result is None:
+                    # Cancelled by the caller: no verdict on the endpoint, just free the probe slot
+                    breaker["probing"] = False
+                else:
+                    _record_upstream_result(breaker, label, result, elapsed if result else None)
+                observe("upstream_request_seconds", elapsed, request.method, endpoint)
+                inc_metric("upstream_requests_total", request.method, endpoint, status)
+
+
+@metrics_collector
+def collect_upstream_metrics():
+    for (method, endpoint), breaker in list(_upstream_breakers.items()):
+        set_metric("upstream_circuit_state", CIRCUIT_STATES[breaker["state"]], method, endpoint)
+        set_metric("upstream_circuit_opened_total", breaker["opened_total"], method, endpoint)
+        set_metric("upstream_circuit_rejected_total", breaker["rejected_total"], method, endpoint)
+        timeout = adaptive_timeout(breaker)
+        if timeout is not None:
+            set_metric("upstream_adaptive_timeout_seconds", timeout, method, endpoint)
+
+
+def api_client(verify: bool = True, **kwargs) -> httpx.AsyncClient:
+    """httpx.AsyncClient for API_BASE_URL calls, instrumented for /metrics"""
+    return httpx.AsyncClient(transport=UpstreamTransport(verify=verify), **kwargs)
+
+
+# Dashboard loads (a whole team after a shift change) fire the same GETs at once. shared_get()
+# gives concurrent identical calls one upstream request, and optionally serves the 200 response
+# for UPSTREAM_GET_TTL seconds after it. Calls are keyed by URL plus an auth scope - the caller's
+# validated user id - so the upstream access check still applies to every user.
+UPSTREAM_GET_TTL = float(os.getenv("UPSTREAM_GET_TTL", "1.0"))
+UPSTREAM_GET_CACHE_SIZE = int(os.getenv("UPSTREAM_GET_CACHE_SIZE", "1000"))
+
+# (url, scope) -> {"response": httpx.Response, "expires_at": float}
+_shared_get_cache = {}
+
+
+def _store_shared_get(key, response: httpx.Response, ttl: float):
+    now = time.monotonic()
+    if len(_shared_get_cache) >= UPSTREAM_GET_CACHE_SIZE:
+        for stale_key in [k for k, entry in _shared_get_cache.items() if entry["expires_at"] <= now]:
+            del _shared_get_cache[stale_key]
+        while len(_shared_get_cache) >= UPSTREAM_GET_CACHE_SIZE:
+            del _shared_get_cache[next(iter(_shared_get_cache))]
+    _shared_get_cache[key] = {"response": response, "expires_at": now + ttl}
+
+
+def forget_shared_get(url: str):
+    """Drop cached responses for url in every scope, after a write through the proxy"""
+    for key in [k for k in _shared_get_cache if k[0] == url]:
+        del _shared_get_cache[key]
+
+
+async def shared_get(url: str, scope: str = None, headers: dict = None, ttl: float = None, **kwargs) -> httpx.Response:
+    """GET url through api_client(), coalesced with identical in-flight calls in the same scope.
+
+    scope identifies whose credentials are in headers (None only for public endpoints).
+    ttl overrides UPSTREAM_GET_TTL; 0 coalesces without caching. Raises like client.get().
+    """
+    ttl = UPSTREAM_GET_TTL if ttl is None else ttl
+    key = (url, scope)
+    entry = _shared_get_cache.get(key)
+    if entry is not None:
+        if entry["expires_at"] > time.monotonic():
+            inc_metric("upstream_get_coalesced_total", "cached")
+            return entry["response"]
+        del _shared_get_cache[key]
+
+    async def fetch():
+        async with api_client(verify=False) as client:
+            response = await client.get(url, headers=headers, **kwargs)
+        if ttl > 0 and response.status_code == 200:
+            _store_shared_get(key, response, ttl)
+        return response
+
+    if ("GET", key) in _inflight:
+        inc_metric("upstream_get_coalesced_total", "joined")
+    return await singleflight(("GET", key), fetch)
+
+
+# ------------------ LOOP HEALTH ------------------
+
+# Everything realtime shares one event loop, so a blocking call stalls every socket.
+# A probe task measures how late the loop wakes it (lag); a watchdog thread notices when the
+# probe is overdue by LOOP_STALL_SECONDS and samples the loop thread's stack while it is still
+# blocked, which points at the offending callback. Both run continuously at negligible cost.
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+LOOP_PROBE_INTERVAL = float(os.getenv("LOOP_PROBE_INTERVAL", "0.5"))
+LOOP_STALL_SECONDS = float(os.getenv("LOOP_STALL_SECONDS", "0.25"))
+LOOP_STALL_HISTORY = int(os.getenv("LOOP_STALL_HISTORY", "50"))
+LOOP_STACK_DEPTH = 30
+
+_loop_state = {
+    "thread_id": None,  # ident of the thread running the loop
+    "expected_at": None,  # monotonic time the probe should wake up next
+    "last_lag": 0.0,
+    "max_lag": 0.0,
+    "stall": None  # sample for the stall in progress
+}
+# Recent stalls, oldest first: {"detected_at", "lag_seconds", "site", "stack"}
+_loop_stalls = deque(maxlen=LOOP_STALL_HISTORY)
+# "file:line in function" of the innermost app frame -> stall count
+_loop_stall_sites = {}
+_loop_probe_task = None
+_loop_watchdog_stop = threading.Event()
+
+
+async def _loop_probe():
+    while True:
+        _loop_state["expected_at"] = time.monotonic() + LOOP_PROBE_INTERVAL
+        await asyncio.sleep(LOOP_PROBE_INTERVAL)
+        woke = time.monotonic()
+        lag = max(0.0, woke - _loop_state["expected_at"])
+        _loop_state["expected_at"] = None
+        _loop_state["last_lag"] = lag
+        _loop_state["max_lag"] = max(_loop_state["max_lag"], lag)
+        observe("loop_lag_seconds", lag)
+        stall = _loop_state["stall"]
+        if stall is not None:
+            # The loop is running again: settle how long it was blocked
+            _loop_state["stall"] = None
+            stall["lag_seconds"] = round(lag, 4)
+            observe("loop_stall_seconds", lag)
+            loop_log.warning("Event loop lagged %.3fs, blocked at %s", lag, stall["site"])
+
+
+def _app_frame_site(stack: list) -> str:
+    """Innermost frame in this file, else the innermost frame overall"""
+    for frame in reversed(stack):
+        if frame.filename == __file__:
+            return f"main.py:{frame.lineno} in {frame.name}"
+    frame = stack[-1]
+    return f"{frame.filename}:{frame.lineno} in {frame.name}"
+
+
+def _loop_watchdog():
+    """Thread: sample the loop thread's stack when the probe is overdue"""
+    while not _loop_watchdog_stop.wait(LOOP_STALL_SECONDS / 2):
+        expected_at = _loop_state["expected_at"]
+        if expected_at is None or _loop_state["stall"] is not None:
+            continue
+        overdue = time.monotonic() - expected_at
+        if overdue < LOOP_STALL_SECONDS:
+            continue
+        frame = sys._current_frames().get(_loop_state["thread_id"])
+        if frame is None:
+            continue
+        stack = traceback.extract_stack(frame, limit=LOOP_STACK_DEPTH)
+        if _loop_state["expected_at"] != expected_at:
+            continue  # the loop resumed while we were sampling
+        site = _app_frame_site(stack)
+        stall = {
+            "detected_at": time.time(),
+            "lag_seconds": None,  # probe lag, filled in once the loop resumes
+            "site": site,
+            "stack": [f"{f.filename}:{f.lineno} in {f.name}: {f.line}" for f in stack]
+        }
+        _loop_state["stall"] = stall
+        _loop_stalls.append(stall)
+        _loop_stall_sites[site] = _loop_stall_sites.get(site, 0) + 1
+        inc_metric("loop_stalls_total")
+
+
+@metrics_collector
+def collect_loop_metrics():
+    set_metric("loop_lag_last_seconds", _loop_state["last_lag"])
+    set_metric("loop_tasks", len(asyncio.all_tasks()))
+
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    global _loop_probe_task
+    if not LOOP_MONITOR_ENABLED:
+        return
+    _loop_state["thread_id"] = threading.get_ident()
+    _loop_probe_task = asyncio.ensure_future(_loop_probe())
+    _loop_watchdog_stop.clear()
+    threading.Thread(target=_loop_watchdog, name="loop-watchdog", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    _loop_watchdog_stop.set()
+    if _loop_probe_task:
+        _loop_probe_task.cancel()
+
+
+@app.get("/debug/loop")
+async def get_loop_health(authorization: str = Header(None)):
+    """Loop lag, stall hot spots and recent stall stacks (super admin)"""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization required")
+    token_data = validate_jwt_token(authorization.replace("Bearer ", ""))
+    if not token_data:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if token_data.get("role") != "super_admin":
+        raise HTTPException(status_code=403, detail="Super admin access required")
+
+    return {
+        "enabled": LOOP_MONITOR_ENABLED,
+        "probe_interval": LOOP_PROBE_INTERVAL,
+        "stall_threshold": LOOP_STALL_SECONDS,
+        "lag_seconds": _loop_state["last_lag"],
+        "max_lag_seconds": _loop_state["max_lag"],
+        "tasks": len(asyncio.all_tasks()),
+        "stall_sites": sorted(
+            ({"site": site, "count": count} for site, count in _loop_stall_sites.items()),
+            key=lambda entry: entry["count"], reverse=True
+        ),
+        "recent_stalls": list(reversed(_loop_stalls))
+    }
+
+
+# ------------------ TRACING ------------------
+
+# W3C trace context + OTLP/JSON export, without the OpenTelemetry SDK. Each /ws frame opens a
+# server span, each API_BASE_URL call a client span that forwards `traceparent` to the .NET API,
+# and @traced functions (message save, workflows, AI usage/analysis) child spans in between.
+# TRACE_EXPORT selects the sink:
+#   file:/path/spans.jsonl        one OTLP ExportTraceServiceRequest per line
+#   http://collector:4318/v1/traces   OTLP/HTTP JSON (any OpenTelemetry collector)
+# Tracing is off unless TRACE_EXPORT is set.
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACING_ENABLED = bool(TRACE_EXPORT)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # fraction of root spans kept
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "python-widget-app")
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "5"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+# Span of the current frame/call; unsampled spans are kept too so children inherit the decision
+current_span = contextvars.ContextVar("current_span", default=None)
+# Finished sampled spans waiting for export
+_trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+_trace_flush_needed = None  # asyncio.Event, created on startup
+_trace_export_task = None
+
+
+def parse_traceparent(header: str) -> dict:
+    """Remote parent from a W3C traceparent header, or None"""
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return {"trace_id": parts[1], "span_id": parts[2], "sampled": parts[3] == "01"}
+
+
+def traceparent(span: dict) -> str:
+    return f"00-{span['trace_id']}-{span['span_id']}-{'01' if span['sampled'] else '00'}"
+
+
+def start_span(name: str, kind: str = "internal", attributes: dict = None, parent: dict = None) -> dict:
+    parent = parent or current_span.get()
+    if parent:
+        trace_id, sampled = parent["trace_id"], parent["sampled"]
+    else:
+        trace_id, sampled = f"{random.getrandbits(128):032x}", random.random() < TRACE_SAMPLE_RATE
+    return {
+        "trace_id": trace_id,
+        "span_id": f"{random.getrandbits(64):016x}",
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "kind": kind,
+        "start": time.time_ns(),
+        "end": None,
+        "attributes": attributes or {},
+        "error": None,
+        "sampled": sampled
+    }
+
+
+def end_span(span: dict, error: BaseException = None):
+    span["end"] = time.time_ns()
+    if error is not None:
+        span["error"] = f"{type(error).__name__}: {error}"
+    if span["sampled"]:
+        _trace_buffer.append(span)
+        if len(_trace_buffer) >= TRACE_BATCH_SIZE and _trace_flush_needed:
+            _trace_flush_needed.set()
+
+
+@contextlib.contextmanager
+def trace_span(name: str, kind: str = "internal", attributes: dict = None, parent: dict = None):
+    """Run the block inside a child span of the current one (no-op when tracing is off)"""
+    if not TRACING_ENABLED:
+        yield None
+        return
+    span = start_span(name, kind, attributes, parent)
+    token = current_span.set(span)
+    try:
+        yield span
+    except (asyncio.CancelledError, WebSocketDisconnect):
+        end_span(span)
+        raise
+    except Exception as e:
+        end_span(span, e)
+        raise
+    else:
+        end_span(span)
+    finally:
+        current_span.reset(token)
+
+
+def traced(name: str):
+    """Decorator: run an async function inside a span (returns it unchanged when tracing is off)"""
+    def decorate(fn):
+        if not TRACING_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_span(name: str, started: float, attributes: dict = None):
+    """Record an already finished child span; started is a time.perf_counter() reading"""
+    if not TRACING_ENABLED:
+        return
+    parent = current_span.get()
+    if parent is not None and not parent["sampled"]:
+        return
+    span = start_span(name, "internal", attributes, parent)
+    span["start"] -= int((time.perf_counter() - started) * 1e9)
+    end_span(span)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: dict) -> dict:
+    otlp = {
+        "traceId": span["trace_id"],
+        "spanId": span["span_id"],
+        "name": span["name"],
+        "kind": SPAN_KINDS[span["kind"]],
+        "startTimeUnixNano": str(span["start"]),
+        "endTimeUnixNano": str(span["end"]),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in span["attributes"].items() if value is not None
+        ],
+        "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 0}
+    }
+    if span["parent_id"]:
+        otlp["parentSpanId"] = span["parent_id"]
+    return otlp
+
+
+def otlp_payload(spans: list) -> dict:
+    """OTLP ExportTraceServiceRequest (JSON encoding) for a batch of spans"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "widget"}, "spans": [_otlp_span(span) for span in spans]}]
+        }]
+    }
+
+
+def _append_trace_file(path: str, line: str):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+async def export_spans():
+    """Send everything buffered to TRACE_EXPORT"""
+    while _trace_buffer:
+        batch = [_trace_buffer.popleft() for _ in range(min(TRACE_BATCH_SIZE, len(_trace_buffer)))]
+        payload = otlp_payload(batch)
+        try:
+            if TRACE_EXPORT.startswith("file:"):
+                await asyncio.to_thread(_append_trace_file, TRACE_EXPORT[5:], json.dumps(payload, separators=(",", ":")))
+            else:
+                # Plain client on purpose: exporter calls must not be traced or counted as upstream calls
+                async with httpx.AsyncClient() as client:
+                    response = await client.post(TRACE_EXPORT, json=payload, timeout=10.0)
+                    if response.status_code >= 300:
+                        log.warning("Trace export rejected: %s", response.status_code)
+        except Exception as e:
+            log.warning("Trace export failed, dropped %s spans: %s", len(batch), e)
+
+
+async def _trace_export_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_trace_flush_needed.wait(), TRACE_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _trace_flush_needed.clear()
+        await export_spans()
+
+
+@app.on_event("startup")
+async def start_trace_exporter():
+    global _trace_export_task, _trace_flush_needed
+    if not TRACING_ENABLED:
+        return
+    _trace_flush_needed = asyncio.Event()
+    _trace_export_task = asyncio.ensure_future(_trace_export_loop())
+
+
+@app.on_event("shutdown")
+async def stop_trace_exporter():
+    if _trace_export_task:
+        _trace_export_task.cancel()
+        await export_spans()
+
+
+async def trace_http_request(request, call_next):
+    """Server span per HTTP request, continuing the caller's traceparent"""
+    parent = parse_traceparent(request.headers.get("traceparent"))
+    with trace_span(f"{request.method} {request.url.path}", "server", {"http.method": request.method}, parent) as span:
+        response = await call_next(request)
+        span["attributes"]["http.status_code"] = response.status_code
+        return response
+
+
+if TRACING_ENABLED:
+    app.middleware("http")(trace_http_request)
+
+
 # ------------------ PAGES ------------------
 
 @app.get("/")
@@ -666,7 +1590,7 @@ def test_payment_page_html():
 @app.post("/api/auth/register")
 async def register_user(data: dict):
     """Proxy registration to .NET API and auto-login to get token"""
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             # Step 1: Register
             response = await client.post(
@@ -711,7 +1635,7 @@ async def create_site(data: dict, authorization: str = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites",
@@ -730,20 +1654,99 @@ async def create_site(data: dict, authorization: str = Header(None)):
             raise HTTPException(status_code=503, detail="Site service unavailable")
 
 
+# ------------------ PUBLIC RESPONSE CACHE ------------------
+
+# Anonymous proxy endpoints (the pricing plans every marketing page loads) are answered from
+# memory. A response is fresh for PUBLIC_CACHE_TTL. For PUBLIC_CACHE_STALE_TTL after that it
+# is served stale while one background refresh runs. When the API is failing, the last good
+# response is served for up to PUBLIC_CACHE_STALE_IF_ERROR. Every response carries an ETag
+# and a matching Cache-Control, so browsers revalidate with If-None-Match (304, no body) and a
+# CDN in front can absorb spikes on its own.
+PUBLIC_CACHE_TTL = float(os.getenv("PUBLIC_CACHE_TTL", "300"))
+PUBLIC_CACHE_STALE_TTL = float(os.getenv("PUBLIC_CACHE_STALE_TTL", "3600"))
+PUBLIC_CACHE_STALE_IF_ERROR = float(os.getenv("PUBLIC_CACHE_STALE_IF_ERROR", "86400"))
+
+# key -> {"body": bytes, "etag": str, "fetched_at": float}
+_public_cache = {}
+
+
+async def _load_public_response(key: str, loader):
+    value = await loader()
+    if value is None:
+        # Upstream failed - hand back the last good response, if any
+        return _public_cache.get(key)
+    body = json.dumps(value, separators=(",", ":")).encode()
+    entry = _public_cache.get(key)
+    if entry is None or entry["body"] != body:
+        entry = _public_cache[key] = {"body": body, "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"'}
+    entry["fetched_at"] = time.monotonic()
+    return entry
+
+
+async def public_response(key: str, loader, unavailable: dict, if_none_match: str = None) -> Response:
+    """Serve an anonymous GET through the public response cache.
+
+    loader() is an async callable returning the JSON body to cache, or None on failure
+    (failures are never cached). unavailable is returned with a 503 when the API fails and
+    nothing usable is cached.
+    """
+    entry = _public_cache.get(key)
+    age = time.monotonic() - entry["fetched_at"] if entry else None
+    result = "hit"
+    if entry is None or age >= PUBLIC_CACHE_TTL + PUBLIC_CACHE_STALE_TTL:
+        result = "miss"
+        entry = await singleflight(("public", key), lambda: _load_public_response(key, loader))
+        age = time.monotonic() - entry["fetched_at"] if entry else None
+        if entry is not None and PUBLIC_CACHE_TTL <= age < PUBLIC_CACHE_TTL + PUBLIC_CACHE_STALE_IF_ERROR:
+            result = "stale_if_error"
+            api_log.warning("Serving %s from cache (%ds old), API unavailable", key, age)
+    elif age >= PUBLIC_CACHE_TTL:
+        result = "stale"
+        run_in_background(singleflight(("public", key), lambda: _load_public_response(key, loader)))
+
+    if entry is None or age >= PUBLIC_CACHE_TTL + PUBLIC_CACHE_STALE_IF_ERROR:
+        inc_metric("public_cache_responses_total", key, "unavailable")
+        return Response(json.dumps(unavailable), status_code=503, media_type="application/json", headers={"Cache-Control": "no-store"})
+
+    headers = {
+        "ETag": entry["etag"],
+        "Cache-Control": (
+            f"public, max-age={int(max(0, PUBLIC_CACHE_TTL - age))}, "
+            f"stale-while-revalidate={int(PUBLIC_CACHE_STALE_TTL)}, stale-if-error={int(PUBLIC_CACHE_STALE_IF_ERROR)}"
+        )
+    }
+    inc_metric("public_cache_responses_total", key, result)
+    if if_none_match and entry["etag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(entry["body"], media_type="application/json", headers=headers)
+
+
 # ------------------ SUBSCRIPTION PLANS ------------------
 
-@app.get("/api/subscriptions/plans")
-async def get_subscription_plans():
-    """Proxy subscription plans from .NET API (no auth required)"""
-    async with httpx.AsyncClient(verify=False) as client:
+async def _fetch_subscription_plans():
+    """Plans payload from the .NET API, None on failure"""
+    async with api_client(verify=False) as client:
         try:
-            response = await client.get(f"{API_BASE_URL}/subscriptions/plans")
+            response = await client.get(f"{API_BASE_URL}/subscriptions/plans", timeout=10.0)
             if response.status_code == 200:
-                return response.json()
-            else:
-                return {"success": False, "data": [], "message": "Failed to fetch plans"}
-        except httpx.RequestError:
-            raise HTTPException(status_code=503, detail="Plans service unavailable")
+                result = response.json()
+                if result.get("success"):
+                    return result
+            api_log.warning("Fetching subscription plans failed with %s", response.status_code)
+        except Exception as e:
+            api_log.error("Error fetching subscription plans: %s", e)
+    return None
+
+
+@app.get("/api/subscriptions/plans")
+async def get_subscription_plans(if_none_match: str = Header(None)):
+    """Proxy subscription plans from .NET API (no auth required, publicly cached)"""
+    return await public_response(
+        "/subscriptions/plans",
+        _fetch_subscription_plans,
+        {"success": False, "data": [], "message": "Plans service unavailable"},
+        if_none_match
+    )
 
 
 # ------------------ PAYMENT PROXIES ------------------
@@ -754,7 +1757,7 @@ async def create_razorpay_order(site_id: str, data: dict, authorization: str = H
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/payments/razorpay/create-order",
@@ -772,7 +1775,7 @@ async def verify_razorpay_payment(site_id: str, data: dict, authorization: str =
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/payments/razorpay/verify",
@@ -790,7 +1793,7 @@ async def create_paypal_order(site_id: str, data: dict, authorization: str = Hea
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/payments/paypal/create-order",
@@ -808,7 +1811,7 @@ async def capture_paypal_payment(site_id: str, data: dict, authorization: str =
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/payments/paypal/capture",
@@ -828,7 +1831,7 @@ async def support_login(data: dict):
     password = data.get("password")
     site_id = data.get("siteId")  # Optional now - auto-fetched from user's sites
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
 
             # Call .NET API for authentication (siteId is optional)
@@ -887,9 +1890,12 @@ async def support_login(data: dict):
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), siteId: str = Form(...), visitorId: str = Form(None), token: str = Form(None)):
+    bind_log_context(site_id=siteId, visitor_id=visitorId)
+    started = time.perf_counter()
     # Validate file extension
     ext = Path(file.filename).suffix.lower()
     if ext not in ALLOWED_EXTENSIONS:
+        inc_metric("uploads_total", "rejected_type")
         raise HTTPException(status_code=400, detail=f"File type not allowed. Allowed: {', '.join(ALLOWED_EXTENSIONS)}")
 
     # Read file content
@@ -897,15 +1903,15 @@ async def upload_file(file: UploadFile = File(...), siteId: str = Form(...), vis
 
     # Check file size
     if len(content) > MAX_FILE_SIZE:
+        inc_metric("uploads_total", "too_large")
         raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
 
     # Generate unique filename
     unique_name = f"{uuid.uuid4().hex}{ext}"
     file_path = UPLOADS_DIR / unique_name
 
-    # Save file locally
-    with open(file_path, "wb") as f:
-        f.write(content)
+    # Save file locally (off the event loop: a 10MB write would stall every socket)
+    await asyncio.to_thread(file_path.write_bytes, content)
 
     # Determine if it's an image
     is_image = ext in {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
@@ -914,7 +1920,7 @@ async def upload_file(file: UploadFile = File(...), siteId: str = Form(...), vis
 
     # Try to upload to .NET API as well
     try:
-        async with httpx.AsyncClient(verify=False) as client:
+        async with api_client(verify=False) as client:
             # Reset file position for re-reading
             files = {"file": (file.filename, content, file.content_type)}
             params = {"siteId": siteId}
@@ -942,8 +1948,11 @@ async def upload_file(file: UploadFile = File(...), siteId: str = Form(...), vis
                     api_data = result.get("data", {})
                     file_id = api_data.get("id", file_id)
     except Exception as e:
-        print(f"Error uploading to API: {e}")
+        api_log.error("Error uploading to API: %s", e)
 
+    inc_metric("uploads_total", "stored")
+    observe("upload_bytes", len(content))
+    observe("upload_seconds", time.perf_counter() - started)
     return {
         "id": file_id,
         "filename": unique_name,
@@ -981,7 +1990,7 @@ async def get_all_conversations(authorization: str = Header(None)):
     if token_data.get("role") != "super_admin":
         raise HTTPException(status_code=403, detail="Super admin access required")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             # First get all sites
             sites_response = await client.get(
@@ -1019,7 +2028,7 @@ async def get_all_conversations(authorization: str = Header(None)):
 
                         all_conversations.extend(conversations)
                 except Exception as e:
-                    print(f"Error fetching conversations for site {site_id}: {e}")
+                    api_log.error("Error fetching conversations for site %s: %s", site_id, e)
                     continue
 
             return {"success": True, "data": all_conversations}
@@ -1027,7 +2036,7 @@ async def get_all_conversations(authorization: str = Header(None)):
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error fetching conversations: {e}")
+            api_log.error("Error fetching conversations: %s", e)
             raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1044,25 +2053,25 @@ async def get_conversation_messages(conversation_id: str, authorization: str = H
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             # Get messages from the API (route: /api/conversations/{id}/messages)
             url = f"{API_BASE_URL}/conversations/{conversation_id}/messages"
-            print(f"[DEBUG] Fetching messages from: {url}")
+            api_log.debug("Fetching messages from: %s", url)
             response = await client.get(url, headers={"Authorization": authorization})
-            print(f"[DEBUG] Response status: {response.status_code}")
+            api_log.debug("Response status: %s", response.status_code)
 
             if response.status_code == 200:
                 result = response.json()
                 return {"success": True, "data": result.get("data", {})}
             else:
-                print(f"[DEBUG] Error response: {response.text[:500]}")
+                api_log.warning("Fetching messages failed with %s: %s", response.status_code, response.text[:200])
                 raise HTTPException(status_code=response.status_code, detail="Failed to fetch messages")
 
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error fetching messages: {e}")
+            api_log.error("Error fetching messages: %s", e)
             raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1081,23 +2090,23 @@ async def get_site_conversations(site_id: str, authorization: str = Header(None)
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            response = await client.get(
-                f"{API_BASE_URL}/sites/{site_id}/conversations",
-                headers={"Authorization": authorization}
-            )
+    try:
+        response = await shared_get(
+            f"{API_BASE_URL}/sites/{site_id}/conversations",
+            scope=token_data["user_id"] or token,
+            headers={"Authorization": authorization}
+        )
 
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Failed to fetch conversations")
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise HTTPException(status_code=response.status_code, detail="Failed to fetch conversations")
 
-        except HTTPException:
-            raise
-        except Exception as e:
-            print(f"Error fetching site conversations: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_log.error("Error fetching site conversations: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/api/sites/{site_id}/conversations/{conversation_id}")
@@ -1113,7 +2122,7 @@ async def delete_conversation(site_id: str, conversation_id: str, authorization:
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.delete(
                 f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}",
@@ -1121,6 +2130,7 @@ async def delete_conversation(site_id: str, conversation_id: str, authorization:
             )
 
             if response.status_code == 200:
+                forget_shared_get(f"{API_BASE_URL}/sites/{site_id}/conversations")
                 return response.json()
             else:
                 raise HTTPException(status_code=response.status_code, detail="Failed to delete conversation")
@@ -1128,7 +2138,7 @@ async def delete_conversation(site_id: str, conversation_id: str, authorization:
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error deleting conversation: {e}")
+            api_log.error("Error deleting conversation: %s", e)
             raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1145,25 +2155,25 @@ async def get_site_agents(site_id: str, authorization: str = Header(None)):
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            response = await client.get(
-                f"{API_BASE_URL}/sites/{site_id}/agents",
-                headers={"Authorization": authorization}
-            )
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                # Return empty list if endpoint doesn't exist or fails
-                return {"success": True, "data": []}
+    try:
+        response = await shared_get(
+            f"{API_BASE_URL}/sites/{site_id}/agents",
+            scope=token_data["user_id"] or token,
+            headers={"Authorization": authorization}
+        )
 
-        except HTTPException:
-            raise
-        except Exception as e:
-            print(f"Error fetching site agents: {e}")
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # Return empty list if endpoint doesn't exist or fails
             return {"success": True, "data": []}
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_log.error("Error fetching site agents: %s", e)
+        return {"success": True, "data": []}
+
 
 # ------------------ CONVERSATION COMMENTS API ------------------
 
@@ -1178,23 +2188,23 @@ async def get_conversation_comments(conversation_id: str, authorization: str = H
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            response = await client.get(
-                f"{API_BASE_URL}/conversations/{conversation_id}/comments",
-                headers={"Authorization": authorization}
-            )
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                # Return empty list if endpoint doesn't exist
-                return {"success": True, "data": []}
+    try:
+        response = await shared_get(
+            f"{API_BASE_URL}/conversations/{conversation_id}/comments",
+            scope=token_data["user_id"] or token,
+            headers={"Authorization": authorization}
+        )
 
-        except Exception as e:
-            print(f"Error fetching conversation comments: {e}")
+        if response.status_code == 200:
+            return response.json()
+        else:
+            # Return empty list if endpoint doesn't exist
             return {"success": True, "data": []}
 
+    except Exception as e:
+        api_log.error("Error fetching conversation comments: %s", e)
+        return {"success": True, "data": []}
+
 
 @app.post("/api/conversations/{conversation_id}/comments")
 async def add_conversation_comment(conversation_id: str, data: dict, authorization: str = Header(None)):
@@ -1207,7 +2217,7 @@ async def add_conversation_comment(conversation_id: str, data: dict, authorizati
     if not token_data:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/conversations/{conversation_id}/comments",
@@ -1216,6 +2226,7 @@ async def add_conversation_comment(conversation_id: str, data: dict, authorizati
             )
 
             if response.status_code == 200 or response.status_code == 201:
+                forget_shared_get(f"{API_BASE_URL}/conversations/{conversation_id}/comments")
                 return response.json()
             else:
                 error_text = response.text
@@ -1224,7 +2235,7 @@ async def add_conversation_comment(conversation_id: str, data: dict, authorizati
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error adding conversation comment: {e}")
+            api_log.error("Error adding conversation comment: %s", e)
             raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1273,53 +2284,54 @@ async def get_supervisor_overview(site_id: str, authorization: str = Header(None
         })
 
     # Also fetch historical data from API
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            # Get all agents for the site
-            agents_response = await client.get(
-                f"{API_BASE_URL}/sites/{site_id}/agents",
-                headers={"Authorization": authorization}
-            )
-            all_agents = []
-            if agents_response.status_code == 200:
-                result = agents_response.json()
-                all_agents = result.get("data", [])
-
-            # Merge with online status
-            online_ids = {a["id"] for a in online_agents}
-            for agent in all_agents:
-                if agent.get("userId") not in online_ids and agent.get("id") not in online_ids:
-                    online_agents.append({
-                        "id": agent.get("userId") or agent.get("id"),
-                        "username": agent.get("name") or agent.get("email"),
-                        "status": "offline",
-                        "isOnline": False
-                    })
+    try:
+        # Get all agents for the site
+        agents_response = await shared_get(
+            f"{API_BASE_URL}/sites/{site_id}/agents",
+            scope=token_data["user_id"] or token,
+            headers={"Authorization": authorization}
+        )
+        all_agents = []
+        if agents_response.status_code == 200:
+            result = agents_response.json()
+            all_agents = result.get("data", [])
+
+        # Merge with online status
+        online_ids = {a["id"] for a in online_agents}
+        for agent in all_agents:
+            if agent.get("userId") not in online_ids and agent.get("id") not in online_ids:
+                online_agents.append({
+                    "id": agent.get("userId") or agent.get("id"),
+                    "username": agent.get("name") or agent.get("email"),
+                    "status": "offline",
+                    "isOnline": False
+                })
 
-            # Get conversations
-            conv_response = await client.get(
-                f"{API_BASE_URL}/sites/{site_id}/conversations",
-                headers={"Authorization": authorization}
-            )
-            if conv_response.status_code == 200:
-                conv_result = conv_response.json()
-                conversations = conv_result.get("data", {}).get("items", [])
-
-                # Merge with active status
-                active_ids = {c["visitorId"] for c in active_conversations}
-                for conv in conversations:
-                    if conv.get("visitorId") not in active_ids:
-                        active_conversations.append({
-                            "visitorId": conv.get("visitorId"),
-                            "name": conv.get("visitorName", "Visitor"),
-                            "conversationId": conv.get("id"),
-                            "isOnline": False,
-                            "lastMessageAt": conv.get("lastMessageAt"),
-                            "assignedAgentId": conv.get("assignedAgentId")
-                        })
+        # Get conversations
+        conv_response = await shared_get(
+            f"{API_BASE_URL}/sites/{site_id}/conversations",
+            scope=token_data["user_id"] or token,
+            headers={"Authorization": authorization}
+        )
+        if conv_response.status_code == 200:
+            conv_result = conv_response.json()
+            conversations = conv_result.get("data", {}).get("items", [])
+
+            # Merge with active status
+            active_ids = {c["visitorId"] for c in active_conversations}
+            for conv in conversations:
+                if conv.get("visitorId") not in active_ids:
+                    active_conversations.append({
+                        "visitorId": conv.get("visitorId"),
+                        "name": conv.get("visitorName", "Visitor"),
+                        "conversationId": conv.get("id"),
+                        "isOnline": False,
+                        "lastMessageAt": conv.get("lastMessageAt"),
+                        "assignedAgentId": conv.get("assignedAgentId")
+                    })
 
-        except Exception as e:
-            print(f"Error fetching supervisor data from API: {e}")
+    except Exception as e:
+        api_log.error("Error fetching supervisor data from API: %s", e)
 
     return {
         "success": True,
@@ -1336,11 +2348,127 @@ async def get_supervisor_overview(site_id: str, authorization: str = Header(None
     }
 
 
+# ------------------ SITE CONFIG CACHE ------------------
+
+# Fresh window, then a stale window in which cached values are served while a
+# background refresh runs. Past both, callers wait for a reload.
+SITE_CONFIG_TTL = float(os.getenv("SITE_CONFIG_TTL", "60"))
+SITE_CONFIG_STALE_TTL = float(os.getenv("SITE_CONFIG_STALE_TTL", "300"))
+
+# key -> asyncio.Task for loads currently in flight
+_inflight = {}
+
+# (kind, site_id, scope) -> {"value": ..., "fetched_at": float}
+_site_config_cache = {}
+# (kind, site_id, scope) -> int, bumped on invalidation so in-flight loads don't repopulate
+_site_config_generation = {}
+# Fire-and-forget refreshes, referenced until done so they aren't garbage-collected mid-flight
+_background_tasks = set()
+
+
+def _forget_inflight(key, task):
+    if _inflight.get(key) is task:
+        _inflight.pop(key, None)
+    # Mark the exception as retrieved when every waiter has gone away
+    if not task.cancelled():
+        task.exception()
+
+
+def _finish_background_task(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("Background task failed: %r", task.exception())
+
+
+def run_in_background(coro):
+    """Schedule coro without awaiting it; a failure is logged instead of going unretrieved"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_finish_background_task)
+    return task
+
+
+async def singleflight(key, loader):
+    """Run loader() once per key; concurrent callers share the same result"""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(loader())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _forget_inflight(key, t))
+    # Shield so one cancelled waiter doesn't cancel the load for everyone else
+    return await asyncio.shield(task)
+
+
+async def _load_site_config(key, loader):
+    generation = _site_config_generation.get(key, 0)
+    value = await loader()
+    if value is None:
+        # Upstream failed - keep serving the last good value if we have one
+        entry = _site_config_cache.get(key)
+        return entry["value"] if entry else None
+    if _site_config_generation.get(key, 0) == generation:
+        _site_config_cache[key] = {"value": value, "fetched_at": time.monotonic()}
+    return value
+
+
+async def get_site_config(kind: str, site_id: str, loader, scope: str = None):
+    """Get a piece of site configuration through the cache.
+
+    loader() is an async callable returning the fresh value, or None on failure
+    (failures are never cached). Concurrent misses share one upstream call.
+    """
+    key = (kind, site_id, scope)
+    flight_key = ("site_config", key, _site_config_generation.get(key, 0))
+    entry = _site_config_cache.get(key)
+    if entry:
+        age = time.monotonic() - entry["fetched_at"]
+        if age < SITE_CONFIG_TTL:
+            return entry["value"]
+        if age < SITE_CONFIG_TTL + SITE_CONFIG_STALE_TTL:
+            # Serve stale, refresh in the background
+            run_in_background(singleflight(flight_key, lambda: _load_site_config(key, loader)))
+            return entry["value"]
+    return await singleflight(flight_key, lambda: _load_site_config(key, loader))
+
+
+def token_scope(token: str):
+    """Cache scope for config loaded with a caller's credentials: the JWT subject, else the token itself"""
+    claims = validate_jwt_token(token) if token else None
+    return (claims or {}).get("user_id") or token
+
+
+def invalidate_site_config(site_id: str, kind: str = None):
+    """Drop cached configuration for a site (all kinds if kind is None)"""
+    for key in set(_site_config_cache) | set(_site_config_generation):
+        if key[1] == site_id and (kind is None or key[0] == kind):
+            _site_config_cache.pop(key, None)
+            _site_config_generation[key] = _site_config_generation.get(key, 0) + 1
+
+
 # ------------------ AI USAGE TRACKING ------------------
 
-async def check_and_record_ai_usage(site_id: str, feature_type: str) -> dict:
-    """Check if AI feature can be used and record usage. Returns {allowed, message, used, limit}"""
-    async with httpx.AsyncClient(verify=False) as client:
+# AI usage is counted in a local ledger per (site, feature) and recorded with the .NET API by a
+# background sync, instead of inline with every analysis/auto-reply. The API contract takes one
+# {featureType} record per use, so the sync replays each pending use individually.
+
+# What to do when a site's quota can't be determined: "open" allows AI, "closed" blocks it
+AI_QUOTA_FAIL_POLICY = os.getenv("AI_QUOTA_FAIL_POLICY", "open").lower()
+# Seconds between pushes of locally recorded usage to the .NET API
+AI_QUOTA_SYNC_INTERVAL = float(os.getenv("AI_QUOTA_SYNC_INTERVAL", "30"))
+# Seconds before a ledger entry is re-seeded from the .NET API in the background
+AI_QUOTA_RESEED_SECONDS = float(os.getenv("AI_QUOTA_RESEED_SECONDS", "300"))
+
+# Metric names used by the subscription overview for each feature
+AI_USAGE_METRICS = {"analysis": "ai_analyses", "auto_reply": "ai_auto_replies"}
+
+# (site_id, feature_type) -> {"used": int, "limit": int|None, "pending": int, "message": str, "seeded_at": float}
+_ai_quota = {}
+_ai_usage_sync_task = None
+
+
+async def _post_ai_usage(site_id: str, feature_type: str):
+    """Record one use with the .NET API. Returns {allowed, message, used, limit} or None on failure"""
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/subscriptions/sites/{site_id}/ai-usage",
@@ -1352,34 +2480,337 @@ async def check_and_record_ai_usage(site_id: str, feature_type: str) -> dict:
                 if result.get("success"):
                     return result.get("data", {"allowed": False})
         except Exception as e:
-            print(f"AI usage tracking error: {e}")
+            ai_log.error("AI usage tracking error: %s", e)
+    return None
 
-    # Default to allowed if tracking fails (graceful degradation)
-    return {"allowed": True, "message": None, "used": 0, "limit": None}
 
+def _parse_ai_usage(data: dict, feature_type: str):
+    """Pull {used, limit} for one feature out of a get_ai_usage() payload, None if absent"""
+    if not isinstance(data, dict):
+        return None
+    camel = feature_type.split("_")[0] + "".join(p.title() for p in feature_type.split("_")[1:])
+    for key in (feature_type, camel):
+        item = data.get(key)
+        if isinstance(item, dict) and "used" in item:
+            return {"used": item.get("used") or 0, "limit": item.get("limit")}
+    metric = AI_USAGE_METRICS.get(feature_type)
+    for item in data.get("usage") or []:
+        if isinstance(item, dict) and item.get("metricName") == metric:
+            return {"used": item.get("used") or 0, "limit": item.get("limit")}
+    return None
 
-async def get_ai_usage(site_id: str) -> dict:
-    """Get current AI usage for a site"""
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
-            response = await client.get(
-                f"{API_BASE_URL}/subscriptions/sites/{site_id}/ai-usage",
-                timeout=10.0
-            )
-            if response.status_code == 200:
-                result = response.json()
+
+def _new_ai_quota_entry(used: int, limit, message=None) -> dict:
+    # pending: counted locally, not posted yet; in_flight: being posted right now;
+    # recorded: posts the API has acknowledged (lets a re-seed spot ones that raced its GET)
+    return {
+        "used": used,
+        "limit": limit,
+        "pending": 0,
+        "in_flight": 0,
+        "recorded": 0,
+        "message": message,
+        "seeded_at": time.monotonic()
+    }
+
+
+async def _seed_ai_quota(site_id: str, feature_type: str):
+    key = (site_id, feature_type)
+    recorded_before = _ai_quota[key]["recorded"] if key in _ai_quota else 0
+    usage = _parse_ai_usage(await get_ai_usage(site_id), feature_type)
+    if usage is None:
+        return None
+    entry = _ai_quota.get(key)
+    if entry is None:
+        entry = _ai_quota[key] = _new_ai_quota_entry(usage["used"], usage["limit"])
+        return entry
+    # Updated in place: a flush already running holds this dict. Upstream hasn't seen what we still
+    # owe it or what is on the wire, and may have answered before posts that completed since
+    entry.update(
+        used=usage["used"] + entry["pending"] + entry["in_flight"] + entry["recorded"] - recorded_before,
+        limit=usage["limit"],
+        message=None,
+        seeded_at=time.monotonic()
+    )
+    return entry
+
+
+def _ai_quota_unavailable() -> dict:
+    if AI_QUOTA_FAIL_POLICY == "closed":
+        return {"allowed": False, "message": "AI usage could not be verified", "used": 0, "limit": None}
+    return {"allowed": True, "message": None, "used": 0, "limit": None}
+
+
+@traced("ai.usage.check")
+async def check_and_record_ai_usage(site_id: str, feature_type: str) -> dict:
+    """Check if AI feature can be used and record usage. Returns {allowed, message, used, limit}"""
+    key = (site_id, feature_type)
+    seed_key = ("ai_quota", site_id, feature_type)
+    entry = _ai_quota.get(key)
+    if entry is None:
+        entry = await singleflight(seed_key, lambda: _seed_ai_quota(site_id, feature_type))
+    elif time.monotonic() - entry["seeded_at"] > AI_QUOTA_RESEED_SECONDS:
+        run_in_background(singleflight(seed_key, lambda: _seed_ai_quota(site_id, feature_type)))
+
+    if entry is None:
+        # Usage endpoint had nothing for this feature - record upstream directly and seed from the reply
+        result = await _post_ai_usage(site_id, feature_type)
+        if result is None:
+            return _ai_quota_unavailable()
+        _ai_quota.setdefault(key, _new_ai_quota_entry(result.get("used") or 0, result.get("limit"), result.get("message")))
+        return result
+
+    limit = entry["limit"]
+    if limit is not None and entry["used"] >= limit:
+        return {
+            "allowed": False,
+            "message": entry.get("message") or "AI usage limit reached for this billing period",
+            "used": entry["used"],
+            "limit": limit
+        }
+
+    entry["used"] += 1
+    entry["pending"] += 1
+    return {"allowed": True, "message": None, "used": entry["used"], "limit": limit}
+
+
+def refund_ai_usage(site_id: str, feature_type: str):
+    """Take back a use recorded by check_and_record_ai_usage whose result was never delivered"""
+    entry = _ai_quota.get((site_id, feature_type))
+    if entry is None or entry["pending"] <= 0:
+        # Already recorded upstream (direct post or a sync in between) - nothing local to undo
+        ai_log.warning("Could not refund %s usage for site %s, already recorded with the API", feature_type, site_id)
+        return
+    entry["used"] -= 1
+    entry["pending"] -= 1
+
+
+def _reconcile_ai_usage(site_id: str, feature_type: str, entry: dict, result: dict):
+    api_used = result.get("used")
+    if api_used is not None:
+        # Everything recorded so far, minus what is still queued or on the wire, should be on the API's count
+        expected = entry["used"] - entry["pending"] - entry["in_flight"]
+        if api_used != expected:
+            ai_log.warning(
+                "AI usage mismatch for site %s %s: API reports %s, ledger expects %s",
+                site_id, feature_type, api_used, expected
+            )
+        # Other instances may have recorded more; the API's count never lowers the ledger
+        entry["used"] = max(entry["used"], api_used + entry["pending"] + entry["in_flight"])
+    entry["limit"] = result.get("limit", entry["limit"])
+    if not result.get("allowed", True):
+        entry["message"] = result.get("message")
+
+
+async def _flush_ai_usage_entry(site_id: str, feature_type: str, entry: dict):
+    """Replay pending uses one record at a time; stop at the first failure and retry on the next sync"""
+    while entry["pending"] > 0:
+        entry["pending"] -= 1
+        entry["in_flight"] += 1
+        try:
+            result = await _post_ai_usage(site_id, feature_type)
+        finally:
+            entry["in_flight"] -= 1
+        if result is None:
+            entry["pending"] += 1
+            return
+        entry["recorded"] += 1
+        _reconcile_ai_usage(site_id, feature_type, entry, result)
+
+
+async def flush_ai_usage():
+    """Record locally counted AI usage with the .NET API, sites and features in parallel"""
+    pending = [
+        _flush_ai_usage_entry(site_id, feature_type, entry)
+        for (site_id, feature_type), entry in list(_ai_quota.items())
+        if entry["pending"] > 0
+    ]
+    if pending:
+        await asyncio.gather(*pending)
+
+
+async def _ai_usage_sync_loop():
+    while True:
+        await asyncio.sleep(AI_QUOTA_SYNC_INTERVAL)
+        try:
+            await flush_ai_usage()
+        except Exception as e:
+            ai_log.error("AI usage sync error: %s", e)
+
+
+@app.on_event("startup")
+async def start_ai_usage_sync():
+    global _ai_usage_sync_task
+    _ai_usage_sync_task = asyncio.ensure_future(_ai_usage_sync_loop())
+
+
+@app.on_event("shutdown")
+async def stop_ai_usage_sync():
+    if _ai_usage_sync_task:
+        _ai_usage_sync_task.cancel()
+    await flush_ai_usage()
+
+
+async def get_ai_usage(site_id: str) -> dict:
+    """Get current AI usage for a site"""
+    async with api_client(verify=False) as client:
+        try:
+            response = await client.get(
+                f"{API_BASE_URL}/subscriptions/sites/{site_id}/ai-usage",
+                timeout=10.0
+            )
+            if response.status_code == 200:
+                result = response.json()
                 if result.get("success"):
                     return result.get("data", {})
         except Exception as e:
-            print(f"Error getting AI usage: {e}")
+            ai_log.error("Error getting AI usage: %s", e)
     return {}
 
 
+# ------------------ AI RESPONSE CACHE ------------------
+
+# Short FAQ-style messages ("hi", "pricing?") get the same analysis over and over, so
+# results are cached per site under normalized text. RAG results are also keyed on the
+# knowledge-base version so they drop out when the knowledge base changes.
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "500"))  # per site
+AI_CACHE_MAX_CHARS = int(os.getenv("AI_CACHE_MAX_CHARS", "200"))  # longer messages are never cached
+# Optional near-duplicate tier: simhash with banded LSH lookup
+AI_CACHE_NEAR_DUPLICATES = os.getenv("AI_CACHE_NEAR_DUPLICATES", "false").lower() == "true"
+AI_CACHE_NEAR_DUPLICATE_DISTANCE = int(os.getenv("AI_CACHE_NEAR_DUPLICATE_DISTANCE", "3"))  # max differing bits
+
+_SIMHASH_BANDS = 4
+_SIMHASH_BAND_BITS = 16
+
+# site_id -> {"entries": OrderedDict[key -> {"value", "stored_at", "simhash"}], "bands": {band_key -> set(key)}}
+_analysis_cache = {}
+
+
+def normalize_message_text(message: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace"""
+    cleaned = "".join(ch if ch.isalnum() or ch.isspace() else " " for ch in message.lower())
+    return " ".join(cleaned.split())
+
+
+def _simhash(text: str) -> int:
+    """64-bit simhash over character trigrams"""
+    padded = f" {text} "
+    grams = [padded[i:i + 3] for i in range(max(1, len(padded) - 2))]
+    weights = [0] * 64
+    for gram in grams:
+        h = int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _simhash_bands(kind: str, kb_version: str, value: int) -> list:
+    mask = (1 << _SIMHASH_BAND_BITS) - 1
+    return [(kind, kb_version, band, value >> (band * _SIMHASH_BAND_BITS) & mask) for band in range(_SIMHASH_BANDS)]
+
+
+def _drop_analysis_entry(site_cache: dict, key: tuple):
+    entry = site_cache["entries"].pop(key, None)
+    if entry and entry["simhash"] is not None:
+        for band_key in _simhash_bands(key[0], key[1], entry["simhash"]):
+            keys = site_cache["bands"].get(band_key)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    site_cache["bands"].pop(band_key, None)
+
+
+def get_cached_analysis(site_id: str, kind: str, kb_version: str, message: str):
+    """Return a cached analysis for this message (exact, then near-duplicate), or None"""
+    site_cache = _analysis_cache.get(site_id)
+    text = normalize_message_text(message)
+    if not site_cache or not text or len(text) > AI_CACHE_MAX_CHARS:
+        return None
+
+    now = time.monotonic()
+    key = (kind, kb_version, text)
+    entry = site_cache["entries"].get(key)
+    if entry is None and AI_CACHE_NEAR_DUPLICATES:
+        value = _simhash(text)
+        for band_key in _simhash_bands(kind, kb_version, value):
+            for candidate in site_cache["bands"].get(band_key, ()):
+                cached = site_cache["entries"][candidate]
+                if bin(cached["simhash"] ^ value).count("1") <= AI_CACHE_NEAR_DUPLICATE_DISTANCE:
+                    key, entry = candidate, cached
+                    break
+            if entry:
+                break
+    if entry is None:
+        return None
+    if now - entry["stored_at"] > AI_CACHE_TTL:
+        _drop_analysis_entry(site_cache, key)
+        return None
+    site_cache["entries"].move_to_end(key)
+    return dict(entry["value"])
+
+
+def store_cached_analysis(site_id: str, kind: str, kb_version: str, message: str, value: dict):
+    text = normalize_message_text(message)
+    if not text or len(text) > AI_CACHE_MAX_CHARS:
+        return
+    site_cache = _analysis_cache.setdefault(site_id, {"entries": OrderedDict(), "bands": {}})
+    key = (kind, kb_version, text)
+    _drop_analysis_entry(site_cache, key)
+    simhash = _simhash(text) if AI_CACHE_NEAR_DUPLICATES else None
+    site_cache["entries"][key] = {"value": dict(value), "stored_at": time.monotonic(), "simhash": simhash}
+    if simhash is not None:
+        for band_key in _simhash_bands(kind, kb_version, simhash):
+            site_cache["bands"].setdefault(band_key, set()).add(key)
+    while len(site_cache["entries"]) > AI_CACHE_MAX_ENTRIES:
+        _drop_analysis_entry(site_cache, next(iter(site_cache["entries"])))
+
+
+def invalidate_analysis_cache(site_id: str):
+    _analysis_cache.pop(site_id, None)
+
+
+async def _fetch_kb_version(site_id: str, token: str):
+    """Fingerprint of the site's knowledge base, None if unavailable"""
+    if not token:
+        return None
+    async with api_client(verify=False) as client:
+        try:
+            response = await client.get(
+                f"{API_BASE_URL}/knowledge/sites/{site_id}/stats",
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=10.0
+            )
+            if response.status_code == 200:
+                result = response.json()
+                data = result.get("data") or {}
+                if result.get("success"):
+                    return ":".join(str(data.get(field, "")) for field in (
+                        "totalDocuments", "indexedDocuments", "totalChunks", "lastUpdatedAt"
+                    ))
+        except Exception as e:
+            ai_log.error("Error fetching knowledge base stats: %s", e)
+    return None
+
+
+async def get_kb_version(site_id: str):
+    """Current knowledge-base version for a site (cached with the site config)"""
+    site = connections.get(site_id, {})
+    agent_token = None
+    for aid, adata in site.get("agents", {}).items():
+        agent_token = adata.get("token")
+        if agent_token:
+            break
+    return await get_site_config(
+        "kb_version", site_id, lambda: _fetch_kb_version(site_id, agent_token), scope=token_scope(agent_token)
+    )
+
+
 # ------------------ AI ANALYSIS ------------------
 
-async def analyze_customer_message(message: str, conversation_id: str = None, visitor_id: str = None):
-    """Analyze customer message using .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+async def _request_analysis(message: str, conversation_id: str = None, visitor_id: str = None):
+    """Analyze customer message using .NET API, None on failure"""
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/ai/analyze-message",
@@ -1404,7 +2835,23 @@ async def analyze_customer_message(message: str, conversation_id: str = None, vi
                     }
 
         except Exception as e:
-            print(f"AI analysis error: {e}")
+            ai_log.error("AI analysis error: %s", e)
+    return None
+
+
+@traced("ai.analyze")
+async def analyze_customer_message(message: str, conversation_id: str = None, visitor_id: str = None, site_id: str = None):
+    """Analyze customer message using .NET API (cached per site when site_id is given)"""
+    if site_id:
+        cached = get_cached_analysis(site_id, "analysis", "", message)
+        if cached:
+            return cached
+
+    analysis = await _request_analysis(message, conversation_id, visitor_id)
+    if analysis:
+        if site_id:
+            store_cached_analysis(site_id, "analysis", "", message, analysis)
+        return analysis
 
     # Return default response if API fails
     return {
@@ -1416,9 +2863,9 @@ async def analyze_customer_message(message: str, conversation_id: str = None, vi
     }
 
 
-async def analyze_customer_message_with_rag(message: str, site_id: str, conversation_id: str = None, visitor_id: str = None):
-    """Analyze customer message using RAG (Knowledge Base) via .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+async def _request_analysis_with_rag(message: str, site_id: str, conversation_id: str = None, visitor_id: str = None):
+    """Analyze customer message using RAG (Knowledge Base) via .NET API, None on failure"""
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/ai/analyze-message-with-rag",
@@ -1448,38 +2895,178 @@ async def analyze_customer_message_with_rag(message: str, site_id: str, conversa
                     }
 
         except Exception as e:
-            print(f"RAG analysis error: {e}")
+            ai_log.error("RAG analysis error: %s", e)
+    return None
+
+
+@traced("ai.analyze_rag")
+async def analyze_customer_message_with_rag(message: str, site_id: str, conversation_id: str = None, visitor_id: str = None):
+    """Analyze customer message using RAG (Knowledge Base) via .NET API"""
+    # Without a knowledge-base version RAG answers can't be invalidated, so don't cache them
+    kb_version = await get_kb_version(site_id)
+    if kb_version:
+        cached = get_cached_analysis(site_id, "rag", kb_version, message)
+        if cached:
+            return cached
+
+    analysis = await _request_analysis_with_rag(message, site_id, conversation_id, visitor_id)
+    if analysis:
+        if kb_version:
+            store_cached_analysis(site_id, "rag", kb_version, message, analysis)
+        return analysis
 
     # Fall back to regular analysis if RAG fails
-    return await analyze_customer_message(message, conversation_id, visitor_id)
+    return await analyze_customer_message(message, conversation_id, visitor_id, site_id)
+
+
+# Messages that couldn't be saved because the API was down (or its circuit open), in send order.
+# A background task retries them once POST /chat/message is reachable again. While anything is
+# queued, new messages queue behind it so conversation history keeps its order. On shutdown the
+# outbox gets one last flush; whatever is left is written to MESSAGE_OUTBOX_PATH and re-queued
+# by the next start.
+MESSAGE_OUTBOX_SIZE = int(os.getenv("MESSAGE_OUTBOX_SIZE", "5000"))
+MESSAGE_OUTBOX_RETRY_SECONDS = float(os.getenv("MESSAGE_OUTBOX_RETRY_SECONDS", "5"))
+MESSAGE_OUTBOX_FLUSH_SECONDS = float(os.getenv("MESSAGE_OUTBOX_FLUSH_SECONDS", "10"))  # shutdown flush budget
+MESSAGE_OUTBOX_PATH = os.getenv("MESSAGE_OUTBOX_PATH", str(BASE_DIR / "data" / "message_outbox.json"))
+
+_message_outbox = deque()
+_message_outbox_task = None
+
+
+async def _post_message(payload: dict) -> tuple:
+    """POST one message. Returns (saved data or None, whether it should be retried later)"""
+    try:
+        async with api_client(verify=False) as client:
+            response = await client.post(f"{API_BASE_URL}/chat/message", json=payload)
+    except httpx.TransportError as e:
+        api_log.warning("Message save failed, will retry: %s", e)
+        return None, True
+    if response.status_code >= 500:
+        api_log.warning("Message save failed with %s, will retry", response.status_code)
+        return None, True
+    if response.status_code == 200:
+        return response.json().get("data"), False
+    # Retrying won't change a 4xx; record the loss instead of dropping the message silently
+    api_log.error(
+        "Message for conversation %s rejected with %s, not saved: %s",
+        payload["conversationId"], response.status_code, response.text[:200]
+    )
+    inc_metric("message_save_failures_total", "rejected")
+    return None, False
+
+
+def _queue_message(payload: dict):
+    if len(_message_outbox) >= MESSAGE_OUTBOX_SIZE:
+        dropped = _message_outbox.popleft()
+        api_log.error("Message outbox full, dropping unsaved message for conversation %s", dropped["conversationId"])
+        inc_metric("message_save_failures_total", "dropped")
+    _message_outbox.append(payload)
 
 
+@traced("api.save_message")
 async def save_message_to_api(conversation_id: str, sender_type: str, sender_id: str, content: str, message_type: str = "text", file_id: str = None):
-    """Save message to .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+    """Save message to .NET API, or queue it in the outbox while the API is unavailable"""
+    payload = {
+        "conversationId": conversation_id,
+        "senderType": sender_type,
+        "senderId": sender_id,
+        "content": content,
+        "messageType": message_type,
+        "fileId": file_id
+    }
+    if _message_outbox or not upstream_available("POST", "/chat/message"):
+        _queue_message(payload)
+        return None
+    try:
+        data, retry = await _post_message(payload)
+        if retry:
+            _queue_message(payload)
+        return data
+    except Exception as e:
+        api_log.error("Error saving message: %s", e)
+        inc_metric("message_save_failures_total", "error")
+    return None
+
+
+async def flush_message_outbox():
+    """Post queued messages in order until the outbox is empty or the API stops accepting them"""
+    while _message_outbox and upstream_available("POST", "/chat/message"):
+        payload = _message_outbox[0]
         try:
-            response = await client.post(
-                f"{API_BASE_URL}/chat/message",
-                json={
-                    "conversationId": conversation_id,
-                    "senderType": sender_type,
-                    "senderId": sender_id,
-                    "content": content,
-                    "messageType": message_type,
-                    "fileId": file_id
-                }
-            )
-            if response.status_code == 200:
-                result = response.json()
-                return result.get("data")
+            _, retry = await _post_message(payload)
         except Exception as e:
-            print(f"Error saving message: {e}")
-    return None
+            api_log.error("Error saving queued message: %s", e)
+            inc_metric("message_save_failures_total", "error")
+            retry = False
+        if retry:
+            return
+        # The head may have been dropped by a full outbox while we were posting
+        if _message_outbox and _message_outbox[0] is payload:
+            _message_outbox.popleft()
 
 
+async def _drain_message_outbox():
+    while True:
+        await asyncio.sleep(MESSAGE_OUTBOX_RETRY_SECONDS)
+        await flush_message_outbox()
+
+
+def _load_message_outbox():
+    """Re-queue messages a previous shutdown could not save"""
+    path = Path(MESSAGE_OUTBOX_PATH)
+    if not path.exists():
+        return
+    try:
+        saved = json.loads(path.read_text())
+        path.unlink()
+    except Exception as e:
+        api_log.error("Could not load saved message outbox from %s: %s", path, e)
+        return
+    for payload in saved:
+        _queue_message(payload)
+    api_log.info("Re-queued %s unsaved messages from the last shutdown", len(saved))
+
+
+def _save_message_outbox():
+    path = Path(MESSAGE_OUTBOX_PATH)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(list(_message_outbox)))
+    except Exception as e:
+        api_log.error("Shutting down with %s unsaved messages, could not write %s: %s", len(_message_outbox), path, e)
+        inc_metric("message_save_failures_total", "dropped", amount=len(_message_outbox))
+        return
+    api_log.warning("Shutting down with %s unsaved messages, kept in %s for the next start", len(_message_outbox), path)
+
+
+@metrics_collector
+def collect_outbox_metrics():
+    set_metric("message_outbox_size", len(_message_outbox))
+
+
+@app.on_event("startup")
+async def start_message_outbox():
+    global _message_outbox_task
+    _load_message_outbox()
+    _message_outbox_task = asyncio.ensure_future(_drain_message_outbox())
+
+
+@app.on_event("shutdown")
+async def stop_message_outbox():
+    if _message_outbox_task:
+        _message_outbox_task.cancel()
+    try:
+        await asyncio.wait_for(flush_message_outbox(), MESSAGE_OUTBOX_FLUSH_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+    if _message_outbox:
+        _save_message_outbox()
+
+
+@traced("api.init_chat")
 async def init_chat_session(site_id: str, visitor_id: str, name: str = None, email: str = None):
     """Initialize chat session via .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/chat/init",
@@ -1495,13 +3082,13 @@ async def init_chat_session(site_id: str, visitor_id: str, name: str = None, ema
                 if result.get("success"):
                     return result.get("data")
         except Exception as e:
-            print(f"Error initializing chat: {e}")
+            api_log.error("Error initializing chat: %s", e)
     return None
 
 
-async def get_welcome_messages(site_id: str):
-    """Fetch welcome messages from .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+async def _fetch_welcome_messages(site_id: str):
+    """Fetch welcome messages from .NET API, None on failure"""
+    async with api_client(verify=False) as client:
         try:
             response = await client.get(f"{API_BASE_URL}/sites/{site_id}/welcome-messages")
             if response.status_code == 200:
@@ -1511,8 +3098,14 @@ async def get_welcome_messages(site_id: str):
                     messages = result.get("data", [])
                     return [m for m in messages if m.get("isActive")]
         except Exception as e:
-            print(f"Error fetching welcome messages: {e}")
-    return []
+            api_log.error("Error fetching welcome messages: %s", e)
+    return None
+
+
+async def get_welcome_messages(site_id: str):
+    """Get active welcome messages for a site (cached)"""
+    messages = await get_site_config("welcome_messages", site_id, lambda: _fetch_welcome_messages(site_id))
+    return messages if messages is not None else []
 
 
 async def send_welcome_message(site_id: str, visitor_id: str, conversation_id: str, customer_ws: WebSocket, site: dict):
@@ -1532,7 +3125,7 @@ async def send_welcome_message(site_id: str, visitor_id: str, conversation_id: s
         support_user_id = site.get("support_user_id") or "bot"
 
         # Send to customer
-        await customer_ws.send_json({
+        await send_to_customer(site, site_id, visitor_id, {
             "type": "message",
             "from": "support",
             "name": support_name,
@@ -1550,8 +3143,8 @@ async def send_welcome_message(site_id: str, visitor_id: str, conversation_id: s
                 message_type="text"
             )
 
-        # Notify all agents - show as auto-message, not a separate user
-        await broadcast_to_agents(site, {
+        # Notify agents - show as auto-message, not a separate user
+        await publish_conversation_event(site, conversation_id, {
             "type": "welcome_sent",
             "visitorId": visitor_id,
             "message": welcome_msg.get("message"),
@@ -1559,7 +3152,7 @@ async def send_welcome_message(site_id: str, visitor_id: str, conversation_id: s
         })
 
     except Exception as e:
-        print(f"Error sending welcome message: {e}")
+        api_log.error("Error sending welcome message: %s", e)
 
 
 # ------------------ API KEY VALIDATION ------------------
@@ -1569,7 +3162,7 @@ async def validate_api_key(site_id: str, api_key: str) -> bool:
     if not site_id or not api_key:
         return False
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/validate-api-key",
@@ -1580,7 +3173,7 @@ async def validate_api_key(site_id: str, api_key: str) -> bool:
                 result = response.json()
                 return result.get("success", False) and result.get("data", {}).get("valid", False)
         except Exception as e:
-            print(f"API key validation error: {e}")
+            api_log.error("API key validation error: %s", e)
     return False
 
 
@@ -1589,7 +3182,7 @@ async def update_agent_status(token: str, status: str):
     if not token:
         return False
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.put(
                 f"{API_BASE_URL}/auth/me/status",
@@ -1598,12 +3191,12 @@ async def update_agent_status(token: str, status: str):
                 timeout=10.0
             )
             if response.status_code == 200:
-                print(f"Agent status updated to: {status}")
+                api_log.info("Agent status updated to: %s", status)
                 return True
             else:
-                print(f"Failed to update agent status: {response.status_code}")
+                api_log.warning("Failed to update agent status: %s", response.status_code)
         except Exception as e:
-            print(f"Error updating agent status: {e}")
+            api_log.error("Error updating agent status: %s", e)
     return False
 
 
@@ -1617,7 +3210,7 @@ async def update_site_toggle(site_id: str, token: str, auto_reply_enabled: bool
     if not payload:
         return False
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.put(
                 f"{API_BASE_URL}/sites/{site_id}",
@@ -1626,12 +3219,13 @@ async def update_site_toggle(site_id: str, token: str, auto_reply_enabled: bool
                 timeout=10.0
             )
             if response.status_code == 200:
-                print(f"Site toggle state saved: {payload}")
+                invalidate_site_config(site_id, "toggles")
+                api_log.info("Site toggle state saved: %s", payload)
                 return True
             else:
-                print(f"Failed to save site toggle state: {response.status_code}")
+                api_log.warning("Failed to save site toggle state: %s", response.status_code)
         except Exception as e:
-            print(f"Error saving site toggle state: {e}")
+            api_log.error("Error saving site toggle state: %s", e)
     return False
 
 
@@ -1653,29 +3247,33 @@ async def get_onboarding_state(site_id: str, authorization: str = Header(None)):
     if not claims:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
-        try:
+    async def _fetch_onboarding():
+        async with api_client(verify=False) as client:
             response = await client.get(
                 f"{API_BASE_URL}/sites/{site_id}",
                 headers={"Authorization": f"Bearer {token}"},
                 timeout=10.0
             )
-            if response.status_code == 200:
-                data = response.json()
-                site_data = data.get("data", {})
-                onboarding = site_data.get("onboardingState")
-                if onboarding is None:
-                    return {"success": True, "data": DEFAULT_ONBOARDING_STATE}
-                if isinstance(onboarding, str):
-                    onboarding = json.loads(onboarding)
-                return {"success": True, "data": onboarding}
-            else:
+            if response.status_code != 200:
                 raise HTTPException(status_code=response.status_code, detail="Failed to fetch site data")
-        except HTTPException:
-            raise
-        except Exception as e:
-            print(f"Error loading onboarding state: {e}")
-            raise HTTPException(status_code=500, detail="Internal server error")
+            data = response.json()
+            site_data = data.get("data", {})
+            onboarding = site_data.get("onboardingState")
+            if onboarding is None:
+                return DEFAULT_ONBOARDING_STATE
+            if isinstance(onboarding, str):
+                onboarding = json.loads(onboarding)
+            return onboarding
+
+    try:
+        # Scoped per user so the upstream access check still applies to every caller
+        onboarding = await get_site_config("onboarding", site_id, _fetch_onboarding, scope=claims.get("user_id"))
+        return {"success": True, "data": onboarding}
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_log.error("Error loading onboarding state: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.put("/api/sites/{site_id}/onboarding")
 async def update_onboarding_state(site_id: str, body: dict, authorization: str = Header(None)):
@@ -1687,7 +3285,7 @@ async def update_onboarding_state(site_id: str, body: dict, authorization: str =
     if not claims:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    async with httpx.AsyncClient(verify=False) as client:
+    async with api_client(verify=False) as client:
         try:
             response = await client.put(
                 f"{API_BASE_URL}/sites/{site_id}",
@@ -1696,19 +3294,20 @@ async def update_onboarding_state(site_id: str, body: dict, authorization: str =
                 timeout=10.0
             )
             if response.status_code == 200:
+                invalidate_site_config(site_id, "onboarding")
                 return {"success": True, "message": "Onboarding state updated"}
             else:
                 raise HTTPException(status_code=response.status_code, detail="Failed to update onboarding state")
         except HTTPException:
             raise
         except Exception as e:
-            print(f"Error saving onboarding state: {e}")
+            api_log.error("Error saving onboarding state: %s", e)
             raise HTTPException(status_code=500, detail="Internal server error")
 
 
-async def load_site_toggle_state(site_id: str, token: str):
-    """Load toggle state from database via .NET API"""
-    async with httpx.AsyncClient(verify=False) as client:
+async def _fetch_site_toggle_state(site_id: str, token: str):
+    """Load toggle state from database via .NET API, None on failure"""
+    async with api_client(verify=False) as client:
         try:
             response = await client.get(
                 f"{API_BASE_URL}/sites/{site_id}",
@@ -1723,8 +3322,17 @@ async def load_site_toggle_state(site_id: str, token: str):
                     "analysis_enabled": site_data.get("analysisEnabled", False)
                 }
         except Exception as e:
-            print(f"Error loading site toggle state: {e}")
-    return {"auto_reply_enabled": False, "analysis_enabled": False}
+            api_log.error("Error loading site toggle state: %s", e)
+    return None
+
+
+async def load_site_toggle_state(site_id: str, token: str):
+    """Load toggle state for a site (cached)"""
+    # Scoped per caller: the upstream access check on the token still applies to every agent
+    toggle_state = await get_site_config(
+        "toggles", site_id, lambda: _fetch_site_toggle_state(site_id, token), scope=token_scope(token)
+    )
+    return toggle_state or {"auto_reply_enabled": False, "analysis_enabled": False}
 
 
 # ==================== WORKFLOW ENGINE ====================
@@ -1735,10 +3343,10 @@ _idle_timers = {}
 _round_robin_index = {}
 
 
-async def load_site_workflows(site_id: str, token: str):
-    """Load enabled workflows from API for a site"""
+async def _fetch_site_workflows(site_id: str, token: str):
+    """Load enabled workflows from API for a site, None on failure"""
     try:
-        async with httpx.AsyncClient() as client:
+        async with api_client() as client:
             resp = await client.get(
                 f"{API_BASE_URL}/sites/{site_id}/workflows",
                 headers={"Authorization": f"Bearer {token}"}
@@ -1748,8 +3356,16 @@ async def load_site_workflows(site_id: str, token: str):
                 workflows = data.get("data", [])
                 return [w for w in workflows if w.get("isEnabled", False)]
     except Exception as e:
-        print(f"Error loading workflows for site {site_id}: {e}")
-    return []
+        workflow_log.error("Error loading workflows for site %s: %s", site_id, e)
+    return None
+
+
+async def load_site_workflows(site_id: str, token: str):
+    """Load enabled workflows for a site (cached)"""
+    workflows = await get_site_config(
+        "workflows", site_id, lambda: _fetch_site_workflows(site_id, token), scope=token_scope(token)
+    )
+    return workflows if workflows is not None else []
 
 
 def get_round_robin_agent(site: dict):
@@ -1783,7 +3399,7 @@ def get_least_busy_agent(site: dict):
 async def assign_conversation_via_api(site_id: str, conversation_id: str, user_id: str, token: str):
     """Assign a conversation to an agent via API"""
     try:
-        async with httpx.AsyncClient() as client:
+        async with api_client() as client:
             resp = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/assign",
                 json={"userId": user_id},
@@ -1791,14 +3407,14 @@ async def assign_conversation_via_api(site_id: str, conversation_id: str, user_i
             )
             return resp.status_code == 200
     except Exception as e:
-        print(f"Error assigning conversation: {e}")
+        api_log.error("Error assigning conversation: %s", e)
         return False
 
 
 async def update_conversation_via_api(site_id: str, conversation_id: str, updates: dict, token: str):
     """Update conversation fields via API"""
     try:
-        async with httpx.AsyncClient() as client:
+        async with api_client() as client:
             resp = await client.put(
                 f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}",
                 json=updates,
@@ -1806,14 +3422,14 @@ async def update_conversation_via_api(site_id: str, conversation_id: str, update
             )
             return resp.status_code == 200
     except Exception as e:
-        print(f"Error updating conversation: {e}")
+        api_log.error("Error updating conversation: %s", e)
         return False
 
 
 async def close_conversation_via_api(site_id: str, conversation_id: str, token: str):
     """Close a conversation via API"""
     try:
-        async with httpx.AsyncClient() as client:
+        async with api_client() as client:
             resp = await client.post(
                 f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/close",
                 json={"resolutionStatus": "resolved", "note": "Auto-closed by workflow"},
@@ -1821,7 +3437,7 @@ async def close_conversation_via_api(site_id: str, conversation_id: str, token:
             )
             return resp.status_code == 200
     except Exception as e:
-        print(f"Error closing conversation: {e}")
+        api_log.error("Error closing conversation: %s", e)
         return False
 
 
@@ -1838,11 +3454,11 @@ async def add_intent_tag(site_id: str, conversation_id: str, intent: str, site:
             break
 
     if not agent_token:
-        print(f"No agent token available for adding intent tag")
+        api_log.warning("No agent token available for adding intent tag")
         return
 
     try:
-        async with httpx.AsyncClient(verify=False) as client:
+        async with api_client(verify=False) as client:
             # Get current tags
             get_resp = await client.get(
                 f"{API_BASE_URL}/conversations/{conversation_id}",
@@ -1866,17 +3482,17 @@ async def add_intent_tag(site_id: str, conversation_id: str, intent: str, site:
                     timeout=10.0
                 )
                 if update_resp.status_code == 200:
-                    print(f"Added intent tag '{intent}' to conversation {conversation_id}")
-                    # Broadcast tag update to all agents for real-time UI update
-                    await broadcast_to_agents(site, {
+                    api_log.info("Added intent tag '%s' to conversation %s", intent, conversation_id)
+                    # Publish tag update to the conversation's subscribers for real-time UI update
+                    await publish_conversation_event(site, conversation_id, {
                         "type": "conversation_updated",
                         "conversationId": conversation_id,
                         "tags": new_tags
                     })
                 else:
-                    print(f"Failed to add intent tag: {update_resp.status_code}")
+                    api_log.warning("Failed to add intent tag: %s", update_resp.status_code)
     except Exception as e:
-        print(f"Error adding intent tag: {e}")
+        api_log.error("Error adding intent tag: %s", e)
 
 
 def evaluate_conditions(conditions: list, context: dict) -> bool:
@@ -1934,7 +3550,7 @@ async def execute_actions(site: dict, site_id: str, workflow: dict, context: dic
             break
 
     if not agent_token:
-        print(f"No agent token available for workflow execution")
+        workflow_log.warning("No agent token available for workflow execution")
         return executed
 
     for action in actions:
@@ -1955,6 +3571,7 @@ async def execute_actions(site: dict, site_id: str, workflow: dict, context: dic
                     success = await assign_conversation_via_api(site_id, conversation_id, agent_id, agent_token)
                     if success:
                         executed.append(f"assign_agent:{agent_id}")
+                        record_assignment(site, conversation_id, agent_id)
                         agent_name = site.get("agents", {}).get(agent_id, {}).get("username", agent_id)
                         await broadcast_to_agents(site, {
                             "type": "workflow_notification",
@@ -1993,11 +3610,12 @@ async def execute_actions(site: dict, site_id: str, workflow: dict, context: dic
                     executed.append("auto_close")
 
         except Exception as e:
-            print(f"Error executing action {action_type}: {e}")
+            workflow_log.error("Error executing action %s: %s", action_type, e)
 
     return executed
 
 
+@traced("workflows.evaluate")
 async def evaluate_workflows(site: dict, site_id: str, trigger_type: str, context: dict):
     """Evaluate and execute matching workflows"""
     workflows = site.get("workflows", [])
@@ -2013,10 +3631,10 @@ async def evaluate_workflows(site: dict, site_id: str, trigger_type: str, contex
     for workflow in matching:
         conditions = workflow.get("conditions", [])
         if evaluate_conditions(conditions, context):
-            print(f"Workflow '{workflow.get('name')}' matched for trigger '{trigger_type}'")
+            workflow_log.info("Workflow '%s' matched for trigger '%s'", workflow.get('name'), trigger_type)
             executed = await execute_actions(site, site_id, workflow, context)
             if executed:
-                print(f"  Actions executed: {executed}")
+                workflow_log.info("Workflow actions executed: %s", executed)
 
 
 async def start_idle_timer(site: dict, site_id: str, visitor_id: str, conversation_id: str, timeout_minutes: int = 5):
@@ -2043,15 +3661,26 @@ async def start_idle_timer(site: dict, site_id: str, visitor_id: str, conversati
     _idle_timers[timer_key] = asyncio.create_task(_idle_callback())
 
 
+def record_broadcast(kind: str, started: float, recipients: int, failures: int):
+    record_span(f"broadcast {kind}", started, {"broadcast.recipients": recipients, "broadcast.failures": failures})
+    observe("broadcast_seconds", time.perf_counter() - started, kind)
+    observe("broadcast_recipients", recipients, kind)
+    if failures:
+        inc_metric("broadcast_send_failures_total", kind, amount=failures)
+
+
 async def broadcast_to_admins(site: dict, message: dict):
     """Broadcast a message to all connected admins for a site"""
     admins_to_remove = []
+    encoded = {}
+    started = time.perf_counter()
     for admin_id, admin_ws in site.get("admins", {}).items():
         try:
-            await admin_ws.send_json(message)
+            await send_frame(admin_ws, message, encoded)
         except Exception as e:
-            print(f"Failed to send to admin {admin_id}: {e}")
+            send_log.warning("Failed to send to admin %s: %s", admin_id, e)
             admins_to_remove.append(admin_id)
+    record_broadcast("admins", started, len(site.get("admins", {})), len(admins_to_remove))
     # Remove disconnected admins
     for admin_id in admins_to_remove:
         site["admins"].pop(admin_id, None)
@@ -2059,17 +3688,24 @@ async def broadcast_to_admins(site: dict, message: dict):
 
 async def broadcast_to_agents(site: dict, message: dict, exclude_agent: str = None):
     """Broadcast a message to all connected agents for a site"""
+    message = log_agent_event(site, None, message, exclude_agent)
     agents_to_remove = []
+    encoded = {}
+    sent = 0
+    started = time.perf_counter()
     for agent_id, agent_data in site.get("agents", {}).items():
         if agent_id == exclude_agent:
             continue
+        sent += 1
         try:
-            await agent_data["ws"].send_json(message)
+            await send_frame(agent_data["ws"], message, encoded)
         except Exception as e:
-            print(f"Failed to send to agent {agent_id}: {e}")
+            send_log.warning("Failed to send to agent %s: %s", agent_id, e)
             agents_to_remove.append(agent_id)
+    record_broadcast("agents", started, sent, len(agents_to_remove))
     # Remove disconnected agents
     for agent_id in agents_to_remove:
+        unsubscribe_agent_all(site, agent_id)
         site["agents"].pop(agent_id, None)
 
 
@@ -2078,10 +3714,10 @@ async def send_to_agent(site: dict, agent_id: str, message: dict) -> bool:
     agent_data = site.get("agents", {}).get(agent_id)
     if agent_data:
         try:
-            await agent_data["ws"].send_json(message)
+            await send_frame(agent_data["ws"], message)
             return True
         except Exception as e:
-            print(f"Failed to send to agent {agent_id}: {e}")
+            send_log.warning("Failed to send to agent %s: %s", agent_id, e)
     return False
 
 
@@ -2098,947 +3734,2695 @@ def get_first_available_agent(site: dict) -> tuple:
     return None, None
 
 
-# ------------------ WEBSOCKET ------------------
-
-@app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    await ws.accept()
+# ------------------ WIRE PROTOCOL ------------------
 
-    site_id = ws.query_params.get("siteId")
-    role = ws.query_params.get("role")
-    visitor_id = ws.query_params.get("visitorId")
-    token = ws.query_params.get("token")
-    api_key = ws.query_params.get("apiKey")
+# /ws?protocol=json (default) | compact | msgpack. "compact" is JSON with the short keys and
+# numeric type codes below; "msgpack" is the same compact frame as binary MessagePack.
+# Only top-level keys are shortened, so payload objects (analysis, file, comment) are untouched.
+# The tables are append-only: clients fetch them from /api/ws/protocol.
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"  # under gunicorn, applied by worker.py
 
-    # -------- AUTH SUPPORT --------
-    auth = None
-    if role == SUPPORT:
-        # First try JWT validation (for tokens from .NET API)
-        auth = validate_jwt_token(token)
-        if not auth:
-            # Fall back to ACTIVE_TOKENS (for tokens from Python login)
-            auth = ACTIVE_TOKENS.get(token)
-        if not auth:
-            await ws.close()
-            return
+WIRE_KEYS = {
+    "type": "t", "message": "m", "visitorId": "v", "conversationId": "c", "from": "f",
+    "name": "n", "seq": "q", "timestamp": "ts", "status": "s", "agentName": "an",
+    "agentId": "ai", "username": "u", "userId": "ui", "analysis": "a", "file": "fl",
+    "email": "e", "intent": "i", "tags": "tg", "feature": "ft", "used": "us", "limit": "l",
+    "resumeToken": "rt", "resumed": "rs", "topics": "tp", "rejected": "rj", "comment": "cm",
+    "fromAgentId": "fai", "fromAgentName": "fan", "toAgentId": "tai", "rating": "r",
+    "feedback": "fb", "isWelcome": "w", "agents": "ag", "messages": "ms",
+    "analysis_enabled": "ae", "auto_reply_enabled": "are", "lastSeq": "ls",
+}
+WIRE_KEYS_REVERSE = {short: key for key, short in WIRE_KEYS.items()}
+WIRE_TYPES = [
+    "message", "typing_start", "typing_stop", "support_typing", "support_typing_stop",
+    "message_delivered", "messages_read", "analysis", "user_joined", "user_left",
+    "welcome_sent", "auto_reply_sent", "ai_usage_update", "ai_limit_reached", "agent_joined",
+    "agent_left", "agent_status_changed", "agent_status_broadcast", "support_joined",
+    "support_left", "conversation_updated", "csat_request", "csat_received",
+    "conversation_closed", "new_comment", "mention_notification", "agent_message",
+    "toggle_state", "online_agents_list", "session", "subscriptions", "ping", "pong", "init",
+    "get_state", "subscribe", "unsubscribe", "view_conversation",
+]
+WIRE_TYPE_CODES = {name: code for code, name in enumerate(WIRE_TYPES, start=1)}
+WIRE_PROTOCOLS = ["json", "compact"] + (["msgpack"] if msgpack else [])
+
+
+def compact_frame(message: dict) -> dict:
+    frame = {}
+    for key, value in message.items():
+        if key == "type":
+            value = WIRE_TYPE_CODES.get(value, value)
+        frame[WIRE_KEYS.get(key, key)] = value
+    return frame
+
+
+def expand_frame(frame: dict) -> dict:
+    message = {}
+    for key, value in frame.items():
+        key = WIRE_KEYS_REVERSE.get(key, key)
+        if key == "type" and isinstance(value, int) and 0 < value <= len(WIRE_TYPES):
+            value = WIRE_TYPES[value - 1]
+        message[key] = value
+    return message
+
+
+def encode_frame(protocol: str, message: dict):
+    if protocol == "compact":
+        return json.dumps(compact_frame(message), separators=(",", ":"), ensure_ascii=False)
+    if protocol == "msgpack":
+        return msgpack.packb(compact_frame(message), use_bin_type=True)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def ws_protocol(ws: WebSocket) -> str:
+    return getattr(ws.state, "protocol", "json")
+
+
+async def send_frame(ws: WebSocket, message: dict, encoded: dict = None):
+    """Send a frame in the socket's protocol; pass the same encoded dict across a fan-out to encode once per protocol"""
+    protocol = ws_protocol(ws)
+    if encoded is not None and protocol in encoded:
+        payload = encoded[protocol]
+    else:
+        payload = encode_frame(protocol, message)
+        if encoded is not None:
+            encoded[protocol] = payload
+    if isinstance(payload, bytes):
+        await ws.send_bytes(payload)
+    else:
+        await ws.send_text(payload)
+
+
+async def receive_frame(ws: WebSocket) -> dict:
+    """Receive and decode one client frame, raising WebSocketDisconnect when the peer is gone"""
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    protocol = ws_protocol(ws)
+    if message.get("bytes") is not None:
+        if protocol == "msgpack":
+            data = msgpack.unpackb(message["bytes"], raw=False)
+        else:
+            data = json.loads(message["bytes"])
+    else:
+        data = json.loads(message["text"])
+    return data if protocol == "json" else expand_frame(data)
 
-    # -------- AUTH CUSTOMER (API Key validation) --------
-    if role == CUSTOMER:
-        is_valid = await validate_api_key(site_id, api_key)
-        if not is_valid:
-            print(f"Invalid API key for site {site_id}")
-            await ws.close(code=4001, reason="Invalid API key")
-            return
 
-    # -------- INIT SITE --------
-    if site_id not in connections:
-        # Load toggle state from database
-        toggle_state = await load_site_toggle_state(site_id, token)
-        # Load workflows from database
-        site_workflows = await load_site_workflows(site_id, token) if token else []
-        connections[site_id] = {
-            "agents": {},  # agent_user_id -> {"ws": WebSocket, "username": str, "status": str, "token": str}
-            "supervisors": {},  # supervisor_user_id -> WebSocket
-            "customers": {},
-            "names": {},
-            "admins": {},  # admin user_id -> WebSocket
-            "analysis_enabled": toggle_state["analysis_enabled"],
-            "auto_reply_enabled": toggle_state["auto_reply_enabled"],
-            "agent_chats": {},  # Stores agent-to-agent chat messages
-            "workflows": site_workflows  # Automated workflows
-        }
+@app.get("/api/ws/protocol")
+async def get_ws_protocol():
+    """Key and type-code tables for the compact /ws protocols"""
+    return {
+        "protocols": WIRE_PROTOCOLS,
+        "keys": WIRE_KEYS,
+        "types": WIRE_TYPE_CODES
+    }
 
-    site = connections[site_id]
 
-    # -------- AUTH ADMIN --------
-    if role == ADMIN:
-        auth = validate_jwt_token(token)
-        if not auth:
-            auth = ACTIVE_TOKENS.get(token)
-        if not auth:
-            await ws.close()
-            return
+# ------------------ TOPIC SUBSCRIPTIONS ------------------
 
-    # -------- REGISTER ROLE --------
-    if role == SUPPORT:
-        agent_user_id = auth.get("user_id")
-        agent_username = auth["username"]
-        agent_role = auth.get("role", "agent")
+# Agent sockets subscribe to topics and events are routed through a topic -> subscribers
+# index, so an event costs O(subscribers) instead of O(agents on the site).
+#   "site"                 every conversation event on the site
+#   "supervisor"           same feed, restricted to supervisor roles
+#   "unassigned"           events for conversations nobody is assigned to yet
+#   "assigned"             events for conversations assigned to this agent
+#   "conversation:<id>"    events for one conversation (also set by view_conversation)
+# Agents whose client never sent a subscription message still receive everything (older dashboards).
+SITE_TOPIC = "site"
+SUPERVISOR_TOPIC = "supervisor"
+UNASSIGNED_TOPIC = "unassigned"
+SUPERVISOR_ROLES = ["admin", "site_admin", "supervisor", "super_admin"]
 
-        # Register agent in multi-agent structure
-        site["agents"][agent_user_id] = {
-            "ws": ws,
-            "username": agent_username,
-            "status": "online",
-            "token": token,
-            "role": agent_role
-        }
 
-        # Also register as supervisor if role allows
-        if agent_role in ["admin", "site_admin", "supervisor"]:
-            site["supervisors"][agent_user_id] = ws
+def conversation_topic(conversation_id: str) -> str:
+    return f"conversation:{conversation_id}"
 
-        # Update agent status to online via API
-        await update_agent_status(token, "online")
 
-        # Broadcast to admins that agent is online
-        await broadcast_to_admins(site, {
-            "type": "agent_online",
-            "userId": agent_user_id,
-            "username": agent_username,
-            "status": "online"
-        })
+def assigned_topic(agent_id: str) -> str:
+    return f"assigned:{agent_id}"
 
-        # Broadcast to other agents that this agent joined
-        await broadcast_to_agents(site, {
-            "type": "agent_joined",
-            "agentId": agent_user_id,
-            "username": agent_username,
-            "status": "online"
-        }, exclude_agent=agent_user_id)
-
-        # Send list of online agents to the newly connected agent
-        online_agents = {
-            aid: {"username": adata["username"], "status": adata["status"]}
-            for aid, adata in site["agents"].items()
-            if aid != agent_user_id
-        }
-        await ws.send_json({
-            "type": "online_agents_list",
-            "agents": online_agents
-        })
 
-        # Send current toggle states to the newly connected agent
-        await ws.send_json({
-            "type": "toggle_state",
-            "analysis_enabled": site["analysis_enabled"],
-            "auto_reply_enabled": site["auto_reply_enabled"]
-        })
+def resolve_client_topic(agent_id: str, agent_role: str, topic) -> str:
+    """Map a topic name sent by a client to the internal topic, or None if not allowed"""
+    if not isinstance(topic, str):
+        return None
+    if topic in (SITE_TOPIC, UNASSIGNED_TOPIC):
+        return topic
+    if topic == "assigned":
+        return assigned_topic(agent_id)
+    if topic == SUPERVISOR_TOPIC:
+        return topic if agent_role in SUPERVISOR_ROLES else None
+    if topic.startswith("conversation:") and len(topic) > len("conversation:"):
+        return topic
+    return None
 
-        # Notify existing customers that support is available
-        for vid, cws in site["customers"].items():
-            visitor_data = VISITOR_DATA.get(vid, {})
-            await ws.send_json({
-                "type": "user_joined",
-                "visitorId": vid,
-                "name": site["names"].get(vid, vid),
-                "conversationId": visitor_data.get("conversation_id")
-            })
 
-        # Notify customers support joined with status
-        for cws in site["customers"].values():
-            await cws.send_json({
-                "type": "support_joined",
-                "name": agent_username
-            })
-            await cws.send_json({
-                "type": "agent_status_broadcast",
-                "status": "online",
-                "agentName": agent_username
-            })
+def client_topics(agent_id: str, agent_data: dict) -> list:
+    """Topics an agent is subscribed to, as the client names them"""
+    own_assigned = assigned_topic(agent_id)
+    return sorted("assigned" if topic == own_assigned else topic for topic in agent_data["topics"])
 
-    elif role == CUSTOMER:
-        site["customers"][visitor_id] = ws
 
-    elif role == ADMIN:
-        admin_id = auth.get("user_id", token)
-        site["admins"][admin_id] = ws
+def subscribe_agent(site: dict, agent_id: str, topic: str):
+    agent_data = site["agents"].get(agent_id)
+    if not agent_data:
+        return
+    site["topics"].setdefault(topic, set()).add(agent_id)
+    agent_data["topics"].add(topic)
 
-        # Send current agents status to admin
-        for agent_id, agent_data in site.get("agents", {}).items():
-            await ws.send_json({
-                "type": "agent_online",
-                "userId": agent_id,
-                "username": agent_data.get("username"),
-                "status": agent_data.get("status", "online")
-            })
 
-    else:
-        await ws.close()
+def unsubscribe_agent(site: dict, agent_id: str, topic: str):
+    subscribers = site["topics"].get(topic)
+    if subscribers:
+        subscribers.discard(agent_id)
+        if not subscribers:
+            site["topics"].pop(topic, None)
+    agent_data = site["agents"].get(agent_id)
+    if agent_data:
+        agent_data["topics"].discard(topic)
+        agent_data["explicit_topics"].discard(topic)
+
+
+def unsubscribe_agent_all(site: dict, agent_id: str):
+    agent_data = site["agents"].get(agent_id)
+    for topic in list(agent_data["topics"]) if agent_data else []:
+        unsubscribe_agent(site, agent_id, topic)
+    site["untargeted_agents"].discard(agent_id)
+
+
+def update_agent_topics(site: dict, agent_id: str, topics: list, subscribe: bool) -> list:
+    """Apply a client subscribe/unsubscribe request, returning the topic names that were rejected"""
+    agent_data = site["agents"].get(agent_id)
+    if not agent_data:
+        return []
+    site["untargeted_agents"].discard(agent_id)
+    rejected = []
+    for name in topics if isinstance(topics, list) else [topics]:
+        topic = resolve_client_topic(agent_id, agent_data.get("role"), name)
+        if topic is None:
+            rejected.append(name)
+        elif subscribe:
+            subscribe_agent(site, agent_id, topic)
+            agent_data["explicit_topics"].add(topic)
+        else:
+            unsubscribe_agent(site, agent_id, topic)
+    return rejected
+
+
+def set_agent_viewing(site: dict, agent_id: str, conversation_id: str):
+    """Move an agent's "open conversation" subscription to conversation_id (None = nothing open)"""
+    agent_data = site["agents"].get(agent_id)
+    if not agent_data:
         return
+    site["untargeted_agents"].discard(agent_id)
+    previous = agent_data.get("viewing")
+    if previous and previous != conversation_id and conversation_topic(previous) not in agent_data["explicit_topics"]:
+        unsubscribe_agent(site, agent_id, conversation_topic(previous))
+    agent_data["viewing"] = conversation_id
+    if conversation_id:
+        subscribe_agent(site, agent_id, conversation_topic(conversation_id))
+
+
+def record_assignment(site: dict, conversation_id: str, agent_id: str):
+    """Remember which agent a conversation is assigned to (routes the "assigned"/"unassigned" topics)"""
+    if conversation_id and agent_id:
+        site["assignments"][conversation_id] = agent_id
+
+
+def conversation_topics(site: dict, conversation_id: str) -> list:
+    """Topics that receive events for a conversation"""
+    topics = [SITE_TOPIC, SUPERVISOR_TOPIC]
+    assignee = site["assignments"].get(conversation_id) if conversation_id else None
+    if conversation_id:
+        topics.append(conversation_topic(conversation_id))
+    topics.append(assigned_topic(assignee) if assignee else UNASSIGNED_TOPIC)
+    return topics
+
+
+def visitor_conversation_id(visitor_id: str) -> str:
+    return VISITOR_DATA.get(visitor_id, {}).get("conversation_id")
+
+
+async def publish_to_topics(site: dict, topics: list, message: dict, exclude_agent: str = None):
+    """Send a message to the agents subscribed to any of the topics (plus agents without subscriptions)"""
+    message = log_agent_event(site, topics, message, exclude_agent)
+    index = site["topics"]
+    recipients = set(site["untargeted_agents"])
+    for topic in topics:
+        subscribers = index.get(topic)
+        if subscribers:
+            recipients |= subscribers
+    agents_to_remove = []
+    encoded = {}
+    sent = 0
+    started = time.perf_counter()
+    for agent_id in recipients:
+        if agent_id == exclude_agent:
+            continue
+        agent_data = site["agents"].get(agent_id)
+        if not agent_data:
+            continue
+        sent += 1
+        try:
+            await send_frame(agent_data["ws"], message, encoded)
+        except Exception as e:
+            send_log.warning("Failed to send to agent %s: %s", agent_id, e)
+            agents_to_remove.append(agent_id)
+    record_broadcast("topics", started, sent, len(agents_to_remove))
+    # Remove disconnected agents
+    for agent_id in agents_to_remove:
+        unsubscribe_agent_all(site, agent_id)
+        site["agents"].pop(agent_id, None)
 
-    # -------- MESSAGE LOOP --------
-    try:
-        while True:
-            data = await ws.receive_json()
-
-            # ----- STATE REQUEST -----
-            if data.get("type") == "get_state" and role == CUSTOMER:
-                # Notify customer about available agents
-                first_agent_id, first_agent = get_first_available_agent(site)
-                if first_agent:
-                    await ws.send_json({
-                        "type": "support_joined",
-                        "name": first_agent.get("username", "Support")
-                    })
-                    # Also send current agent status
-                    await ws.send_json({
-                        "type": "agent_status_broadcast",
-                        "status": first_agent.get("status", "online"),
-                        "agentName": first_agent.get("username", "Support")
-                    })
 
-            # ----- INIT USER -----
-            elif data.get("type") == "init" and role == CUSTOMER:
-                name = data.get("name", visitor_id)
-                email = data.get("email")
-                intent = data.get("intent", "")
-                print(f"[DEBUG] Init received - name: {name}, intent: {intent}")
-                site["names"][visitor_id] = name
-
-                # Initialize chat session with API (creates visitor & conversation)
-                chat_data = await init_chat_session(site_id, visitor_id, name, email)
-                conversation_id = None
-                if chat_data:
-                    conversation_id = chat_data.get("conversationId")
-                    print(f"[DEBUG] Conversation created: {conversation_id}")
-                    VISITOR_DATA[visitor_id] = {
-                        "internal_visitor_id": chat_data.get("visitorId"),
-                        "conversation_id": conversation_id
-                    }
+async def publish_conversation_event(site: dict, conversation_id: str, message: dict, exclude_agent: str = None):
+    """Send a conversation-scoped event (message, typing, analysis, ...) to its subscribers"""
+    await publish_to_topics(site, conversation_topics(site, conversation_id), message, exclude_agent)
 
-                    # Add intent as tag if provided
-                    if intent and conversation_id:
-                        print(f"[DEBUG] Adding intent tag: {intent} to conversation: {conversation_id}")
-                        await add_intent_tag(site_id, conversation_id, intent, site)
-                    else:
-                        print(f"[DEBUG] Skipping intent tag - intent: '{intent}', conversation_id: {conversation_id}")
-                else:
-                    print(f"[DEBUG] chat_data is None or empty")
 
-                # Notify all agents about user joined (include intent as tag)
-                await broadcast_to_agents(site, {
-                    "type": "user_joined",
-                    "visitorId": visitor_id,
-                    "name": name,
-                    "email": email,
-                    "conversationId": conversation_id,
-                    "intent": intent,
-                    "tags": [intent] if intent else []
+async def publish_site_event(site: dict, message: dict, exclude_agent: str = None):
+    """Send a site-wide event (AI usage, workflow notifications) to the site and supervisor feeds"""
+    await publish_to_topics(site, [SITE_TOPIC, SUPERVISOR_TOPIC], message, exclude_agent)
+
+
+# ------------------ SESSION RESUME ------------------
+
+# Every agent/customer socket gets a resume token in a "session" frame. Reconnecting with
+# ?resume=<token>&lastSeq=<n> replays only the frames sent after seq n, and a customer keeps
+# its conversation. Departures (user_left / agent offline) wait out a grace period so a
+# network blip is invisible to everyone else.
+RESUME_LOG_SIZE = int(os.getenv("RESUME_LOG_SIZE", "500"))  # agent frames kept per site for replay
+RESUME_CUSTOMER_LOG_SIZE = int(os.getenv("RESUME_CUSTOMER_LOG_SIZE", "50"))  # frames kept per visitor
+RESUME_GRACE_SECONDS = float(os.getenv("RESUME_GRACE_SECONDS", "60"))  # 0 = depart immediately
+
+# resume token -> {"key": (site_id, role, principal), "seq": int, "log": deque, "state": dict, "departure": Task}
+_resume_sessions = {}
+# (site_id, role, principal) -> current resume token
+_resume_tokens = {}
+
+
+def open_resume_session(site_id: str, role: str, principal: str, resume_token: str = None):
+    """Return (token, session, resumed) for a connecting socket, resuming resume_token if it is still valid"""
+    key = (site_id, role, principal)
+    session = _resume_sessions.get(resume_token) if resume_token else None
+    if session and session["key"] == key:
+        if session["departure"]:
+            session["departure"].cancel()
+            session["departure"] = None
+        return resume_token, session, True
+
+    # Fresh session; a pending departure of an older one finds the principal connected and does nothing
+    session_token = secrets.token_urlsafe(24)
+    session = {
+        "key": key,
+        "seq": 0,
+        "log": deque(maxlen=RESUME_CUSTOMER_LOG_SIZE) if role == CUSTOMER else None,
+        "state": {},
+        "departure": None
+    }
+    _resume_sessions[session_token] = session
+    _resume_tokens[key] = session_token
+    return session_token, session, False
+
+
+def close_resume_session(session_token: str):
+    session = _resume_sessions.pop(session_token, None)
+    if session and _resume_tokens.get(session["key"]) == session_token:
+        _resume_tokens.pop(session["key"], None)
+
+
+async def _depart_later(session_token: str, finalize):
+    try:
+        await asyncio.sleep(RESUME_GRACE_SECONDS)
+    except asyncio.CancelledError:
+        return
+    session = _resume_sessions.get(session_token)
+    if session is None or session["departure"] is not asyncio.current_task():
+        return
+    close_resume_session(session_token)
+    await finalize()
+
+
+async def schedule_departure(session_token: str, finalize):
+    """Run finalize (user_left / agent offline) after the grace period unless the session resumes"""
+    session = _resume_sessions.get(session_token)
+    if session is None or RESUME_GRACE_SECONDS <= 0:
+        close_resume_session(session_token)
+        await finalize()
+        return
+    if session["departure"]:
+        session["departure"].cancel()
+    session["departure"] = asyncio.ensure_future(_depart_later(session_token, finalize))
+
+
+def log_agent_event(site: dict, topics, message: dict, exclude_agent: str = None) -> dict:
+    """Keep a copy of an agent-bound frame, stamped with the site's next seq, for replay (topics None = everyone)"""
+    site["event_seq"] += 1
+    # The caller's dict is often reused for other recipients, so it is left untouched
+    message = {**message, "seq": site["event_seq"]}
+    site["event_log"].append((site["event_seq"], topics, exclude_agent, message))
+    return message
+
+
+async def replay_agent_events(site: dict, agent_id: str, last_seq, head_seq: int) -> bool:
+    """Send an agent the logged frames in (last_seq, head_seq]; False if they are no longer all available"""
+    try:
+        last_seq = int(last_seq)
+    except (TypeError, ValueError):
+        return False
+    log = site["event_log"]
+    first_seq = log[0][0] if log else head_seq + 1
+    if last_seq > head_seq or last_seq < first_seq - 1:
+        return False  # seq from an older site instance, or the log has wrapped past it
+
+    agent_data = site["agents"].get(agent_id)
+    if not agent_data:
+        return False
+    untargeted = agent_id in site["untargeted_agents"]
+    for seq, topics, exclude_agent, message in list(log):
+        if seq <= last_seq or exclude_agent == agent_id:
+            continue
+        if seq > head_seq:
+            break
+        if topics is None or untargeted or not agent_data["topics"].isdisjoint(topics):
+            await send_frame(agent_data["ws"], message)
+    return True
+
+
+def save_agent_subscriptions(site: dict, agent_id: str) -> dict:
+    agent_data = site["agents"].get(agent_id, {})
+    return {
+        "topics": set(agent_data.get("topics", ())),
+        "explicit_topics": set(agent_data.get("explicit_topics", ())),
+        "viewing": agent_data.get("viewing"),
+        "untargeted": agent_id in site["untargeted_agents"]
+    }
+
+
+def restore_agent_subscriptions(site: dict, agent_id: str, state: dict):
+    agent_data = site["agents"].get(agent_id)
+    if not agent_data or not state:
+        return
+    if not state["untargeted"]:
+        site["untargeted_agents"].discard(agent_id)
+    for topic in state["topics"]:
+        subscribe_agent(site, agent_id, topic)
+    agent_data["explicit_topics"] = set(state["explicit_topics"])
+    agent_data["viewing"] = state["viewing"]
+
+
+async def send_to_customer(site: dict, site_id: str, visitor_id: str, message: dict) -> bool:
+    """Send a frame to a customer, keeping it for replay if the customer reconnects"""
+    session = _resume_sessions.get(_resume_tokens.get((site_id, CUSTOMER, visitor_id)))
+    if session:
+        session["seq"] += 1
+        message = {**message, "seq": session["seq"]}
+        session["log"].append((session["seq"], message))
+    customer_ws = site["customers"].get(visitor_id)
+    if not customer_ws:
+        return False
+    try:
+        await send_frame(customer_ws, message)
+        return True
+    except Exception as e:
+        send_log.warning("Failed to send to customer %s: %s", visitor_id, e)
+        return False
+
+
+async def replay_customer_events(session: dict, ws: WebSocket, last_seq):
+    """Send a resumed customer the frames it has not seen"""
+    try:
+        last_seq = int(last_seq)
+    except (TypeError, ValueError):
+        last_seq = 0
+    for seq, message in list(session["log"]):
+        if seq > last_seq:
+            await send_frame(ws, message)
+
+
+async def send_agent_snapshot(site: dict, ws: WebSocket, agent_id: str):
+    """Full state for an agent socket that could not resume: online agents, toggles, connected customers"""
+    # Send list of online agents to the newly connected agent
+    online_agents = {
+        aid: {"username": adata["username"], "status": adata["status"]}
+        for aid, adata in site["agents"].items()
+        if aid != agent_id
+    }
+    await send_frame(ws, {
+        "type": "online_agents_list",
+        "agents": online_agents
+    })
+
+    # Send current toggle states to the newly connected agent
+    await send_frame(ws, {
+        "type": "toggle_state",
+        "analysis_enabled": site["analysis_enabled"],
+        "auto_reply_enabled": site["auto_reply_enabled"]
+    })
+
+    # Notify existing customers that support is available
+    for vid, cws in site["customers"].items():
+        visitor_data = VISITOR_DATA.get(vid, {})
+        await send_frame(ws, {
+            "type": "user_joined",
+            "visitorId": vid,
+            "name": site["names"].get(vid, vid),
+            "conversationId": visitor_data.get("conversation_id")
+        })
+
+
+async def finalize_customer_departure(site: dict, site_id: str, visitor_id: str):
+    """The customer is gone for good: forget the conversation binding and tell agents"""
+    if visitor_id in site["customers"]:
+        return  # reconnected without resuming
+    site["names"].pop(visitor_id, None)
+    conversation_id = VISITOR_DATA.pop(visitor_id, {}).get("conversation_id")
+
+    # Notify agents that user left
+    await publish_conversation_event(site, conversation_id, {
+        "type": "user_left",
+        "visitorId": visitor_id
+    })
+    site["assignments"].pop(conversation_id, None)
+
+
+async def finalize_agent_departure(site: dict, agent_user_id: str, agent_username: str, agent_token: str):
+    """The agent is gone for good: mark them offline and tell admins, agents and customers"""
+    if agent_user_id in site["agents"]:
+        return  # reconnected without resuming
+
+    # Update agent status to offline via API
+    if agent_token:
+        await update_agent_status(agent_token, "offline")
+
+    # Broadcast to admins that agent is offline
+    await broadcast_to_admins(site, {
+        "type": "agent_offline",
+        "userId": agent_user_id,
+        "username": agent_username,
+        "status": "offline"
+    })
+
+    # Broadcast to other agents that this agent left
+    await broadcast_to_agents(site, {
+        "type": "agent_left",
+        "agentId": agent_user_id,
+        "username": agent_username
+    }, exclude_agent=agent_user_id)
+
+    # Notify customers only if no agents remain
+    if not site["agents"]:
+        for cvisitor_id, cws in list(site["customers"].items()):
+            try:
+                await send_frame(cws, {
+                    "type": "support_left"
                 })
+            except Exception as e:
+                # Runs from the agent's socket teardown; one closing customer socket must not stop the rest
+                send_log.warning("Failed to send to customer %s: %s", cvisitor_id, e)
+
+
+# ------------------ HEARTBEAT ------------------
+
+# Protocol-level pings (uvicorn ws_ping_interval/ws_ping_timeout) catch most dead peers. As a
+# fallback, every frame a client sends counts as a heartbeat; quiet sockets get an app-level
+# {"type": "ping"} and one reaper task closes sockets that stay silent past their role's
+# timeout, which runs the normal disconnect path. Only clients that have shown they answer
+# pings (sent a ping or pong) are reaped, so older widgets are left to the protocol pings.
+# Protocol ping interval / pong timeout. Under gunicorn they reach uvicorn via worker.py
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+HEARTBEAT_SWEEP_SECONDS = float(os.getenv("HEARTBEAT_SWEEP_SECONDS", "10"))
+HEARTBEAT_TIMEOUTS = {
+    CUSTOMER: float(os.getenv("HEARTBEAT_TIMEOUT_CUSTOMER", "60")),
+    SUPPORT: float(os.getenv("HEARTBEAT_TIMEOUT_SUPPORT", "90")),  # Support.html pings every 30s
+    ADMIN: float(os.getenv("HEARTBEAT_TIMEOUT_ADMIN", "120")),
+}
+HEARTBEAT_CLOSE_CODE = 4008
+
+# id(ws) -> {"ws", "role", "last_seen", "pinged": bool, "answers_pings": bool, "reaped": bool}
+_heartbeats = {}
+_heartbeat_task = None
 
-                # Send welcome message to customer
-                await send_welcome_message(site_id, visitor_id, conversation_id, ws, site)
 
-                # Evaluate customer_join workflows
-                await evaluate_workflows(site, site_id, "customer_join", {
+def track_heartbeat(ws: WebSocket, role: str):
+    _heartbeats[id(ws)] = {
+        "ws": ws,
+        "role": role,
+        "last_seen": time.monotonic(),
+        "pinged": False,
+        "answers_pings": False,
+        "reaped": False
+    }
+
+
+def untrack_heartbeat(ws: WebSocket):
+    _heartbeats.pop(id(ws), None)
+
+
+def touch_heartbeat(ws: WebSocket, frame_type: str = None):
+    """Record activity on a socket; ping/pong frames also mark the client as heartbeat-aware"""
+    conn = _heartbeats.get(id(ws))
+    if conn:
+        conn["last_seen"] = time.monotonic()
+        conn["pinged"] = False
+        if frame_type in ("ping", "pong"):
+            conn["answers_pings"] = True
+
+
+def heartbeat_reaped(ws: WebSocket) -> bool:
+    conn = _heartbeats.get(id(ws))
+    return bool(conn and conn["reaped"])
+
+
+async def _reap_socket(conn: dict, idle: float):
+    heartbeat_log.info("Reaping silent %s socket (idle %.0fs)", conn['role'], idle)
+    try:
+        await conn["ws"].close(code=HEARTBEAT_CLOSE_CODE, reason="heartbeat timeout")
+    except Exception as e:
+        heartbeat_log.warning("Failed to close silent %s socket: %s", conn['role'], e)
+
+
+async def _ping_socket(conn: dict):
+    try:
+        await send_frame(conn["ws"], {"type": "ping"})
+    except Exception as e:
+        heartbeat_log.warning("Failed to ping %s socket: %s", conn['role'], e)
+
+
+def _sweep_heartbeats():
+    """Ping quiet sockets and reap silent ones (each in its own task so a stuck peer can't stall the sweep)"""
+    now = time.monotonic()
+    for conn in list(_heartbeats.values()):
+        if conn["reaped"]:
+            continue
+        timeout = HEARTBEAT_TIMEOUTS.get(conn["role"], HEARTBEAT_TIMEOUTS[CUSTOMER])
+        idle = now - conn["last_seen"]
+        if idle > timeout and conn["answers_pings"]:
+            conn["reaped"] = True
+            run_in_background(_reap_socket(conn, idle))
+        elif idle > timeout / 2 and not conn["pinged"]:
+            conn["pinged"] = True
+            run_in_background(_ping_socket(conn))
+
+
+async def _heartbeat_loop():
+    while True:
+        await asyncio.sleep(HEARTBEAT_SWEEP_SECONDS)
+        try:
+            _sweep_heartbeats()
+        except Exception as e:
+            heartbeat_log.error("Heartbeat sweep error: %s", e)
+
+
+@app.on_event("startup")
+async def start_heartbeat_reaper():
+    global _heartbeat_task
+    _heartbeat_task = asyncio.ensure_future(_heartbeat_loop())
+
+
+@app.on_event("shutdown")
+async def stop_heartbeat_reaper():
+    if _heartbeat_task:
+        _heartbeat_task.cancel()
+
+
+# ------------------ TYPING INDICATORS ------------------
+
+# Typing is tracked per (visitor, direction) and only state transitions are relayed.
+# "customer" = the visitor typing to agents, "support" = agents typing to the visitor.
+TYPING_COALESCE_SECONDS = float(os.getenv("TYPING_COALESCE_SECONDS", "1.0"))  # stop->start flaps inside this window are dropped
+TYPING_EXPIRE_SECONDS = float(os.getenv("TYPING_EXPIRE_SECONDS", "6"))  # "typing" with no refresh for this long is stopped
+
+# (site_id, visitor_id, direction) -> {"typing": bool, "timer": asyncio.Task}
+_typing_states = {}
+
+
+async def _emit_typing(site: dict, visitor_id: str, direction: str, typing: bool):
+    if direction == "customer":
+        conversation_id = visitor_conversation_id(visitor_id)
+        if typing:
+            await publish_conversation_event(site, conversation_id, {
+                "type": "typing_start",
+                "visitorId": visitor_id,
+                "name": site["names"].get(visitor_id, visitor_id)
+            })
+        else:
+            await publish_conversation_event(site, conversation_id, {
+                "type": "typing_stop",
+                "visitorId": visitor_id
+            })
+    else:
+        customer_ws = site["customers"].get(visitor_id)
+        if customer_ws:
+            try:
+                await send_frame(customer_ws, {"type": "support_typing" if typing else "support_typing_stop"})
+            except Exception as e:
+                send_log.warning("Failed to send typing state to customer %s: %s", visitor_id, e)
+
+
+async def _typing_timeout(site: dict, key: tuple, delay: float):
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        return
+    state = _typing_states.get(key)
+    if state is None or state["timer"] is not asyncio.current_task():
+        return
+    _typing_states.pop(key, None)
+    if state["typing"]:
+        await _emit_typing(site, key[1], key[2], False)
+
+
+async def update_typing_state(site: dict, site_id: str, visitor_id: str, direction: str, typing: bool):
+    """Record a typing_start/typing_stop frame, relaying it only if the visible state changes"""
+    key = (site_id, visitor_id, direction)
+    state = _typing_states.get(key)
+    if state is None:
+        if not typing:
+            return  # already stopped
+        state = _typing_states[key] = {"typing": False, "timer": None}
+    if state["timer"]:
+        state["timer"].cancel()
+
+    if typing:
+        # Refresh the server-side expiry; repeats (and a start cancelling a pending stop) emit nothing
+        state["timer"] = asyncio.ensure_future(_typing_timeout(site, key, TYPING_EXPIRE_SECONDS))
+        if not state["typing"]:
+            state["typing"] = True
+            await _emit_typing(site, visitor_id, direction, True)
+    else:
+        # Hold the stop briefly so a quick restart cancels it
+        state["timer"] = asyncio.ensure_future(_typing_timeout(site, key, TYPING_COALESCE_SECONDS))
+
+
+def clear_typing_states(site_id: str, visitor_id: str):
+    """Forget typing state for a visitor without relaying anything"""
+    for direction in ("customer", "support"):
+        state = _typing_states.pop((site_id, visitor_id, direction), None)
+        if state and state["timer"]:
+            state["timer"].cancel()
+
+
+# ------------------ READ RECEIPTS ------------------
+
+# Delivery/read receipts are merged into a high-water mark per (visitor, direction)
+# and flushed at most once per window as a single frame.
+# "to_agents" = receipts from the visitor, "to_customer" = receipts from agents.
+RECEIPT_FLUSH_SECONDS = float(os.getenv("RECEIPT_FLUSH_SECONDS", "0.25"))
+
+# (site_id, visitor_id, direction) -> {"delivered": ts, "read": ts, "timer": asyncio.Task}
+_receipt_states = {}
+
+
+def _later_timestamp(current, candidate):
+    """Max of two client timestamps; falls back to the newest one received if they don't compare"""
+    if current is None:
+        return candidate
+    if candidate is None:
+        return current
+    try:
+        return candidate if candidate > current else current
+    except TypeError:
+        return candidate
+
+
+async def _flush_receipts(site: dict, key: tuple):
+    try:
+        await asyncio.sleep(RECEIPT_FLUSH_SECONDS)
+    except asyncio.CancelledError:
+        return
+    state = _receipt_states.pop(key, None)
+    if not state:
+        return
+    site_id, visitor_id, direction = key
+
+    # Read implies delivered, so a window with any read sends only the read receipt
+    if state["read"] is not None:
+        receipt_type, timestamp = "messages_read", state["read"]
+    else:
+        receipt_type, timestamp = "message_delivered", state["delivered"]
+
+    if direction == "to_agents":
+        await publish_conversation_event(site, visitor_conversation_id(visitor_id), {
+            "type": receipt_type,
+            "from": visitor_id,
+            "visitorId": visitor_id,
+            "timestamp": timestamp
+        })
+    else:
+        await send_to_customer(site, site_id, visitor_id, {
+            "type": receipt_type,
+            "from": "support",
+            "timestamp": timestamp
+        })
+
+
+def record_receipt(site: dict, site_id: str, visitor_id: str, direction: str, kind: str, timestamp):
+    """Merge a delivered/read receipt into the pending window for this visitor and direction"""
+    key = (site_id, visitor_id, direction)
+    state = _receipt_states.get(key)
+    if state is None:
+        state = _receipt_states[key] = {"delivered": None, "read": None}
+        state["timer"] = asyncio.ensure_future(_flush_receipts(site, key))
+    state[kind] = _later_timestamp(state[kind], timestamp)
+
+
+def clear_receipts(site_id: str, visitor_id: str):
+    for direction in ("to_agents", "to_customer"):
+        state = _receipt_states.pop((site_id, visitor_id, direction), None)
+        if state:
+            state["timer"].cancel()
+
+
+# ------------------ AGENT CHAT STORE ------------------
+
+# Agent-to-agent messages live in SQLite; the most recent messages of each pair are
+# also kept in a bounded in-memory ring buffer so typical history requests skip the disk.
+AGENT_CHAT_DB_PATH = os.getenv("AGENT_CHAT_DB_PATH", str(BASE_DIR / "data" / "agent_chats.db"))
+AGENT_CHAT_BUFFER_SIZE = int(os.getenv("AGENT_CHAT_BUFFER_SIZE", "100"))  # per pair, in memory
+AGENT_CHAT_MAX_PER_PAIR = int(os.getenv("AGENT_CHAT_MAX_PER_PAIR", "2000"))  # per pair, on disk
+AGENT_CHAT_RETENTION_DAYS = float(os.getenv("AGENT_CHAT_RETENTION_DAYS", "90"))
+AGENT_CHAT_PAGE_SIZE = int(os.getenv("AGENT_CHAT_PAGE_SIZE", "50"))
+
+_agent_chat_db = None
+_agent_chat_db_lock = threading.Lock()
+# Serializes appends so buffer order always matches row ids
+_agent_chat_write_lock = asyncio.Lock()
+# (site_id, pair_key) -> deque of the newest messages, oldest first
+_agent_chat_buffers = {}
+_agent_chat_retention_task = None
+
+
+def _agent_chat_connection():
+    global _agent_chat_db
+    if _agent_chat_db is None:
+        try:
+            Path(AGENT_CHAT_DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+            _agent_chat_db = sqlite3.connect(AGENT_CHAT_DB_PATH, check_same_thread=False)
+            _agent_chat_db.execute("PRAGMA journal_mode=WAL")
+        except Exception as e:
+            # May fail on read-only filesystems - keep history for the life of the process
+            store_log.error("Agent chat store unavailable at %s, using memory: %s", AGENT_CHAT_DB_PATH, e)
+            _agent_chat_db = sqlite3.connect(":memory:", check_same_thread=False)
+        _agent_chat_db.execute("""
+            CREATE TABLE IF NOT EXISTS agent_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                site_id TEXT NOT NULL,
+                pair_key TEXT NOT NULL,
+                from_id TEXT,
+                from_name TEXT,
+                to_id TEXT,
+                message TEXT,
+                timestamp TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        _agent_chat_db.execute("CREATE INDEX IF NOT EXISTS ix_agent_messages_pair ON agent_messages (site_id, pair_key, id)")
+        _agent_chat_db.commit()
+    return _agent_chat_db
+
+
+def _agent_chat_query(sql: str, params: tuple = (), commit: bool = False):
+    """Run a statement against the store (called from a worker thread)"""
+    with _agent_chat_db_lock:
+        db = _agent_chat_connection()
+        cursor = db.execute(sql, params)
+        rows = cursor.fetchall()
+        if commit:
+            db.commit()
+        return rows, cursor.lastrowid
+
+
+def agent_chat_pair_key(agent_a: str, agent_b: str) -> str:
+    return "|".join(sorted([str(agent_a), str(agent_b)]))
+
+
+def _agent_chat_row(row) -> dict:
+    return {
+        "id": row[0],
+        "from": row[1],
+        "fromName": row[2],
+        "to": row[3],
+        "message": row[4],
+        "timestamp": row[5]
+    }
+
+
+async def _agent_chat_buffer(site_id: str, pair_key: str) -> deque:
+    key = (site_id, pair_key)
+    buffer = _agent_chat_buffers.get(key)
+    if buffer is None:
+        rows, _ = await asyncio.to_thread(
+            _agent_chat_query,
+            "SELECT id, from_id, from_name, to_id, message, timestamp FROM agent_messages "
+            "WHERE site_id = ? AND pair_key = ? ORDER BY id DESC LIMIT ?",
+            (site_id, pair_key, AGENT_CHAT_BUFFER_SIZE)
+        )
+        buffer = _agent_chat_buffers.setdefault(key, deque((_agent_chat_row(r) for r in reversed(rows)), maxlen=AGENT_CHAT_BUFFER_SIZE))
+    return buffer
+
+
+async def append_agent_chat(site_id: str, from_id: str, from_name: str, to_id: str, message: str, timestamp) -> dict:
+    """Persist an agent-to-agent message and add it to the pair's ring buffer"""
+    pair_key = agent_chat_pair_key(from_id, to_id)
+    async with _agent_chat_write_lock:
+        buffer = await _agent_chat_buffer(site_id, pair_key)
+        _, row_id = await asyncio.to_thread(
+            _agent_chat_query,
+            "INSERT INTO agent_messages (site_id, pair_key, from_id, from_name, to_id, message, timestamp, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (site_id, pair_key, from_id, from_name, to_id, message, None if timestamp is None else str(timestamp), time.time()),
+            True
+        )
+        msg_obj = {
+            "id": row_id,
+            "from": from_id,
+            "fromName": from_name,
+            "to": to_id,
+            "message": message,
+            "timestamp": timestamp
+        }
+        buffer.append(msg_obj)
+
+    # Trim the pair on disk now and then rather than on every insert
+    if row_id % 100 == 0:
+        await asyncio.to_thread(
+            _agent_chat_query,
+            "DELETE FROM agent_messages WHERE site_id = ? AND pair_key = ? AND id <= ("
+            "SELECT id FROM agent_messages WHERE site_id = ? AND pair_key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (site_id, pair_key, site_id, pair_key, AGENT_CHAT_MAX_PER_PAIR),
+            True
+        )
+    return msg_obj
+
+
+async def get_agent_chat_page(site_id: str, agent_a: str, agent_b: str, before: int = None, limit: int = None) -> tuple:
+    """Return (messages oldest-first, next_cursor) for a pair, newest page first.
+
+    next_cursor is the id to pass as `before` for the previous page, or None at the start.
+    """
+    limit = max(1, min(limit or AGENT_CHAT_PAGE_SIZE, 200))
+    pair_key = agent_chat_pair_key(agent_a, agent_b)
+    buffer = await _agent_chat_buffer(site_id, pair_key)
+
+    # Serve from memory when the page lies entirely inside the ring buffer
+    candidates = [m for m in buffer if before is None or m["id"] < before]
+    buffer_holds_start = len(buffer) < AGENT_CHAT_BUFFER_SIZE  # a short buffer is the whole history
+    if len(candidates) > limit or buffer_holds_start:
+        page = candidates[-limit:]
+        has_more = len(candidates) > limit
+        return page, (page[0]["id"] if has_more and page else None)
+
+    rows, _ = await asyncio.to_thread(
+        _agent_chat_query,
+        "SELECT id, from_id, from_name, to_id, message, timestamp FROM agent_messages "
+        "WHERE site_id = ? AND pair_key = ? AND id < ? ORDER BY id DESC LIMIT ?",
+        (site_id, pair_key, before if before is not None else 2 ** 62, limit + 1)
+    )
+    has_more = len(rows) > limit
+    page = [_agent_chat_row(r) for r in reversed(rows[:limit])]
+    return page, (page[0]["id"] if has_more and page else None)
+
+
+def drop_agent_chat_buffers(site_id: str):
+    for key in [k for k in _agent_chat_buffers if k[0] == site_id]:
+        _agent_chat_buffers.pop(key, None)
+
+
+async def prune_agent_chats():
+    """Apply the retention window to the on-disk store"""
+    cutoff = time.time() - AGENT_CHAT_RETENTION_DAYS * 86400
+    await asyncio.to_thread(_agent_chat_query, "DELETE FROM agent_messages WHERE created_at < ?", (cutoff,), True)
+    _agent_chat_buffers.clear()
+
+
+async def _agent_chat_retention_loop():
+    while True:
+        try:
+            await prune_agent_chats()
+        except Exception as e:
+            store_log.error("Agent chat retention error: %s", e)
+        await asyncio.sleep(6 * 3600)
+
+
+@app.on_event("startup")
+async def start_agent_chat_retention():
+    global _agent_chat_retention_task
+    _agent_chat_retention_task = asyncio.ensure_future(_agent_chat_retention_loop())
+
+
+@app.on_event("shutdown")
+async def stop_agent_chat_retention():
+    if _agent_chat_retention_task:
+        _agent_chat_retention_task.cancel()
+
+
+# ------------------ AI PIPELINE ------------------
+
+# Max AI pipelines running at once per site
+AI_PIPELINE_CONCURRENCY = int(os.getenv("AI_PIPELINE_CONCURRENCY", "4"))
+
+
+def schedule_ai_processing(site: dict, site_id: str, visitor_id: str, conversation_id: str, internal_visitor_id: str, msg: str):
+    """Run analysis/auto-reply for a customer message in the background.
+
+    A newer message from the same visitor cancels work still pending for the previous one.
+    """
+    tasks = site["ai_tasks"]
+    previous = tasks.pop(visitor_id, None)
+    if previous and not previous.done():
+        previous.cancel()
+
+    task = asyncio.ensure_future(_run_ai_pipeline(site, site_id, visitor_id, conversation_id, internal_visitor_id, msg))
+    tasks[visitor_id] = task
+    task.add_done_callback(lambda t: tasks.pop(visitor_id, None) if tasks.get(visitor_id) is t else None)
+
+
+@traced("ai.pipeline")
+async def _run_ai_pipeline(site: dict, site_id: str, visitor_id: str, conversation_id: str, internal_visitor_id: str, msg: str):
+    bind_log_context(site_id=site_id, visitor_id=visitor_id, conversation_id=conversation_id)
+    started = time.perf_counter()
+    result = "ok"
+    try:
+        async with site["ai_semaphore"]:
+            await _process_ai_message(site, site_id, visitor_id, conversation_id, internal_visitor_id, msg)
+    except asyncio.CancelledError:
+        result = "cancelled"
+    except Exception as e:
+        result = "error"
+        ai_log.error("AI pipeline error for visitor %s: %s", visitor_id, e)
+    finally:
+        observe("ai_pipeline_seconds", time.perf_counter() - started, result)
+
+
+async def _process_ai_message(site: dict, site_id: str, visitor_id: str, conversation_id: str, internal_visitor_id: str, msg: str):
+    analysis_enabled = site.get("analysis_enabled", False)
+    auto_reply_enabled = site.get("auto_reply_enabled", False)
+
+    # With the analysis endpoints' circuits open, skip the pipeline (and the usage it would be
+    # charged) rather than publish a canned default analysis. RAG falls back to plain analysis.
+    if not upstream_available("POST", "/ai/analyze-message") and not (
+        auto_reply_enabled and upstream_available("POST", "/ai/analyze-message-with-rag")
+    ):
+        ai_log.info("AI analysis skipped, API circuit open")
+        return
+
+    # One model call serves both features. Auto-reply wants the knowledge base, and the RAG
+    # response carries every analysis field, so speculatively start RAG when auto-reply is on.
+    if auto_reply_enabled:
+        model_task = asyncio.ensure_future(analyze_customer_message_with_rag(msg, site_id, conversation_id, internal_visitor_id))
+    else:
+        model_task = asyncio.ensure_future(analyze_customer_message(msg, conversation_id, internal_visitor_id, site_id))
+
+    analysis_usage = None
+    try:
+        # Usage check runs while the model call is already in flight
+        if analysis_enabled:
+            analysis_usage = await check_and_record_ai_usage(site_id, "analysis")
+        if analysis_usage is not None and not analysis_usage.get("allowed") and not auto_reply_enabled:
+            model_task.cancel()
+            analysis = None
+        else:
+            analysis = await model_task
+    except asyncio.CancelledError:
+        model_task.cancel()
+        # Superseded by a newer message before delivery: don't bill for it
+        if analysis_usage is not None and analysis_usage.get("allowed"):
+            refund_ai_usage(site_id, "analysis")
+        raise
+
+    # From here on results are delivered; a newer message no longer cancels this one
+    if site["ai_tasks"].get(visitor_id) is asyncio.current_task():
+        site["ai_tasks"].pop(visitor_id, None)
+
+    if analysis_usage is not None:
+        if analysis_usage.get("allowed"):
+            # Send analysis to the conversation's subscribers
+            await publish_conversation_event(site, conversation_id, {
+                "type": "analysis",
+                "from": visitor_id,
+                "analysis": analysis
+            })
+            # Send usage update to the site feed
+            await publish_site_event(site, {
+                "type": "ai_usage_update",
+                "feature": "analysis",
+                "used": analysis_usage.get("used"),
+                "limit": analysis_usage.get("limit")
+            })
+            # Evaluate sentiment_change workflows if sentiment is negative
+            if analysis and analysis.get("sentiment", "").lower() in ["negative", "angry", "frustrated"]:
+                await evaluate_workflows(site, site_id, "sentiment_change", {
                     "visitor_id": visitor_id,
-                    "visitor_name": name,
-                    "visitor_email": email or "",
                     "conversation_id": conversation_id,
-                    "intent": intent
+                    "sentiment": analysis.get("sentiment", ""),
+                    "intent": analysis.get("intent", ""),
+                    "urgency_score": str(analysis.get("urgency_score", 0)),
+                    "message_text": msg
                 })
+        else:
+            # Limit reached - notify the site feed
+            await publish_site_event(site, {
+                "type": "ai_limit_reached",
+                "feature": "analysis",
+                "message": analysis_usage.get("message"),
+                "used": analysis_usage.get("used"),
+                "limit": analysis_usage.get("limit")
+            })
 
-            # ----- TYPING INDICATORS -----
-            elif data.get("type") == "typing_start" and role == CUSTOMER:
-                await broadcast_to_agents(site, {
-                    "type": "typing_start",
-                    "visitorId": visitor_id,
-                    "name": site["names"].get(visitor_id, visitor_id)
-                })
+    # Auto-reply if enabled
+    if auto_reply_enabled and analysis and analysis.get("suggested_reply"):
+        # Check and record AI auto-reply usage
+        auto_reply_usage = await check_and_record_ai_usage(site_id, "auto_reply")
+        if auto_reply_usage.get("allowed"):
+            auto_msg = analysis["suggested_reply"]
+
+            # Get first available agent for saving the message
+            first_agent_id, first_agent = get_first_available_agent(site)
+
+            # Save auto-reply to API
+            if conversation_id and first_agent_id:
+                await save_message_to_api(
+                    conversation_id,
+                    "agent",
+                    first_agent_id,
+                    auto_msg,
+                    "text",
+                    None
+                )
 
-            elif data.get("type") == "typing_stop" and role == CUSTOMER:
-                await broadcast_to_agents(site, {
-                    "type": "typing_stop",
-                    "visitorId": visitor_id
-                })
+            # Send to customer (looked up now - they may have reconnected meanwhile)
+            await send_to_customer(site, site_id, visitor_id, {
+                "type": "message",
+                "from": "support",
+                "name": first_agent.get("username", "Support") if first_agent else "Support",
+                "message": auto_msg
+            })
 
-            elif data.get("type") == "support_typing" and role == SUPPORT:
-                to = data.get("to")
-                if to in site["customers"]:
-                    await site["customers"][to].send_json({
-                        "type": "support_typing"
-                    })
+            # Notify agents of auto-reply with usage
+            await publish_conversation_event(site, conversation_id, {
+                "type": "auto_reply_sent",
+                "to": visitor_id,
+                "message": auto_msg
+            })
+            await publish_site_event(site, {
+                "type": "ai_usage_update",
+                "feature": "auto_reply",
+                "used": auto_reply_usage.get("used"),
+                "limit": auto_reply_usage.get("limit")
+            })
+        else:
+            # Limit reached - notify the site feed
+            await publish_site_event(site, {
+                "type": "ai_limit_reached",
+                "feature": "auto_reply",
+                "message": auto_reply_usage.get("message"),
+                "used": auto_reply_usage.get("used"),
+                "limit": auto_reply_usage.get("limit")
+            })
 
-            elif data.get("type") == "support_typing_stop" and role == SUPPORT:
-                to = data.get("to")
-                if to in site["customers"]:
-                    await site["customers"][to].send_json({
-                        "type": "support_typing_stop"
-                    })
 
-            # ----- READ RECEIPTS -----
-            elif data.get("type") == "message_delivered" and role == SUPPORT:
-                to = data.get("to")
-                if to in site["customers"]:
-                    await site["customers"][to].send_json({
-                        "type": "message_delivered",
-                        "from": "support",
-                        "timestamp": data.get("timestamp")
-                    })
+# ------------------ SITE LIFECYCLE ------------------
+
+# Sites with no sockets left are dropped after this many idle seconds
+SITE_IDLE_EVICT_SECONDS = float(os.getenv("SITE_IDLE_EVICT_SECONDS", "600"))
+# Comma-separated site ids to initialize at startup and keep resident
+HOT_SITE_IDS = [sid.strip() for sid in os.getenv("HOT_SITE_IDS", "").split(",") if sid.strip()]
+# Optional token used to load config for preloaded sites
+SITE_PRELOAD_TOKEN = os.getenv("SITE_PRELOAD_TOKEN")
+
+# siteId -> asyncio.Task that evicts the site once it has stayed idle
+_site_evictions = {}
+
+
+async def _load_site_state(site_id: str, token: str) -> tuple:
+    """Load toggle state and workflows for a site concurrently"""
+    async def _workflows():
+        return await load_site_workflows(site_id, token) if token else []
+    return await asyncio.gather(load_site_toggle_state(site_id, token), _workflows())
+
+
+async def _init_site(site_id: str, token: str) -> dict:
+    toggle_state, site_workflows = await _load_site_state(site_id, token)
+    # setdefault: never replace a site dict that sockets may already be registered in
+    return connections.setdefault(site_id, {
+        "agents": {},  # agent_user_id -> {"ws": WebSocket, "username": str, "status": str, "token": str}
+        "supervisors": {},  # supervisor_user_id -> WebSocket
+        "customers": {},
+        "names": {},
+        "admins": {},  # admin user_id -> WebSocket
+        "analysis_enabled": toggle_state["analysis_enabled"],
+        "auto_reply_enabled": toggle_state["auto_reply_enabled"],
+        "workflows": site_workflows,  # Automated workflows
+        "ai_tasks": {},  # visitor_id -> pending AI pipeline task
+        "topics": {},  # topic -> set(agent_user_id)
+        "untargeted_agents": set(),  # agents that haven't sent any subscription yet
+        "assignments": {},  # conversation_id -> assigned agent_user_id
+        "event_seq": 0,  # seq of the last agent-bound frame
+        "event_log": deque(maxlen=RESUME_LOG_SIZE),  # (seq, topics, exclude_agent, frame) for resume
+        "ai_semaphore": asyncio.Semaphore(AI_PIPELINE_CONCURRENCY),
+        "ref_count": 0,  # open sockets holding this site
+        "pinned": False,  # hot sites are never evicted
+        "config_token": token  # token the config was loaded with (None = anonymous load)
+    })
+
+
+async def _reload_site_state(site_id: str, site: dict, token: str):
+    """Reload config for a site that was initialized without a token"""
+    toggle_state, site_workflows = await _load_site_state(site_id, token)
+    site["analysis_enabled"] = toggle_state["analysis_enabled"]
+    site["auto_reply_enabled"] = toggle_state["auto_reply_enabled"]
+    site["workflows"] = site_workflows
+    site["config_token"] = token
+
+
+async def acquire_site(site_id: str, token: str = None) -> dict:
+    """Get (or initialize exactly once) the shared state for a site and take a reference on it"""
+    site = connections.get(site_id)
+    if site is None:
+        site = await singleflight(("site_init", site_id), lambda: _init_site(site_id, token))
+    elif token and not site.get("config_token"):
+        # First authenticated connection for a site loaded anonymously
+        run_in_background(singleflight(("site_reload", site_id), lambda: _reload_site_state(site_id, site, token)))
+
+    site["ref_count"] += 1
+    eviction = _site_evictions.pop(site_id, None)
+    if eviction:
+        eviction.cancel()
+    return site
+
+
+def release_site(site_id: str, site: dict):
+    """Drop a reference on a site, scheduling eviction once nothing holds it"""
+    site["ref_count"] = max(0, site["ref_count"] - 1)
+    if site["ref_count"] == 0 and not site.get("pinned") and connections.get(site_id) is site:
+        previous = _site_evictions.pop(site_id, None)
+        if previous:
+            previous.cancel()
+        _site_evictions[site_id] = asyncio.ensure_future(_evict_site_later(site_id, site))
+
+
+@metrics_collector
+def collect_site_metrics():
+    set_metric("sites_resident", len(connections))
+    set_metric("ai_tasks_pending", sum(len(site["ai_tasks"]) for site in list(connections.values())))
+
+
+async def _evict_site_later(site_id: str, site: dict):
+    try:
+        await asyncio.sleep(SITE_IDLE_EVICT_SECONDS)
+    except asyncio.CancelledError:
+        return
+    if _site_evictions.get(site_id) is asyncio.current_task():
+        _site_evictions.pop(site_id, None)
+    if connections.get(site_id) is not site or site["ref_count"] > 0:
+        return
+    if site["agents"] or site["customers"] or site["admins"]:
+        return
+    connections.pop(site_id, None)
+    _round_robin_index.pop(id(site), None)
+    invalidate_analysis_cache(site_id)
+    drop_agent_chat_buffers(site_id)
+    site_log.info("Evicted idle site %s", site_id)
+
+
+@app.on_event("startup")
+async def preload_hot_sites():
+    """Initialize known hot sites so the first connections after a restart find them warm"""
+    async def _preload(site_id):
+        site = await singleflight(("site_init", site_id), lambda: _init_site(site_id, SITE_PRELOAD_TOKEN))
+        site["pinned"] = True
+
+    if HOT_SITE_IDS:
+        await asyncio.gather(*[_preload(site_id) for site_id in HOT_SITE_IDS])
+        site_log.info("Preloaded %s hot sites", len(HOT_SITE_IDS))
+
+
+# ------------------ WEBSOCKET RATE LIMITING ------------------
+
+# Token buckets per frame class, checked at every scope that applies to the sender:
+# the connection, the visitor, the client IP and the whole site (customers), or just the
+# connection (agents/admins). A frame must fit every bucket; "delay" classes wait up to
+# RATE_LIMIT_MAX_DELAY for tokens (backpressure on that socket), "drop" classes are discarded.
+# Either way the sender gets a (throttled) rate_limited frame when something is held back.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_DELAY = float(os.getenv("RATE_LIMIT_MAX_DELAY", "2"))
+# Reverse proxies (addresses or CIDR ranges) whose X-Forwarded-For is believed; from anyone else
+# the header is ignored so a client cannot pick its own "ip" bucket
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(p.strip(), strict=False)
+    for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()
+]
+
+# class -> {"policy": "drop"|"delay", scope: (tokens per second, burst)}
+WS_RATE_LIMITS = {
+    "chat": {"policy": "delay", "connection": (1.0, 10), "visitor": (1.0, 15), "ip": (5.0, 40), "site": (50.0, 300)},
+    "typing": {"policy": "drop", "connection": (2.0, 6), "visitor": (2.0, 8), "ip": (10.0, 40), "site": (100.0, 400)},
+    "session": {"policy": "delay", "connection": (0.5, 4), "visitor": (0.2, 6), "ip": (2.0, 20), "site": (20.0, 100)},
+    "control": {"policy": "drop", "connection": (10.0, 50), "visitor": (10.0, 50), "ip": (20.0, 100), "site": (200.0, 1000)},
+}
+WS_RATE_LIMITS.update(json.loads(os.getenv("WS_RATE_LIMITS", "{}")))  # per-class overrides
+
+# frame type -> class (None = exempt); unlisted types are "control"
+WS_FRAME_CLASSES = {
+    None: "chat", "message": "chat", "agent_message": "chat",
+    "typing_start": "typing", "typing_stop": "typing", "support_typing": "typing",
+    "support_typing_stop": "typing", "agent_typing_start": "typing", "agent_typing_stop": "typing",
+    "init": "session", "get_state": "session", "csat_response": "session",
+    "ping": None, "pong": None,
+}
 
-            elif data.get("type") == "message_delivered" and role == CUSTOMER:
-                await broadcast_to_agents(site, {
-                    "type": "message_delivered",
-                    "from": visitor_id,
-                    "visitorId": visitor_id,
-                    "timestamp": data.get("timestamp")
-                })
+# (scope, key, class) -> [tokens, last refill (monotonic)]; connection buckets live in conn["rate_buckets"]
+_rate_buckets = {}
+_rate_buckets_pruned_at = time.monotonic()
+# (role, class, scope) -> frames dropped
+_rate_limit_drops = {}
 
-            elif data.get("type") in ("messages_read", "message_read") and role == SUPPORT:
-                to = data.get("to")
-                if to in site["customers"]:
-                    await site["customers"][to].send_json({
-                        "type": "messages_read",
-                        "from": "support",
-                        "timestamp": data.get("timestamp")
-                    })
 
-            elif data.get("type") in ("messages_read", "message_read") and role == CUSTOMER:
-                await broadcast_to_agents(site, {
-                    "type": "messages_read",
-                    "from": visitor_id,
-                    "visitorId": visitor_id,
-                    "timestamp": data.get("timestamp")
-                })
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(ws: WebSocket) -> str:
+    """Peer address, or - behind a trusted proxy - the nearest X-Forwarded-For hop that is not one"""
+    peer = ws.client.host if ws.client else "unknown"
+    if not _is_trusted_proxy(peer):
+        return peer
+    # Walk from the right: hops added by our own proxies are trusted, the first other one is the client
+    for hop in reversed(ws.headers.get("x-forwarded-for", "").split(",")):
+        hop = hop.strip()
+        if hop and not _is_trusted_proxy(hop):
+            return hop
+    return peer
+
+
+def _rate_scopes(conn: dict) -> list:
+    """(scope, key) pairs whose buckets a frame from this connection draws on"""
+    scopes = [("connection", None)]
+    if conn["role"] == CUSTOMER:
+        scopes += [
+            ("visitor", (conn["site_id"], conn["visitor_id"])),
+            ("ip", conn["ip"]),
+            ("site", conn["site_id"])
+        ]
+    return scopes
+
+
+def _refill(store: dict, bucket_key, rate: float, burst: float, now: float) -> list:
+    bucket = store.get(bucket_key)
+    if bucket is None:
+        bucket = store[bucket_key] = [float(burst), now]
+    else:
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    return bucket
+
+
+def take_rate_tokens(conn: dict, frame_class: str):
+    """Consume one token from every applicable bucket; returns (0, None) on success,
+    otherwise (seconds until all buckets have a token, limiting scope) without consuming anything"""
+    limits = WS_RATE_LIMITS[frame_class]
+    now = time.monotonic()
+    buckets = []
+    wait, limiting_scope = 0.0, None
+    for scope, key in _rate_scopes(conn):
+        if scope not in limits:
+            continue
+        rate, burst = limits[scope]
+        if scope == "connection":
+            bucket = _refill(conn.setdefault("rate_buckets", {}), frame_class, rate, burst, now)
+        else:
+            bucket = _refill(_rate_buckets, (scope, key, frame_class), rate, burst, now)
+        buckets.append(bucket)
+        if bucket[0] < 1:
+            scope_wait = (1 - bucket[0]) / rate if rate > 0 else float("inf")
+            if scope_wait > wait:
+                wait, limiting_scope = scope_wait, scope
+    if limiting_scope:
+        return wait, limiting_scope
+    for bucket in buckets:
+        bucket[0] -= 1
+    return 0.0, None
+
+
+def _prune_rate_buckets(now: float):
+    """Forget buckets that have been idle long enough to be full again"""
+    global _rate_buckets_pruned_at
+    if now - _rate_buckets_pruned_at < 60:
+        return
+    _rate_buckets_pruned_at = now
+    for bucket_key, (tokens, updated) in list(_rate_buckets.items()):
+        scope, _, frame_class = bucket_key
+        rate, burst = WS_RATE_LIMITS.get(frame_class, {}).get(scope, (1.0, 1))
+        if tokens + (now - updated) * rate >= burst:
+            _rate_buckets.pop(bucket_key, None)
 
-            # ----- TOGGLE ANALYSIS -----
-            elif data.get("type") == "toggle_analysis" and role == SUPPORT:
-                site["analysis_enabled"] = data.get("enabled", False)
-                print(f"Analysis toggled: {site['analysis_enabled']}")
-                await update_site_toggle(site_id, token, analysis_enabled=site["analysis_enabled"])
-
-            # ----- TOGGLE AUTO REPLY -----
-            elif data.get("type") == "toggle_auto_reply" and role == SUPPORT:
-                site["auto_reply_enabled"] = data.get("enabled", False)
-                print(f"Auto Reply toggled: {site['auto_reply_enabled']}")
-                await update_site_toggle(site_id, token, auto_reply_enabled=site["auto_reply_enabled"])
-
-            # ----- RELOAD WORKFLOWS -----
-            elif data.get("type") == "reload_workflows" and role == SUPPORT:
-                print(f"Reloading workflows for site {site_id}")
-                site["workflows"] = await load_site_workflows(site_id, token)
-                await broadcast_to_agents(site, {
-                    "type": "workflows_loaded",
-                    "count": len(site.get("workflows", []))
-                })
 
-            # ----- GET ONLINE AGENTS -----
-            elif data.get("type") == "get_online_agents" and role == SUPPORT:
-                agent_user_id = auth.get("user_id")
-                online_agents = {
-                    aid: {"username": adata["username"], "status": adata["status"]}
-                    for aid, adata in site["agents"].items()
-                    if aid != agent_user_id
+@metrics_collector
+def collect_rate_limit_metrics():
+    for (role, frame_class, scope), drops in list(_rate_limit_drops.items()):
+        set_metric("ws_rate_limited_total", drops, role, frame_class, scope)
+
+
+async def admit_ws_frame(conn: dict, frame_type) -> bool:
+    """Apply the rate limits for one incoming frame; False means drop it"""
+    frame_class = WS_FRAME_CLASSES.get(frame_type, "control")
+    if not RATE_LIMIT_ENABLED or frame_class is None:
+        return True
+    _prune_rate_buckets(time.monotonic())
+
+    wait, scope = take_rate_tokens(conn, frame_class)
+    if scope is None:
+        return True
+    delayable = WS_RATE_LIMITS[frame_class].get("policy") == "delay" and wait <= RATE_LIMIT_MAX_DELAY
+    await _notify_rate_limited(conn, frame_type, frame_class, scope, wait, delayed=delayable)
+    if delayable:
+        await asyncio.sleep(wait)
+        wait, scope = take_rate_tokens(conn, frame_class)
+        if scope is None:
+            return True
+
+    drop_key = (conn["role"], frame_class, scope)
+    _rate_limit_drops[drop_key] = _rate_limit_drops.get(drop_key, 0) + 1
+    return False
+
+
+async def _notify_rate_limited(conn: dict, frame_type, frame_class: str, scope: str, wait: float, delayed: bool):
+    # At most one notice per class per second per socket
+    now = time.monotonic()
+    notified = conn.setdefault("rate_limited_at", {})
+    if now - notified.get(frame_class, 0) < 1:
+        return
+    notified[frame_class] = now
+    try:
+        await send_frame(conn["ws"], {
+            "type": "rate_limited",
+            "frameType": frame_type,
+            "class": frame_class,
+            "scope": scope,
+            "action": "delayed" if delayed else "dropped",
+            "retryAfter": round(wait, 2)
+        })
+    except Exception as e:
+        send_log.warning("Failed to send rate_limited notice: %s", e)
+
+
+# ------------------ WEBSOCKET DISPATCH ------------------
+
+# /ws frames are routed by (role, type) through WS_HANDLERS instead of an if/elif chain.
+# Handlers take (conn, data); conn holds the socket's ws, site, site_id, role, auth, token,
+# visitor_id, ip and resumed_conversation. Type-less frames are chat messages (type None).
+ALL_ROLES = (CUSTOMER, SUPPORT, ADMIN)
+WS_ID = (str, int)  # ids may arrive as strings or numbers
+
+# (role, type) -> {"handler", "required", "schema"}
+WS_HANDLERS = {}
+# (role, type) -> {"calls", "errors", "invalid", "total_seconds", "max_seconds"}
+_ws_handler_stats = {}
+
+
+def ws_handler(roles, types, required: tuple = (), schema: dict = None):
+    """Register a /ws handler for one or more roles and frame types.
+    required: fields that must be present and non-empty; schema: field -> allowed type(s) when present."""
+    roles = roles if isinstance(roles, tuple) else (roles,)
+    types = types if isinstance(types, tuple) else (types,)
+
+    def register(handler):
+        for role in roles:
+            for frame_type in types:
+                WS_HANDLERS[(role, frame_type)] = {
+                    "handler": handler,
+                    "required": required,
+                    "schema": schema or {}
                 }
-                await ws.send_json({
-                    "type": "online_agents_list",
-                    "agents": online_agents
-                })
+        return handler
+    return register
+
+
+def validate_ws_frame(entry: dict, data: dict) -> str:
+    """Return a description of what is wrong with a frame, or None if it is valid"""
+    for field in entry["required"]:
+        if not data.get(field):
+            return f"'{field}' is required"
+    for field, expected in entry["schema"].items():
+        value = data.get(field)
+        if value is not None and (not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool)):
+            return f"'{field}' has the wrong type"
+    return None
 
-            # ----- AGENT-TO-AGENT MESSAGE -----
-            elif data.get("type") == "agent_message" and role == SUPPORT:
-                from_agent_id = auth.get("user_id")
-                from_agent_name = auth.get("username")
-                to_agent_id = data.get("toAgentId")
-                message = data.get("message", "")
-                timestamp = data.get("timestamp")
-
-                if to_agent_id and message:
-                    # Store message in agent chats
-                    chat_key = tuple(sorted([from_agent_id, to_agent_id]))
-                    if "agent_chats" not in site:
-                        site["agent_chats"] = {}
-                    if chat_key not in site["agent_chats"]:
-                        site["agent_chats"][chat_key] = []
-
-                    msg_obj = {
-                        "from": from_agent_id,
-                        "fromName": from_agent_name,
-                        "to": to_agent_id,
-                        "message": message,
-                        "timestamp": timestamp
-                    }
-                    site["agent_chats"][chat_key].append(msg_obj)
-
-                    # Send to target agent
-                    sent = await send_to_agent(site, to_agent_id, {
-                        "type": "agent_message",
-                        "fromAgentId": from_agent_id,
-                        "fromAgentName": from_agent_name,
-                        "message": message,
-                        "timestamp": timestamp
-                    })
 
-                    # Confirm to sender
-                    await ws.send_json({
-                        "type": "agent_message_sent",
-                        "toAgentId": to_agent_id,
-                        "message": message,
-                        "timestamp": timestamp,
-                        "delivered": sent
-                    })
+def _ws_stats(key: tuple) -> dict:
+    stats = _ws_handler_stats.get(key)
+    if stats is None:
+        stats = _ws_handler_stats[key] = {"calls": 0, "errors": 0, "invalid": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+    return stats
 
-            # ----- AGENT TYPING TO AGENT -----
-            elif data.get("type") == "agent_typing_start" and role == SUPPORT:
-                from_agent_id = auth.get("user_id")
-                from_agent_name = auth.get("username")
-                to_agent_id = data.get("toAgentId")
-
-                if to_agent_id:
-                    await send_to_agent(site, to_agent_id, {
-                        "type": "agent_typing_start",
-                        "fromAgentId": from_agent_id,
-                        "fromAgentName": from_agent_name
-                    })
 
-            elif data.get("type") == "agent_typing_stop" and role == SUPPORT:
-                from_agent_id = auth.get("user_id")
-                to_agent_id = data.get("toAgentId")
+async def dispatch_ws_frame(conn: dict, data: dict):
+    """Rate-limit and validate a frame and run its handler; handler errors are counted and logged, not fatal to the socket"""
+    key = (conn["role"], data.get("type"))
+    entry = WS_HANDLERS.get(key)
+    # As before the registry: a customer frame of an unknown type that carries a message or file is chat
+    if entry is None and conn["role"] == CUSTOMER and ("message" in data or "file" in data):
+        key = (CUSTOMER, None)
+        entry = WS_HANDLERS.get(key)
+    if not await admit_ws_frame(conn, key[1] if entry else data.get("type")):
+        return
+    if conn["role"] == CUSTOMER:
+        log_conversation_id.set(visitor_conversation_id(conn["visitor_id"]))
+    else:
+        target_visitor = data.get("to") or data.get("visitorId")
+        log_visitor_id.set(target_visitor)
+        log_conversation_id.set(data.get("conversationId") or visitor_conversation_id(target_visitor))
+    if entry is None:
+        _ws_stats((conn["role"], "<unhandled>"))["calls"] += 1
+        return
+    stats = _ws_stats(key)
+
+    problem = validate_ws_frame(entry, data)
+    if problem:
+        stats["invalid"] += 1
+        await send_frame(conn["ws"], {
+            "type": "error",
+            "error": "invalid_frame",
+            "frameType": key[1],
+            "message": problem
+        })
+        return
 
-                if to_agent_id:
-                    await send_to_agent(site, to_agent_id, {
-                        "type": "agent_typing_stop",
-                        "fromAgentId": from_agent_id
-                    })
+    stats["calls"] += 1
+    started = time.perf_counter()
+    span_attributes = {
+        "ws.role": key[0],
+        "ws.frame_type": key[1] or "message",
+        "site.id": conn["site_id"],
+        "visitor.id": log_visitor_id.get(),
+        "conversation.id": log_conversation_id.get()
+    } if TRACING_ENABLED else None
+    try:
+        with trace_span(f"ws {key[0]} {key[1] or 'message'}", "server", span_attributes):
+            await entry["handler"](conn, data)
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        stats["errors"] += 1
+        ws_log.error("Error handling %s '%s' frame: %s", key[0], key[1], e, exc_info=True)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        observe("ws_handler_seconds", elapsed, key[0], key[1] or "message")
+
+
+@metrics_collector
+def collect_ws_handler_metrics():
+    for (role, frame_type), stats in list(_ws_handler_stats.items()):
+        frame_type = frame_type or "message"  # type-less chat frames
+        set_metric("ws_frames_total", stats["calls"], role, frame_type)
+        set_metric("ws_frame_errors_total", stats["errors"], role, frame_type)
+        set_metric("ws_frames_invalid_total", stats["invalid"], role, frame_type)
+
+
+@app.get("/api/ws/handlers")
+async def get_ws_handler_stats(authorization: str = Header(None)):
+    """Per-handler call, error and timing counters for /ws (super admin)"""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Authorization required")
+    token_data = validate_jwt_token(authorization.replace("Bearer ", ""))
+    if not token_data:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if token_data.get("role") != "super_admin":
+        raise HTTPException(status_code=403, detail="Super admin access required")
 
-            # ----- GET AGENT CHAT HISTORY -----
-            elif data.get("type") == "get_agent_chat_history" and role == SUPPORT:
-                from_agent_id = auth.get("user_id")
-                with_agent_id = data.get("withAgentId")
-
-                if with_agent_id:
-                    chat_key = tuple(sorted([from_agent_id, with_agent_id]))
-                    messages = site.get("agent_chats", {}).get(chat_key, [])
-                    await ws.send_json({
-                        "type": "agent_chat_history",
-                        "withAgentId": with_agent_id,
-                        "messages": messages
-                    })
+    return {
+        "handlers": [
+            {
+                "role": role,
+                "type": frame_type,
+                **stats,
+                "avg_seconds": stats["total_seconds"] / stats["calls"] if stats["calls"] else 0.0
+            }
+            for (role, frame_type), stats in sorted(_ws_handler_stats.items(), key=lambda item: str(item[0]))
+        ]
+    }
 
-            # ----- BROADCAST NEW COMMENT -----
-            elif data.get("type") == "new_comment" and role == SUPPORT:
-                # When an agent adds a comment, broadcast to all agents
-                conversation_id = data.get("conversationId")
-                comment = data.get("comment", {})
-                author_id = auth.get("user_id")
-                author_name = auth.get("username")
 
-                # Broadcast to all agents (they can filter by conversationId)
-                await broadcast_to_agents(site, {
-                    "type": "new_comment",
-                    "conversationId": conversation_id,
-                    "comment": {
-                        **comment,
-                        "authorId": author_id,
-                        "authorName": author_name
-                    }
-                }, exclude_agent=author_id)
-
-                # Handle mentions in the comment
-                mentions = data.get("mentions", [])
-                if mentions:
-                    for mentioned_id in mentions:
-                        if mentioned_id in site.get("agents", {}):
-                            await send_to_agent(site, mentioned_id, {
-                                "type": "mention_notification",
-                                "conversationId": conversation_id,
-                                "fromAgent": author_name,
-                                "fromAgentId": author_id,
-                                "preview": comment.get("content", "")[:100],
-                                "commentId": comment.get("id")
-                            })
-
-            # ----- REQUEST SUPERVISOR DATA -----
-            elif data.get("type") == "get_supervisor_data" and role == SUPPORT:
-                agent_user_id = auth.get("user_id")
-                agent_role = auth.get("role", "")
-
-                # Check if user has supervisor permissions
-                if agent_role in ["admin", "site_admin", "supervisor", "super_admin"]:
-                    # Get online agents
-                    online_agents = [
-                        {"id": aid, "username": adata["username"], "status": adata["status"]}
-                        for aid, adata in site.get("agents", {}).items()
-                    ]
-
-                    # Get active conversations
-                    active_conversations = [
-                        {
-                            "visitorId": vid,
-                            "name": site.get("names", {}).get(vid, vid),
-                            "conversationId": VISITOR_DATA.get(vid, {}).get("conversation_id")
-                        }
-                        for vid in site.get("customers", {}).keys()
-                    ]
-
-                    await ws.send_json({
-                        "type": "supervisor_data",
-                        "agents": online_agents,
-                        "conversations": active_conversations
-                    })
-                else:
-                    await ws.send_json({
-                        "type": "error",
-                        "message": "Supervisor access required"
-                    })
+# ------------------ WEBSOCKET ------------------
 
-            # ----- AGENT STATUS CHANGE -----
-            elif data.get("type") == "agent_status_change" and role == SUPPORT:
-                status = data.get("status", "online")
-                agent_user_id = auth.get("user_id")
-                agent_username = auth.get("username", "Support")
+async def register_customer(site: dict, site_id: str, ws, visitor_id: str, resume_token: str = None, last_seq=None):
+    """Bind a customer connection (socket or SSE stream) to the site and send its session frame.
+    Returns (session_token, resumed conversation id)"""
+    session_token, session, resumed = open_resume_session(site_id, CUSTOMER, visitor_id, resume_token)
+    site["customers"][visitor_id] = ws
+    resumed_conversation = None
+    if resumed:
+        # Rebind to the existing conversation; the widget's init is then a no-op
+        resumed_conversation = VISITOR_DATA.get(visitor_id, {}).get("conversation_id")
+    await send_frame(ws, {
+        "type": "session",
+        "resumeToken": session_token,
+        "resumed": resumed,
+        "conversationId": resumed_conversation
+    })
+    if resumed:
+        await replay_customer_events(session, ws, last_seq)
+    return session_token, resumed_conversation
+
+
+async def unregister_customer(site: dict, site_id: str, ws, visitor_id: str, session_token: str):
+    """Customer connection closed: start the departure grace period"""
+    # A newer connection for the same visitor may already have taken over
+    if site["customers"].get(visitor_id) is ws:
+        site["customers"].pop(visitor_id, None)
+        clear_typing_states(site_id, visitor_id)
+        clear_receipts(site_id, visitor_id)
+        await schedule_departure(
+            session_token, lambda: finalize_customer_departure(site, site_id, visitor_id)
+        )
+
+
+async def unregister_agent(site: dict, ws, auth: dict, session_token: str):
+    """Agent socket closed: keep its subscriptions for a resume and start the departure grace period"""
+    agent_user_id = auth.get("user_id")
+    agent_data = site["agents"].get(agent_user_id, {})
+    # A newer socket for the same agent may already have taken over
+    if agent_data.get("ws") is not ws:
+        return
+    agent_token = agent_data.get("token")
+    agent_username = agent_data.get("username")
+    session = _resume_sessions.get(session_token)
+    if session:
+        session["state"] = save_agent_subscriptions(site, agent_user_id)
+
+    # Remove from agents dict
+    unsubscribe_agent_all(site, agent_user_id)
+    site["agents"].pop(agent_user_id, None)
+    site["supervisors"].pop(agent_user_id, None)
+
+    await schedule_departure(
+        session_token,
+        lambda: finalize_agent_departure(site, agent_user_id, agent_username, agent_token)
+    )
 
-                # Update agent status in multi-agent structure
-                if agent_user_id in site["agents"]:
-                    site["agents"][agent_user_id]["status"] = status
 
-                print(f"Agent {agent_username} status changed to: {status}")
+@app.websocket("/ws")
+async def websocket_endpoint(ws: WebSocket):
+    await ws.accept()
 
-                # Broadcast to other agents
+    site_id = ws.query_params.get("siteId")
+    role = ws.query_params.get("role")
+    visitor_id = ws.query_params.get("visitorId")
+    token = ws.query_params.get("token")
+    api_key = ws.query_params.get("apiKey")
+    resume_token = ws.query_params.get("resume")
+    last_seq = ws.query_params.get("lastSeq")
+
+    # -------- WIRE PROTOCOL --------
+    protocol = ws.query_params.get("protocol", "json")
+    if protocol not in WIRE_PROTOCOLS:
+        await ws.close(code=4003, reason="Unsupported protocol")
+        return
+    ws.state.protocol = protocol
+    bind_log_context(site_id=site_id, visitor_id=visitor_id if role == CUSTOMER else None)
+    session_token = None
+    resumed_conversation = None
+
+    # -------- AUTH SUPPORT --------
+    auth = None
+    if role == SUPPORT:
+        # First try JWT validation (for tokens from .NET API)
+        auth = validate_jwt_token(token)
+        if not auth:
+            # Fall back to ACTIVE_TOKENS (for tokens from Python login)
+            auth = ACTIVE_TOKENS.get(token)
+        if not auth:
+            await ws.close()
+            return
+
+    # -------- AUTH CUSTOMER (API Key validation) --------
+    if role == CUSTOMER:
+        is_valid = await validate_api_key(site_id, api_key)
+        if not is_valid:
+            ws_log.warning("Invalid API key for site %s", site_id)
+            await ws.close(code=4001, reason="Invalid API key")
+            return
+
+    # -------- AUTH ADMIN --------
+    if role == ADMIN:
+        auth = validate_jwt_token(token)
+        if not auth:
+            auth = ACTIVE_TOKENS.get(token)
+        if not auth:
+            await ws.close()
+            return
+
+    # -------- INIT SITE --------
+    # Concurrent first connections share one initialization and the same site dict
+    site = await acquire_site(site_id, token)
+
+    # Every exit from here on - including a client that drops mid-handshake - goes through the
+    # finally below, so registrations are undone and the site reference is released
+    opened_at = None
+    try:
+        # -------- REGISTER ROLE --------
+        if role == SUPPORT:
+            agent_user_id = auth.get("user_id")
+            agent_username = auth["username"]
+            agent_role = auth.get("role", "agent")
+
+            # Pick up the previous socket's session if the client presented a valid resume token
+            session_token, session, resumed = open_resume_session(site_id, SUPPORT, agent_user_id, resume_token)
+
+            # Register agent in multi-agent structure (dropping subscriptions of a previous socket)
+            unsubscribe_agent_all(site, agent_user_id)
+            site["agents"][agent_user_id] = {
+                "ws": ws,
+                "username": agent_username,
+                "status": "online",
+                "token": token,
+                "role": agent_role,
+                "topics": set(),  # subscribed topics
+                "explicit_topics": set(),  # topics requested with "subscribe" (kept when the view changes)
+                "viewing": None  # conversation currently open in the dashboard
+            }
+            site["untargeted_agents"].add(agent_user_id)
+            if resumed:
+                restore_agent_subscriptions(site, agent_user_id, session["state"])
+            head_seq = site["event_seq"]  # frames after this reach the socket live
+
+            # Also register as supervisor if role allows
+            if agent_role in ["admin", "site_admin", "supervisor"]:
+                site["supervisors"][agent_user_id] = ws
+
+            # Replay what the agent missed; fall back to a full state dump if the log no longer covers it
+            replayed = False
+            if resumed:
+                await send_frame(ws, {"type": "session", "resumeToken": session_token, "resumed": True})
+                replayed = await replay_agent_events(site, agent_user_id, last_seq, head_seq)
+            if not replayed:
+                await send_frame(ws, {"type": "session", "resumeToken": session_token, "resumed": False, "seq": head_seq})
+                await send_agent_snapshot(site, ws, agent_user_id)
+
+            # A resumed agent never went offline as far as anyone else knows
+            if not resumed:
+                # Update agent status to online via API
+                await update_agent_status(token, "online")
+
+                # Broadcast to admins that agent is online
+                await broadcast_to_admins(site, {
+                    "type": "agent_online",
+                    "userId": agent_user_id,
+                    "username": agent_username,
+                    "status": "online"
+                })
+
+                # Broadcast to other agents that this agent joined
                 await broadcast_to_agents(site, {
-                    "type": "agent_status_changed",
+                    "type": "agent_joined",
                     "agentId": agent_user_id,
                     "username": agent_username,
-                    "status": status
+                    "status": "online"
                 }, exclude_agent=agent_user_id)
 
-                # Broadcast to all connected customers
-                for vid, cws in site["customers"].items():
+                # Notify customers support joined with status
+                for cvisitor_id, cws in list(site["customers"].items()):
                     try:
-                        await cws.send_json({
+                        await send_frame(cws, {
+                            "type": "support_joined",
+                            "name": agent_username
+                        })
+                        await send_frame(cws, {
                             "type": "agent_status_broadcast",
-                            "status": status,
+                            "status": "online",
                             "agentName": agent_username
                         })
                     except Exception as e:
-                        print(f"Failed to send status to customer {vid}: {e}")
+                        # A customer socket that is closing must not abort this agent's registration
+                        send_log.warning("Failed to send to customer %s: %s", cvisitor_id, e)
 
-            # ----- CLOSE CONVERSATION -----
-            elif data.get("type") == "close_conversation" and role == SUPPORT:
-                target_visitor = data.get("visitorId")
-                conversation_id = data.get("conversationId")
-                send_csat = data.get("sendCsat", True)
-                close_status = data.get("status", "resolved")
-                close_note = data.get("note", "")
+        elif role == CUSTOMER:
+            session_token, resumed_conversation = await register_customer(site, site_id, ws, visitor_id, resume_token, last_seq)
 
-                print(f"Closing conversation for visitor: {target_visitor}, status: {close_status}")
+        elif role == ADMIN:
+            admin_id = auth.get("user_id", token)
+            site["admins"][admin_id] = ws
+
+            # Send current agents status to admin
+            for agent_id, agent_data in site.get("agents", {}).items():
+                await send_frame(ws, {
+                    "type": "agent_online",
+                    "userId": agent_id,
+                    "username": agent_data.get("username"),
+                    "status": agent_data.get("status", "online")
+                })
 
-                # Update conversation status in database via API
-                if conversation_id and token:
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            response = await client.post(
-                                f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/close",
-                                json={"resolutionStatus": close_status, "note": close_note},
-                                headers={"Authorization": f"Bearer {token}"},
-                                timeout=10.0
-                            )
-                            if response.status_code == 200:
-                                print(f"Conversation {conversation_id} closed in database with status: {close_status}")
-                            else:
-                                print(f"Failed to close conversation in database: {response.status_code} - {response.text}")
-                    except Exception as e:
-                        print(f"Error updating conversation status: {e}")
+        else:
+            await ws.close()
+            return
 
-                # Send CSAT request to customer if enabled and customer is connected
-                if send_csat and target_visitor in site["customers"]:
-                    try:
-                        agent_username = auth.get("username", "Support")
-                        await site["customers"][target_visitor].send_json({
-                            "type": "csat_request",
-                            "agentName": agent_username,
-                            "conversationId": conversation_id
-                        })
-                    except Exception as e:
-                        print(f"Failed to send CSAT request: {e}")
+        # -------- MESSAGE LOOP --------
+        conn = {
+            "ws": ws,
+            "site": site,
+            "site_id": site_id,
+            "role": role,
+            "auth": auth,
+            "token": token,
+            "visitor_id": visitor_id,
+            "ip": client_ip(ws),
+            "resumed_conversation": resumed_conversation
+        }
+        track_heartbeat(ws, role)
+        inc_metric("ws_connections_opened_total", role)
+        inc_metric("ws_connections", role)
+        opened_at = time.monotonic()
+        while True:
+            if heartbeat_reaped(ws):
+                raise WebSocketDisconnect(code=HEARTBEAT_CLOSE_CODE)
+            data = await receive_frame(ws)
+            touch_heartbeat(ws, data.get("type"))
+            await dispatch_ws_frame(conn, data)
 
-                # Notify customer that conversation is closed
-                close_message = "This conversation has been closed. Thank you for chatting with us!"
-                if target_visitor in site["customers"]:
-                    try:
-                        await site["customers"][target_visitor].send_json({
-                            "type": "conversation_closed",
-                            "status": close_status,
-                            "message": close_message
-                        })
-                    except Exception as e:
-                        print(f"Failed to send close notification: {e}")
-
-                # Save closed message to database
-                if conversation_id:
-                    await save_message_to_api(
-                        conversation_id=conversation_id,
-                        sender_id="system",
-                        sender_type="system",
-                        content=close_message,
-                        message_type="system"
-                    )
+    except WebSocketDisconnect:
+        pass
 
-                # Confirm to support
-                await ws.send_json({
-                    "type": "conversation_closed",
-                    "visitorId": target_visitor,
-                    "status": close_status
-                })
+    # -------- DISCONNECT --------
+    finally:
+        if opened_at is not None:
+            untrack_heartbeat(ws)
+            inc_metric("ws_connections", role, amount=-1)
+            observe("ws_connection_seconds", time.monotonic() - opened_at, role)
+        try:
+            if role == CUSTOMER:
+                await unregister_customer(site, site_id, ws, visitor_id, session_token)
+            elif role == SUPPORT:
+                await unregister_agent(site, ws, auth, session_token)
+            elif role == ADMIN:
+                admin_id = auth.get("user_id", token) if auth else token
+                if site["admins"].get(admin_id) is ws:
+                    site["admins"].pop(admin_id, None)
+        finally:
+            release_site(site_id, site)
+
+
+# ------------------ SSE TRANSPORT ------------------
+
+# Fallback for widgets behind proxies that break WebSockets. GET /ws/sse streams server frames
+# as Server-Sent Events, and the widget POSTs its own frames in batches to /ws/sse/{connectionId}.
+# The stream registers an SseConnection in site["customers"]. It has the WebSocket methods that
+# send_frame, the rate limiter and the heartbeat reaper use, so routing, resume and the /ws
+# handlers are shared with the socket path. An idle stream costs one suspended generator and a
+# keep-alive comment every SSE_KEEPALIVE_SECONDS.
+SSE_ENABLED = os.getenv("SSE_ENABLED", "true").lower() == "true"
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "256"))  # frames buffered for a stream before it is dropped
+SSE_MAX_BATCH = int(os.getenv("SSE_MAX_BATCH", "50"))  # frames per POST
+SSE_BACKLOG_CLOSE_CODE = 4013
+
+# connection id -> conn dict, as built by websocket_endpoint plus a "lock" serializing its POSTs
+_sse_connections = {}
+
+
+class SseConnection:
+    """Stand-in for a customer WebSocket: sent frames are queued for the event stream, close() ends it"""
+
+    def __init__(self, request: Request):
+        self.state = State({"protocol": "json"})
+        self.headers = request.headers
+        self.client = request.client
+        self.connection_id = secrets.token_urlsafe(24)
+        self.frames = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.close_code = None
+        self.close_reason = None
+
+    async def send_text(self, payload: str):
+        if self.close_code is not None:
+            raise RuntimeError("SSE stream is closed")
+        try:
+            self.frames.put_nowait(payload)
+        except asyncio.QueueFull:
+            # The client stopped reading; it reconnects and resumes from its last seq
+            await self.close(code=SSE_BACKLOG_CLOSE_CODE, reason="stream backlog")
+            raise RuntimeError("SSE stream backlog is full")
 
-            # ----- TRANSFER CONVERSATION -----
-            elif data.get("type") == "transfer_conversation" and role == SUPPORT:
-                target_visitor = data.get("visitorId")
-                conversation_id = data.get("conversationId")
-                to_agent_id = data.get("toAgentId")
-                transfer_note = data.get("note", "")
+    async def send_bytes(self, payload: bytes):
+        await self.send_text(payload.decode())
 
-                from_agent_id = auth.get("user_id")
-                from_agent_name = auth.get("username", "Agent")
+    async def close(self, code: int = 1000, reason: str = None):
+        if self.close_code is not None:
+            return
+        self.close_code = code
+        self.close_reason = reason
+        # Wake the stream if it is waiting for a frame
+        with contextlib.suppress(asyncio.QueueFull):
+            self.frames.put_nowait(None)
 
-                print(f"Transfer conversation {conversation_id} from {from_agent_name} to {to_agent_id}")
 
-                if not conversation_id or not to_agent_id:
-                    await ws.send_json({"type": "transfer_failed", "error": "Missing conversation or agent ID"})
-                else:
-                    # 1. Reassign conversation via API
-                    transfer_success = False
-                    try:
-                        async with httpx.AsyncClient(verify=False) as client:
-                            response = await client.post(
-                                f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/assign",
-                                json={"userId": to_agent_id},
-                                headers={"Authorization": f"Bearer {token}"},
-                                timeout=10.0
-                            )
-                            if response.status_code == 200:
-                                transfer_success = True
-                                print(f"Conversation {conversation_id} reassigned to {to_agent_id}")
-                            else:
-                                print(f"Failed to reassign conversation: {response.status_code} - {response.text}")
-                    except Exception as e:
-                        print(f"Error reassigning conversation: {e}")
-
-                    if transfer_success:
-                        # 2. Save system message about the transfer
-                        to_agent_data = site["agents"].get(to_agent_id, {})
-                        to_agent_name = to_agent_data.get("username", "another agent")
-                        transfer_msg = f"Conversation transferred from {from_agent_name} to {to_agent_name}"
-                        if transfer_note:
-                            transfer_msg += f". Note: {transfer_note}"
-
-                        await save_message_to_api(
-                            conversation_id=conversation_id,
-                            sender_id="system",
-                            sender_type="system",
-                            content=transfer_msg,
-                            message_type="system"
-                        )
-
-                        # 3. Notify the receiving agent (if online)
-                        if to_agent_id in site["agents"]:
-                            try:
-                                target_ws = site["agents"][to_agent_id]["ws"]
-                                visitor_name = site["names"].get(target_visitor, target_visitor)
-                                await target_ws.send_json({
-                                    "type": "conversation_transferred_in",
-                                    "visitorId": target_visitor,
-                                    "conversationId": conversation_id,
-                                    "name": visitor_name,
-                                    "fromAgent": from_agent_name,
-                                    "note": transfer_note
-                                })
-                            except Exception as e:
-                                print(f"Failed to notify target agent: {e}")
-
-                        # 4. Confirm to the sending agent
-                        await ws.send_json({
-                            "type": "conversation_transferred_out",
-                            "visitorId": target_visitor,
-                            "conversationId": conversation_id,
-                            "toAgent": to_agent_name
-                        })
-                    else:
-                        await ws.send_json({"type": "transfer_failed", "error": "Failed to reassign conversation"})
-
-            # ----- CSAT RESPONSE FROM CUSTOMER -----
-            elif data.get("type") == "csat_response" and role == CUSTOMER:
-                rating = data.get("rating", 0)
-                feedback = data.get("feedback", "")
-                # Get conversationId from message (preferred) or from VISITOR_DATA
-                conversation_id = data.get("conversationId")
-                if not conversation_id:
-                    visitor_data = VISITOR_DATA.get(visitor_id, {})
-                    conversation_id = visitor_data.get("conversation_id")
-
-                print(f"CSAT received from {visitor_id}: {rating}/5, conversationId: {conversation_id}")
-
-                if conversation_id:
-                    # Get agent token for API call
-                    agent_token = None
-                    for aid, adata in site.get("agents", {}).items():
-                        agent_token = adata.get("token")
-                        if agent_token:
-                            break
-
-                    if agent_token:
-                        try:
-                            async with httpx.AsyncClient(verify=False) as client:
-                                response = await client.post(
-                                    f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/csat",
-                                    json={"rating": rating, "feedback": feedback},
-                                    headers={"Content-Type": "application/json", "Authorization": f"Bearer {agent_token}"},
-                                    timeout=10.0
-                                )
-                                if response.status_code == 200:
-                                    print(f"CSAT rating saved for conversation {conversation_id}")
-                                else:
-                                    print(f"Failed to save CSAT rating: {response.status_code} - {response.text}")
-                        except Exception as e:
-                            print(f"Error saving CSAT rating: {e}")
-
-                    # Save the thank you message to database
-                    thank_you_message = "Thank you for your feedback! We appreciate you taking the time to rate your experience."
-                    await save_message_to_api(
-                        conversation_id=conversation_id,
-                        sender_id="system",
-                        sender_type="system",
-                        content=thank_you_message,
-                        message_type="system"
-                    )
+async def _sse_release(site: dict, site_id: str, ws: SseConnection, visitor_id: str, session_token: str):
+    """Awaited part of closing an SSE stream: the customer departure, then the site reference"""
+    try:
+        if session_token is not None:
+            await unregister_customer(site, site_id, ws, visitor_id, session_token)
+    finally:
+        release_site(site_id, site)
 
-                # Notify all agents of the rating
-                await broadcast_to_agents(site, {
-                    "type": "csat_received",
-                    "visitorId": visitor_id,
+
+async def _sse_events(ws: SseConnection, site_id: str, visitor_id: str, resume_token: str, last_seq):
+    site = None
+    session_token = None
+    conn = None
+    opened_at = time.monotonic()
+    try:
+        site = await acquire_site(site_id)
+        # Register before announcing the connectionId so the first POST finds the connection;
+        # frames sent during registration wait in ws.frames behind the connected event
+        session_token, resumed_conversation = await register_customer(site, site_id, ws, visitor_id, resume_token, last_seq)
+        conn = {
+            "ws": ws,
+            "site": site,
+            "site_id": site_id,
+            "role": CUSTOMER,
+            "auth": None,
+            "token": None,
+            "visitor_id": visitor_id,
+            "ip": client_ip(ws),
+            "resumed_conversation": resumed_conversation,
+            "lock": asyncio.Lock()
+        }
+        _sse_connections[ws.connection_id] = conn
+        track_heartbeat(ws, CUSTOMER)
+        inc_metric("sse_connections")
+        yield f"event: connected\ndata: {json.dumps({'connectionId': ws.connection_id})}\n\n"
+
+        while ws.close_code is None:
+            try:
+                payload = await asyncio.wait_for(ws.frames.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if payload is None:
+                break
+            yield f"data: {payload}\n\n"
+        yield f"event: close\ndata: {json.dumps({'code': ws.close_code, 'reason': ws.close_reason})}\n\n"
+
+    finally:
+        # Client went away (the response task is cancelled) or the server closed the stream
+        if ws.close_code is None:
+            ws.close_code = 1001
+        if conn is not None:
+            _sse_connections.pop(ws.connection_id, None)
+            untrack_heartbeat(ws)
+            inc_metric("sse_connections", amount=-1)
+            observe("ws_connection_seconds", time.monotonic() - opened_at, "customer_sse")
+        if site is not None:
+            # The stream is usually being cancelled here; a separate task keeps a second
+            # cancellation from skipping the departure broadcast or the release
+            await asyncio.shield(run_in_background(_sse_release(site, site_id, ws, visitor_id, session_token)))
+
+
+@app.get("/ws/sse")
+async def sse_stream(request: Request):
+    """Event stream for a customer that cannot use /ws; same query parameters as /ws"""
+    if not SSE_ENABLED:
+        raise HTTPException(status_code=404, detail="SSE transport disabled")
+    params = request.query_params
+    site_id = params.get("siteId")
+    visitor_id = params.get("visitorId")
+    if params.get("role", CUSTOMER) != CUSTOMER:
+        raise HTTPException(status_code=400, detail="The SSE transport is for customers only")
+    if not site_id or not visitor_id:
+        raise HTTPException(status_code=400, detail="siteId and visitorId are required")
+    if params.get("protocol", "json") != "json":
+        raise HTTPException(status_code=400, detail="Unsupported protocol")
+    bind_log_context(site_id=site_id, visitor_id=visitor_id)
+
+    if not await validate_api_key(site_id, params.get("apiKey")):
+        ws_log.warning("Invalid API key for site %s", site_id)
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    ws = SseConnection(request)
+    return StreamingResponse(
+        _sse_events(ws, site_id, visitor_id, params.get("resume"), params.get("lastSeq")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/ws/sse/{connection_id}")
+async def sse_send(connection_id: str, body: dict):
+    """Frames from an SSE client, in order: {"frames": [frame, ...]}"""
+    conn = _sse_connections.get(connection_id)
+    if conn is None:
+        raise HTTPException(status_code=404, detail="Unknown or closed SSE connection")
+    frames = body.get("frames")
+    if not isinstance(frames, list) or len(frames) > SSE_MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"'frames' must be a list of at most {SSE_MAX_BATCH} frames")
+    bind_log_context(site_id=conn["site_id"], visitor_id=conn["visitor_id"])
+
+    ws = conn["ws"]
+    async with conn["lock"]:
+        for data in frames:
+            if ws.close_code is not None:
+                raise HTTPException(status_code=410, detail="SSE connection closed")
+            if not isinstance(data, dict):
+                continue
+            touch_heartbeat(ws, data.get("type"))
+            try:
+                await dispatch_ws_frame(conn, data)
+            except WebSocketDisconnect as e:
+                await ws.close(code=e.code)
+                raise HTTPException(status_code=410, detail="SSE connection closed")
+    return {"success": True, "accepted": len(frames)}
+
+
+# ------------------ WEBSOCKET HANDLERS ------------------
+
+# ----- HEARTBEAT -----
+@ws_handler(ALL_ROLES, "ping")
+async def handle_ping(conn: dict, data: dict):
+    ws = conn["ws"]
+    await send_frame(ws, {"type": "pong"})
+
+
+@ws_handler(ALL_ROLES, "pong")
+async def handle_pong(conn: dict, data: dict):
+    pass
+
+
+# ----- STATE REQUEST -----
+@ws_handler(CUSTOMER, "get_state")
+async def handle_get_state(conn: dict, data: dict):
+    ws, site = conn["ws"], conn["site"]
+    # Notify customer about available agents
+    first_agent_id, first_agent = get_first_available_agent(site)
+    if first_agent:
+        await send_frame(ws, {
+            "type": "support_joined",
+            "name": first_agent.get("username", "Support")
+        })
+        # Also send current agent status
+        await send_frame(ws, {
+            "type": "agent_status_broadcast",
+            "status": first_agent.get("status", "online"),
+            "agentName": first_agent.get("username", "Support")
+        })
+
+
+# ----- INIT USER -----
+@ws_handler(CUSTOMER, "init", schema={"name": str, "email": str, "intent": str})
+async def handle_init(conn: dict, data: dict):
+    ws, site, site_id, visitor_id = conn["ws"], conn["site"], conn["site_id"], conn["visitor_id"]
+
+    # A resumed session is already bound to its conversation
+    resumed_conversation = conn["resumed_conversation"]
+    if resumed_conversation and VISITOR_DATA.get(visitor_id, {}).get("conversation_id") == resumed_conversation:
+        site["names"][visitor_id] = data.get("name", site["names"].get(visitor_id, visitor_id))
+        return
+
+    name = data.get("name", visitor_id)
+    email = data.get("email")
+    intent = data.get("intent", "")
+    ws_log.debug("Init received - name: %s, intent: %s", name, intent)
+    site["names"][visitor_id] = name
+
+    # Initialize chat session with API (creates visitor & conversation)
+    chat_data = await init_chat_session(site_id, visitor_id, name, email)
+    conversation_id = None
+    if chat_data:
+        conversation_id = chat_data.get("conversationId")
+        bind_log_context(conversation_id=conversation_id)
+        ws_log.debug("Conversation created: %s", conversation_id)
+        VISITOR_DATA[visitor_id] = {
+            "internal_visitor_id": chat_data.get("visitorId"),
+            "conversation_id": conversation_id
+        }
+
+        # Add intent as tag if provided
+        if intent and conversation_id:
+            ws_log.debug("Adding intent tag: %s to conversation: %s", intent, conversation_id)
+            await add_intent_tag(site_id, conversation_id, intent, site)
+        else:
+            ws_log.debug("Skipping intent tag - intent: '%s', conversation_id: %s", intent, conversation_id)
+    else:
+        ws_log.debug("chat_data is None or empty")
+
+    # Notify agents about user joined (include intent as tag)
+    await publish_conversation_event(site, conversation_id, {
+        "type": "user_joined",
+        "visitorId": visitor_id,
+        "name": name,
+        "email": email,
+        "conversationId": conversation_id,
+        "intent": intent,
+        "tags": [intent] if intent else []
+    })
+
+    # Send welcome message to customer
+    await send_welcome_message(site_id, visitor_id, conversation_id, ws, site)
+
+    # Evaluate customer_join workflows
+    await evaluate_workflows(site, site_id, "customer_join", {
+        "visitor_id": visitor_id,
+        "visitor_name": name,
+        "visitor_email": email or "",
+        "conversation_id": conversation_id,
+        "intent": intent
+    })
+
+
+# ----- TYPING INDICATORS -----
+@ws_handler(CUSTOMER, "typing_start")
+async def handle_customer_typing_start(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    await update_typing_state(site, site_id, visitor_id, "customer", True)
+
+
+@ws_handler(CUSTOMER, "typing_stop")
+async def handle_customer_typing_stop(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    await update_typing_state(site, site_id, visitor_id, "customer", False)
+
+
+@ws_handler(SUPPORT, "support_typing", required=("to",))
+async def handle_support_typing_start(conn: dict, data: dict):
+    site, site_id = conn["site"], conn["site_id"]
+    to = data.get("to")
+    if to in site["customers"]:
+        await update_typing_state(site, site_id, to, "support", True)
+
+
+@ws_handler(SUPPORT, "support_typing_stop", required=("to",))
+async def handle_support_typing_stop(conn: dict, data: dict):
+    site, site_id = conn["site"], conn["site_id"]
+    to = data.get("to")
+    if to in site["customers"]:
+        await update_typing_state(site, site_id, to, "support", False)
+
+
+# ----- READ RECEIPTS -----
+@ws_handler(SUPPORT, "message_delivered", required=("to",))
+async def handle_support_delivered(conn: dict, data: dict):
+    site, site_id = conn["site"], conn["site_id"]
+    to = data.get("to")
+    if to in site["customers"]:
+        record_receipt(site, site_id, to, "to_customer", "delivered", data.get("timestamp"))
+
+
+@ws_handler(CUSTOMER, "message_delivered")
+async def handle_customer_delivered(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    record_receipt(site, site_id, visitor_id, "to_agents", "delivered", data.get("timestamp"))
+
+
+@ws_handler(SUPPORT, ("messages_read", "message_read"), required=("to",))
+async def handle_support_read(conn: dict, data: dict):
+    site, site_id = conn["site"], conn["site_id"]
+    to = data.get("to")
+    if to in site["customers"]:
+        record_receipt(site, site_id, to, "to_customer", "read", data.get("timestamp"))
+
+
+@ws_handler(CUSTOMER, ("messages_read", "message_read"))
+async def handle_customer_read(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    record_receipt(site, site_id, visitor_id, "to_agents", "read", data.get("timestamp"))
+
+
+# ----- TOGGLE ANALYSIS -----
+@ws_handler(SUPPORT, "toggle_analysis", schema={"enabled": bool})
+async def handle_toggle_analysis(conn: dict, data: dict):
+    site, site_id, token = conn["site"], conn["site_id"], conn["token"]
+    site["analysis_enabled"] = data.get("enabled", False)
+    ws_log.info("Analysis toggled: %s", site['analysis_enabled'])
+    invalidate_site_config(site_id, "toggles")
+    await update_site_toggle(site_id, token, analysis_enabled=site["analysis_enabled"])
+
+
+# ----- TOGGLE AUTO REPLY -----
+@ws_handler(SUPPORT, "toggle_auto_reply", schema={"enabled": bool})
+async def handle_toggle_auto_reply(conn: dict, data: dict):
+    site, site_id, token = conn["site"], conn["site_id"], conn["token"]
+    site["auto_reply_enabled"] = data.get("enabled", False)
+    ws_log.info("Auto Reply toggled: %s", site['auto_reply_enabled'])
+    invalidate_site_config(site_id, "toggles")
+    await update_site_toggle(site_id, token, auto_reply_enabled=site["auto_reply_enabled"])
+
+
+# ----- RELOAD WORKFLOWS -----
+@ws_handler(SUPPORT, "reload_workflows")
+async def handle_reload_workflows(conn: dict, data: dict):
+    site, site_id, token = conn["site"], conn["site_id"], conn["token"]
+    ws_log.info("Reloading workflows for site %s", site_id)
+    invalidate_site_config(site_id, "workflows")
+    site["workflows"] = await load_site_workflows(site_id, token)
+    await broadcast_to_agents(site, {
+        "type": "workflows_loaded",
+        "count": len(site.get("workflows", []))
+    })
+
+
+# ----- GET ONLINE AGENTS -----
+@ws_handler(SUPPORT, "get_online_agents")
+async def handle_get_online_agents(conn: dict, data: dict):
+    ws, site, auth = conn["ws"], conn["site"], conn["auth"]
+    agent_user_id = auth.get("user_id")
+    online_agents = {
+        aid: {"username": adata["username"], "status": adata["status"]}
+        for aid, adata in site["agents"].items()
+        if aid != agent_user_id
+    }
+    await send_frame(ws, {
+        "type": "online_agents_list",
+        "agents": online_agents
+    })
+
+
+# ----- AGENT-TO-AGENT MESSAGE -----
+@ws_handler(SUPPORT, "agent_message", required=("toAgentId", "message"), schema={"toAgentId": WS_ID, "message": str})
+async def handle_agent_message(conn: dict, data: dict):
+    ws, site, site_id, auth = conn["ws"], conn["site"], conn["site_id"], conn["auth"]
+    from_agent_id = auth.get("user_id")
+    from_agent_name = auth.get("username")
+    to_agent_id = data.get("toAgentId")
+    message = data.get("message", "")
+    timestamp = data.get("timestamp")
+
+    if to_agent_id and message:
+        # Store message in the agent chat store
+        try:
+            await append_agent_chat(site_id, from_agent_id, from_agent_name, to_agent_id, message, timestamp)
+        except Exception as e:
+            store_log.warning("Failed to store agent message: %s", e)
+
+        # Send to target agent
+        sent = await send_to_agent(site, to_agent_id, {
+            "type": "agent_message",
+            "fromAgentId": from_agent_id,
+            "fromAgentName": from_agent_name,
+            "message": message,
+            "timestamp": timestamp
+        })
+
+        # Confirm to sender
+        await send_frame(ws, {
+            "type": "agent_message_sent",
+            "toAgentId": to_agent_id,
+            "message": message,
+            "timestamp": timestamp,
+            "delivered": sent
+        })
+
+
+# ----- AGENT TYPING TO AGENT -----
+@ws_handler(SUPPORT, "agent_typing_start", required=("toAgentId",))
+async def handle_agent_typing_start(conn: dict, data: dict):
+    site, auth = conn["site"], conn["auth"]
+    from_agent_id = auth.get("user_id")
+    from_agent_name = auth.get("username")
+    to_agent_id = data.get("toAgentId")
+
+    if to_agent_id:
+        await send_to_agent(site, to_agent_id, {
+            "type": "agent_typing_start",
+            "fromAgentId": from_agent_id,
+            "fromAgentName": from_agent_name
+        })
+
+
+@ws_handler(SUPPORT, "agent_typing_stop", required=("toAgentId",))
+async def handle_agent_typing_stop(conn: dict, data: dict):
+    site, auth = conn["site"], conn["auth"]
+    from_agent_id = auth.get("user_id")
+    to_agent_id = data.get("toAgentId")
+
+    if to_agent_id:
+        await send_to_agent(site, to_agent_id, {
+            "type": "agent_typing_stop",
+            "fromAgentId": from_agent_id
+        })
+
+
+# ----- GET AGENT CHAT HISTORY -----
+@ws_handler(SUPPORT, "get_agent_chat_history", required=("withAgentId",), schema={"withAgentId": WS_ID, "before": int, "limit": int})
+async def handle_get_agent_chat_history(conn: dict, data: dict):
+    ws, site_id, auth = conn["ws"], conn["site_id"], conn["auth"]
+    from_agent_id = auth.get("user_id")
+    with_agent_id = data.get("withAgentId")
+
+    if with_agent_id:
+        # Newest page by default; pass "before" (the previous nextCursor) for older pages
+        messages, next_cursor = await get_agent_chat_page(
+            site_id, from_agent_id, with_agent_id,
+            before=data.get("before"), limit=data.get("limit")
+        )
+        await send_frame(ws, {
+            "type": "agent_chat_history",
+            "withAgentId": with_agent_id,
+            "messages": messages,
+            "nextCursor": next_cursor,
+            "hasMore": next_cursor is not None,
+            "before": data.get("before")
+        })
+
+
+# ----- TOPIC SUBSCRIPTIONS -----
+@ws_handler(SUPPORT, ("subscribe", "unsubscribe"), schema={"topics": (list, str)})
+async def handle_subscription(conn: dict, data: dict):
+    ws, site, auth = conn["ws"], conn["site"], conn["auth"]
+    agent_user_id = auth.get("user_id")
+    rejected = update_agent_topics(
+        site, agent_user_id, data.get("topics", []), data.get("type") == "subscribe"
+    )
+    agent_data = site["agents"].get(agent_user_id)
+    await send_frame(ws, {
+        "type": "subscriptions",
+        "topics": client_topics(agent_user_id, agent_data) if agent_data else [],
+        "rejected": rejected
+    })
+
+
+# ----- CONVERSATION VIEW -----
+@ws_handler(SUPPORT, "view_conversation", schema={"conversationId": WS_ID})
+async def handle_view_conversation(conn: dict, data: dict):
+    site, auth = conn["site"], conn["auth"]
+    set_agent_viewing(site, auth.get("user_id"), data.get("conversationId"))
+
+
+# ----- BROADCAST NEW COMMENT -----
+@ws_handler(SUPPORT, "new_comment", required=("conversationId",), schema={"conversationId": WS_ID, "comment": dict, "mentions": list})
+async def handle_new_comment(conn: dict, data: dict):
+    site, auth = conn["site"], conn["auth"]
+    # When an agent adds a comment, broadcast to all agents
+    conversation_id = data.get("conversationId")
+    comment = data.get("comment", {})
+    author_id = auth.get("user_id")
+    author_name = auth.get("username")
+
+    # Deliver to agents that have the conversation open or assigned
+    topics = [conversation_topic(conversation_id)]
+    assignee = site["assignments"].get(conversation_id)
+    if assignee:
+        topics.append(assigned_topic(assignee))
+    await publish_to_topics(site, topics, {
+        "type": "new_comment",
+        "conversationId": conversation_id,
+        "comment": {
+            **comment,
+            "authorId": author_id,
+            "authorName": author_name
+        }
+    }, exclude_agent=author_id)
+
+    # Handle mentions in the comment
+    mentions = data.get("mentions", [])
+    if mentions:
+        for mentioned_id in mentions:
+            if mentioned_id in site.get("agents", {}):
+                await send_to_agent(site, mentioned_id, {
+                    "type": "mention_notification",
                     "conversationId": conversation_id,
-                    "rating": rating,
-                    "feedback": feedback
+                    "fromAgent": author_name,
+                    "fromAgentId": author_id,
+                    "preview": comment.get("content", "")[:100],
+                    "commentId": comment.get("id")
                 })
 
-            # ----- CUSTOMER MESSAGE -----
-            elif role == CUSTOMER and ("message" in data or "file" in data):
-                msg = data.get("message", "")
-                file_data = data.get("file")
-
-                # Get conversation ID for this visitor
-                visitor_data = VISITOR_DATA.get(visitor_id, {})
-                conversation_id = visitor_data.get("conversation_id")
-                internal_visitor_id = visitor_data.get("internal_visitor_id", visitor_id)
-
-                # Save message to API
-                if conversation_id:
-                    await save_message_to_api(
-                        conversation_id,
-                        "visitor",
-                        internal_visitor_id,
-                        msg,
-                        "file" if file_data else "text",
-                        file_data.get("id") if file_data else None
-                    )
 
-                # Send message to all agents
-                msg_payload = {
-                    "type": "message",
-                    "from": visitor_id,
-                    "name": site["names"].get(visitor_id, visitor_id),
-                    "message": msg
-                }
+# ----- REQUEST SUPERVISOR DATA -----
+@ws_handler(SUPPORT, "get_supervisor_data")
+async def handle_get_supervisor_data(conn: dict, data: dict):
+    ws, site, auth = conn["ws"], conn["site"], conn["auth"]
+    agent_role = auth.get("role", "")
 
-                if file_data:
-                    msg_payload["file"] = file_data
+    # Check if user has supervisor permissions
+    if agent_role in ["admin", "site_admin", "supervisor", "super_admin"]:
+        # Get online agents
+        online_agents = [
+            {"id": aid, "username": adata["username"], "status": adata["status"]}
+            for aid, adata in site.get("agents", {}).items()
+        ]
+
+        # Get active conversations
+        active_conversations = [
+            {
+                "visitorId": vid,
+                "name": site.get("names", {}).get(vid, vid),
+                "conversationId": VISITOR_DATA.get(vid, {}).get("conversation_id")
+            }
+            for vid in site.get("customers", {}).keys()
+        ]
 
-                await broadcast_to_agents(site, msg_payload)
+        await send_frame(ws, {
+            "type": "supervisor_data",
+            "agents": online_agents,
+            "conversations": active_conversations
+        })
+    else:
+        await send_frame(ws, {
+            "type": "error",
+            "message": "Supervisor access required"
+        })
 
-                # Evaluate new_message workflows
-                wf_context = {
-                    "visitor_id": visitor_id,
-                    "visitor_name": site["names"].get(visitor_id, visitor_id),
-                    "conversation_id": conversation_id,
-                    "message_text": msg or ""
-                }
-                await evaluate_workflows(site, site_id, "new_message", wf_context)
-
-                # Reset idle timer
-                if conversation_id:
-                    await start_idle_timer(site, site_id, visitor_id, conversation_id)
-
-                # Run AI analysis if analysis or auto-reply is enabled
-                should_analyze = site.get("analysis_enabled", False) or site.get("auto_reply_enabled", False)
-                if msg and not file_data and should_analyze and site.get("agents"):
-                    analysis = None
-                    analysis_usage = None
-
-                    # Check and record AI analysis usage if analysis is enabled
-                    if site.get("analysis_enabled", False):
-                        analysis_usage = await check_and_record_ai_usage(site_id, "analysis")
-                        if analysis_usage.get("allowed"):
-                            analysis = await analyze_customer_message(msg, conversation_id, internal_visitor_id)
-                            # Send analysis to all agents
-                            await broadcast_to_agents(site, {
-                                "type": "analysis",
-                                "from": visitor_id,
-                                "analysis": analysis
-                            })
-                            # Send usage update to all agents
-                            await broadcast_to_agents(site, {
-                                "type": "ai_usage_update",
-                                "feature": "analysis",
-                                "used": analysis_usage.get("used"),
-                                "limit": analysis_usage.get("limit")
-                            })
-                        else:
-                            # Limit reached - notify all agents
-                            await broadcast_to_agents(site, {
-                                "type": "ai_limit_reached",
-                                "feature": "analysis",
-                                "message": analysis_usage.get("message"),
-                                "used": analysis_usage.get("used"),
-                                "limit": analysis_usage.get("limit")
-                            })
-                            # Evaluate sentiment_change workflows if sentiment is negative
-                            if analysis and analysis.get("sentiment", "").lower() in ["negative", "angry", "frustrated"]:
-                                await evaluate_workflows(site, site_id, "sentiment_change", {
-                                    "visitor_id": visitor_id,
-                                    "conversation_id": conversation_id,
-                                    "sentiment": analysis.get("sentiment", ""),
-                                    "intent": analysis.get("intent", ""),
-                                    "urgency_score": str(analysis.get("urgency_score", 0)),
-                                    "message_text": msg
-                                })
-
-                    elif site.get("auto_reply_enabled", False):
-                        # Use RAG-enhanced analysis for auto-reply to leverage knowledge base
-                        analysis = await analyze_customer_message_with_rag(msg, site_id, conversation_id, internal_visitor_id)
-
-                    # Auto-reply if enabled
-                    if site.get("auto_reply_enabled", False) and analysis and analysis.get("suggested_reply"):
-                        # Check and record AI auto-reply usage
-                        auto_reply_usage = await check_and_record_ai_usage(site_id, "auto_reply")
-                        if auto_reply_usage.get("allowed"):
-                            auto_msg = analysis["suggested_reply"]
-
-                            # Get first available agent for saving the message
-                            first_agent_id, first_agent = get_first_available_agent(site)
-
-                            # Save auto-reply to API
-                            if conversation_id and first_agent_id:
-                                await save_message_to_api(
-                                    conversation_id,
-                                    "agent",
-                                    first_agent_id,
-                                    auto_msg,
-                                    "text",
-                                    None
-                                )
-
-                            # Send to customer
-                            await ws.send_json({
-                                "type": "message",
-                                "from": "support",
-                                "name": first_agent.get("username", "Support") if first_agent else "Support",
-                                "message": auto_msg
-                            })
-
-                            # Notify all agents of auto-reply with usage
-                            await broadcast_to_agents(site, {
-                                "type": "auto_reply_sent",
-                                "to": visitor_id,
-                                "message": auto_msg
-                            })
-                            await broadcast_to_agents(site, {
-                                "type": "ai_usage_update",
-                                "feature": "auto_reply",
-                                "used": auto_reply_usage.get("used"),
-                                "limit": auto_reply_usage.get("limit")
-                            })
-                        else:
-                            # Limit reached - notify all agents
-                            await broadcast_to_agents(site, {
-                                "type": "ai_limit_reached",
-                                "feature": "auto_reply",
-                                "message": auto_reply_usage.get("message"),
-                                "used": auto_reply_usage.get("used"),
-                                "limit": auto_reply_usage.get("limit")
-                            })
-
-            # ----- SUPPORT MESSAGE TO CUSTOMER -----
-            elif role == SUPPORT and data.get("to") and not data.get("type"):
-                to = data.get("to")
-                msg = data.get("message", "")
-                file_data = data.get("file")
-                agent_user_id = auth.get("user_id")
-                agent_username = auth.get("username", "Support")
-
-                # Get conversation ID for target visitor
-                visitor_data = VISITOR_DATA.get(to, {})
-                conversation_id = visitor_data.get("conversation_id")
-
-                # Save message to API
-                if conversation_id and agent_user_id:
-                    await save_message_to_api(
-                        conversation_id,
-                        "agent",
-                        agent_user_id,
-                        msg,
-                        "file" if file_data else "text",
-                        file_data.get("id") if file_data else None
-                    )
 
-                if to in site["customers"]:
-                    msg_payload = {
-                        "type": "message",
-                        "from": "support",
-                        "name": agent_username,
-                        "message": msg
-                    }
+# ----- AGENT STATUS CHANGE -----
+@ws_handler(SUPPORT, "agent_status_change", schema={"status": str})
+async def handle_agent_status_change(conn: dict, data: dict):
+    site, auth = conn["site"], conn["auth"]
+    status = data.get("status", "online")
+    agent_user_id = auth.get("user_id")
+    agent_username = auth.get("username", "Support")
 
-                    if file_data:
-                        msg_payload["file"] = file_data
+    # Update agent status in multi-agent structure
+    if agent_user_id in site["agents"]:
+        site["agents"][agent_user_id]["status"] = status
 
-                    await site["customers"][to].send_json(msg_payload)
+    ws_log.info("Agent %s status changed to: %s", agent_username, status)
 
-    # -------- DISCONNECT --------
-    except WebSocketDisconnect:
-        if role == CUSTOMER:
-            site["customers"].pop(visitor_id, None)
-            site["names"].pop(visitor_id, None)
-            VISITOR_DATA.pop(visitor_id, None)
-
-            # Notify all agents that user left
-            await broadcast_to_agents(site, {
-                "type": "user_left",
-                "visitorId": visitor_id
+    # Broadcast to other agents
+    await broadcast_to_agents(site, {
+        "type": "agent_status_changed",
+        "agentId": agent_user_id,
+        "username": agent_username,
+        "status": status
+    }, exclude_agent=agent_user_id)
+
+    # Broadcast to all connected customers
+    for vid, cws in site["customers"].items():
+        try:
+            await send_frame(cws, {
+                "type": "agent_status_broadcast",
+                "status": status,
+                "agentName": agent_username
             })
+        except Exception as e:
+            send_log.warning("Failed to send status to customer %s: %s", vid, e)
 
-        elif role == SUPPORT:
-            agent_user_id = auth.get("user_id")
-            agent_data = site["agents"].get(agent_user_id, {})
-            agent_token = agent_data.get("token")
-            agent_username = agent_data.get("username")
 
-            # Update agent status to offline via API
-            if agent_token:
-                await update_agent_status(agent_token, "offline")
+# ----- CLOSE CONVERSATION -----
+@ws_handler(SUPPORT, "close_conversation", schema={"visitorId": WS_ID, "conversationId": WS_ID, "sendCsat": bool, "status": str, "note": str})
+async def handle_close_conversation(conn: dict, data: dict):
+    ws, site, site_id, auth, token = conn["ws"], conn["site"], conn["site_id"], conn["auth"], conn["token"]
+    target_visitor = data.get("visitorId")
+    conversation_id = data.get("conversationId")
+    send_csat = data.get("sendCsat", True)
+    close_status = data.get("status", "resolved")
+    close_note = data.get("note", "")
 
-            # Broadcast to admins that agent is offline
-            await broadcast_to_admins(site, {
-                "type": "agent_offline",
-                "userId": agent_user_id,
-                "username": agent_username,
-                "status": "offline"
-            })
+    ws_log.info("Closing conversation for visitor: %s, status: %s", target_visitor, close_status)
+
+    # Update conversation status in database via API
+    if conversation_id and token:
+        try:
+            async with api_client() as client:
+                response = await client.post(
+                    f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/close",
+                    json={"resolutionStatus": close_status, "note": close_note},
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=10.0
+                )
+                if response.status_code == 200:
+                    ws_log.info("Conversation %s closed in database with status: %s", conversation_id, close_status)
+                else:
+                    ws_log.warning("Failed to close conversation in database: %s - %s", response.status_code, response.text)
+        except Exception as e:
+            ws_log.error("Error updating conversation status: %s", e)
+
+    # Send CSAT request to customer if enabled and customer is connected
+    if send_csat and target_visitor in site["customers"]:
+        agent_username = auth.get("username", "Support")
+        await send_to_customer(site, site_id, target_visitor, {
+            "type": "csat_request",
+            "agentName": agent_username,
+            "conversationId": conversation_id
+        })
+
+    # Notify customer that conversation is closed
+    close_message = "This conversation has been closed. Thank you for chatting with us!"
+    await send_to_customer(site, site_id, target_visitor, {
+        "type": "conversation_closed",
+        "status": close_status,
+        "message": close_message
+    })
+
+    # Save closed message to database
+    if conversation_id:
+        await save_message_to_api(
+            conversation_id=conversation_id,
+            sender_id="system",
+            sender_type="system",
+            content=close_message,
+            message_type="system"
+        )
+
+    # Confirm to support
+    await send_frame(ws, {
+        "type": "conversation_closed",
+        "visitorId": target_visitor,
+        "status": close_status
+    })
+
+
+# ----- TRANSFER CONVERSATION -----
+@ws_handler(SUPPORT, "transfer_conversation", schema={"visitorId": WS_ID, "conversationId": WS_ID, "toAgentId": WS_ID, "note": str})
+async def handle_transfer_conversation(conn: dict, data: dict):
+    ws, site, site_id, auth, token = conn["ws"], conn["site"], conn["site_id"], conn["auth"], conn["token"]
+    target_visitor = data.get("visitorId")
+    conversation_id = data.get("conversationId")
+    to_agent_id = data.get("toAgentId")
+    transfer_note = data.get("note", "")
+
+    from_agent_name = auth.get("username", "Agent")
+
+    ws_log.info("Transfer conversation %s from %s to %s", conversation_id, from_agent_name, to_agent_id)
+
+    if not conversation_id or not to_agent_id:
+        await send_frame(ws, {"type": "transfer_failed", "error": "Missing conversation or agent ID"})
+    else:
+        # 1. Reassign conversation via API
+        transfer_success = False
+        try:
+            async with api_client(verify=False) as client:
+                response = await client.post(
+                    f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/assign",
+                    json={"userId": to_agent_id},
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=10.0
+                )
+                if response.status_code == 200:
+                    transfer_success = True
+                    ws_log.info("Conversation %s reassigned to %s", conversation_id, to_agent_id)
+                else:
+                    ws_log.warning("Failed to reassign conversation: %s - %s", response.status_code, response.text)
+        except Exception as e:
+            ws_log.error("Error reassigning conversation: %s", e)
+
+        if transfer_success:
+            # 2. Save system message about the transfer
+            to_agent_data = site["agents"].get(to_agent_id, {})
+            to_agent_name = to_agent_data.get("username", "another agent")
+            transfer_msg = f"Conversation transferred from {from_agent_name} to {to_agent_name}"
+            if transfer_note:
+                transfer_msg += f". Note: {transfer_note}"
+
+            await save_message_to_api(
+                conversation_id=conversation_id,
+                sender_id="system",
+                sender_type="system",
+                content=transfer_msg,
+                message_type="system"
+            )
 
-            # Broadcast to other agents that this agent left
-            await broadcast_to_agents(site, {
-                "type": "agent_left",
-                "agentId": agent_user_id,
-                "username": agent_username
-            }, exclude_agent=agent_user_id)
-
-            # Remove from agents dict
-            site["agents"].pop(agent_user_id, None)
-            site["supervisors"].pop(agent_user_id, None)
-
-            # Notify customers only if no agents remain
-            if not site["agents"]:
-                for cws in site["customers"].values():
-                    await cws.send_json({
-                        "type": "support_left"
+            # 3. Notify the receiving agent (if online)
+            record_assignment(site, conversation_id, to_agent_id)
+            if to_agent_id in site["agents"]:
+                try:
+                    target_ws = site["agents"][to_agent_id]["ws"]
+                    visitor_name = site["names"].get(target_visitor, target_visitor)
+                    await send_frame(target_ws, {
+                        "type": "conversation_transferred_in",
+                        "visitorId": target_visitor,
+                        "conversationId": conversation_id,
+                        "name": visitor_name,
+                        "fromAgent": from_agent_name,
+                        "note": transfer_note
                     })
+                except Exception as e:
+                    send_log.warning("Failed to notify target agent: %s", e)
+
+            # 4. Confirm to the sending agent
+            await send_frame(ws, {
+                "type": "conversation_transferred_out",
+                "visitorId": target_visitor,
+                "conversationId": conversation_id,
+                "toAgent": to_agent_name
+            })
+        else:
+            await send_frame(ws, {"type": "transfer_failed", "error": "Failed to reassign conversation"})
+
+
+# ----- CSAT RESPONSE FROM CUSTOMER -----
+@ws_handler(CUSTOMER, "csat_response", schema={"rating": (int, float), "feedback": str, "conversationId": WS_ID})
+async def handle_csat_response(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    rating = data.get("rating", 0)
+    feedback = data.get("feedback", "")
+    # Get conversationId from message (preferred) or from VISITOR_DATA
+    conversation_id = data.get("conversationId")
+    if not conversation_id:
+        visitor_data = VISITOR_DATA.get(visitor_id, {})
+        conversation_id = visitor_data.get("conversation_id")
+
+    ws_log.info("CSAT received from %s: %s/5, conversationId: %s", visitor_id, rating, conversation_id)
+
+    if conversation_id:
+        # Get agent token for API call
+        agent_token = None
+        for aid, adata in site.get("agents", {}).items():
+            agent_token = adata.get("token")
+            if agent_token:
+                break
+
+        if agent_token:
+            try:
+                async with api_client(verify=False) as client:
+                    response = await client.post(
+                        f"{API_BASE_URL}/sites/{site_id}/conversations/{conversation_id}/csat",
+                        json={"rating": rating, "feedback": feedback},
+                        headers={"Content-Type": "application/json", "Authorization": f"Bearer {agent_token}"},
+                        timeout=10.0
+                    )
+                    if response.status_code == 200:
+                        ws_log.info("CSAT rating saved for conversation %s", conversation_id)
+                    else:
+                        ws_log.warning("Failed to save CSAT rating: %s - %s", response.status_code, response.text)
+            except Exception as e:
+                ws_log.error("Error saving CSAT rating: %s", e)
+
+        # Save the thank you message to database
+        thank_you_message = "Thank you for your feedback! We appreciate you taking the time to rate your experience."
+        await save_message_to_api(
+            conversation_id=conversation_id,
+            sender_id="system",
+            sender_type="system",
+            content=thank_you_message,
+            message_type="system"
+        )
+
+    # Notify agents of the rating
+    await publish_conversation_event(site, conversation_id, {
+        "type": "csat_received",
+        "visitorId": visitor_id,
+        "conversationId": conversation_id,
+        "rating": rating,
+        "feedback": feedback
+    })
+
+
+# ----- CUSTOMER MESSAGE -----
+@ws_handler(CUSTOMER, (None, "message"), schema={"message": str, "file": dict})
+async def handle_customer_message(conn: dict, data: dict):
+    site, site_id, visitor_id = conn["site"], conn["site_id"], conn["visitor_id"]
+    if "message" not in data and "file" not in data:
+        return
+    msg = data.get("message", "")
+    file_data = data.get("file")
+
+    # Get conversation ID for this visitor
+    visitor_data = VISITOR_DATA.get(visitor_id, {})
+    conversation_id = visitor_data.get("conversation_id")
+    internal_visitor_id = visitor_data.get("internal_visitor_id", visitor_id)
+
+    # Save message to API
+    if conversation_id:
+        await save_message_to_api(
+            conversation_id,
+            "visitor",
+            internal_visitor_id,
+            msg,
+            "file" if file_data else "text",
+            file_data.get("id") if file_data else None
+        )
+
+    # Send message to the conversation's subscribers
+    msg_payload = {
+        "type": "message",
+        "from": visitor_id,
+        "name": site["names"].get(visitor_id, visitor_id),
+        "message": msg
+    }
+
+    if file_data:
+        msg_payload["file"] = file_data
+
+    await publish_conversation_event(site, conversation_id, msg_payload)
+
+    # Evaluate new_message workflows
+    wf_context = {
+        "visitor_id": visitor_id,
+        "visitor_name": site["names"].get(visitor_id, visitor_id),
+        "conversation_id": conversation_id,
+        "message_text": msg or ""
+    }
+    await evaluate_workflows(site, site_id, "new_message", wf_context)
+
+    # Reset idle timer
+    if conversation_id:
+        await start_idle_timer(site, site_id, visitor_id, conversation_id)
+
+    # Run AI analysis if analysis or auto-reply is enabled (off the receive loop)
+    should_analyze = site.get("analysis_enabled", False) or site.get("auto_reply_enabled", False)
+    if msg and not file_data and should_analyze and site.get("agents"):
+        schedule_ai_processing(site, site_id, visitor_id, conversation_id, internal_visitor_id, msg)
+
+
+# ----- SUPPORT MESSAGE TO CUSTOMER -----
+@ws_handler(SUPPORT, None, required=("to",), schema={"to": WS_ID, "message": str, "file": dict})
+async def handle_support_message(conn: dict, data: dict):
+    site, site_id, auth = conn["site"], conn["site_id"], conn["auth"]
+    to = data.get("to")
+    msg = data.get("message", "")
+    file_data = data.get("file")
+    agent_user_id = auth.get("user_id")
+    agent_username = auth.get("username", "Support")
+
+    # Get conversation ID for target visitor
+    visitor_data = VISITOR_DATA.get(to, {})
+    conversation_id = visitor_data.get("conversation_id")
+
+    # Save message to API
+    if conversation_id and agent_user_id:
+        await save_message_to_api(
+            conversation_id,
+            "agent",
+            agent_user_id,
+            msg,
+            "file" if file_data else "text",
+            file_data.get("id") if file_data else None
+        )
+
+    # Delivered now, or replayed if the customer is mid-reconnect
+    msg_payload = {
+        "type": "message",
+        "from": "support",
+        "name": agent_username,
+        "message": msg
+    }
+
+    if file_data:
+        msg_payload["file"] = file_data
+
+    await send_to_customer(site, site_id, to, msg_payload)
 
-        elif role == ADMIN:
-            admin_id = auth.get("user_id", token) if auth else token
-            site["admins"].pop(admin_id, None)
 
 if __name__ == "__main__":
     import uvicorn
     import os
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT,
+                ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
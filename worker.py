@@ -0,0 +1,19 @@
+"""Gunicorn worker class used in production (Procfile, Dockerfile).
+
+UvicornWorker builds its uvicorn Config from CONFIG_KWARGS; the uvicorn.run() arguments under
+main.py's __main__ never apply under gunicorn. The WebSocket settings are read here from the same
+environment variables, with the same defaults, as main.py. This module stays separate from
+main.py so the gunicorn master does not import (and start) the app.
+"""
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class WidgetUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "ws_ping_interval": float(os.getenv("WS_PING_INTERVAL", "20")),
+        "ws_ping_timeout": float(os.getenv("WS_PING_TIMEOUT", "20")),
+        "ws_per_message_deflate": os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true",
+    }